@@ -0,0 +1,121 @@
+"""
+Registry of PEFT LoRA adapters loaded on demand into one shared model.
+
+Characters name an adapter directory in characters.json; the registry
+loads it under a stable name the first time a request needs it and keeps
+the N most recently used adapters resident, unloading the rest. Only the
+generation scheduler thread touches the model, so activate() is called
+from there and switching adapters never happens under another request.
+
+Some backends (the int8 CPU model) can't take new adapters once they are
+prepared: they load every known adapter up front with load_all() and
+then freeze() the registry, after which requests for any other adapter
+fall back to the base model.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+DEFAULT_ADAPTER = "default"
+
+
+def adapter_name(path):
+    return "lora_" + hashlib.sha1(path.encode("utf-8")).hexdigest()[:12]
+
+
+class AdapterRegistry:
+    def __init__(self, model, max_resident=4, pinned=(DEFAULT_ADAPTER,)):
+        self.model = model
+        self.max_resident = max_resident
+        self.pinned = set(pinned)  # Loaded at startup and never unloaded
+        self._paths = {}
+        self._resident = OrderedDict((name, None) for name in self.pinned)
+        self._lock = threading.Lock()
+        self.stats = {"loads": 0, "unloads": 0, "switches": 0, "rejected": 0}
+        self._active = None
+        self.frozen = None  # Why no more adapters can be loaded, once freeze() was called
+
+    def register(self, path):
+        """
+        Records an adapter directory and returns the name requests should
+        use for it, or None (the base model) if the registry is frozen and
+        the adapter wasn't loaded beforehand.
+        """
+        name = adapter_name(path)
+        with self._lock:
+            if self.frozen and name not in self._resident:
+                self.stats["rejected"] += 1
+                print(f"Warning: LoRA adapter {path} can't be loaded ({self.frozen}); using the base model")
+                return None
+            self._paths[name] = path
+        return name
+
+    def load_all(self):
+        """
+        Loads every registered adapter now and pins it, so it is never
+        unloaded. Adapters that fail to load are skipped with a warning.
+        Must be called from the thread that runs the model.
+        """
+        with self._lock:
+            paths = dict(self._paths)
+        for name, path in paths.items():
+            if name in self._resident:
+                continue
+            print(f"Loading LoRA adapter {name} from {path}...")
+            try:
+                self.model.load_adapter(path, adapter_name=name)
+            except Exception as e:
+                print(f"Warning: Could not load LoRA adapter {path}: {e}")
+                continue
+            self._resident[name] = None
+            self.pinned.add(name)
+            self.stats["loads"] += 1
+
+    def freeze(self, reason):
+        """Stops loading new adapters; register() then returns None for unknown ones."""
+        with self._lock:
+            self.frozen = reason
+
+    def path(self, name):
+        """Returns the directory registered under `name` (None for pinned adapters loaded at startup)."""
+        with self._lock:
+            return self._paths.get(name)
+
+    def activate(self, name, in_use=()):
+        """
+        Makes `name` the active adapter, loading it if needed and unloading
+        the least recently used ones beyond max_resident (except those in use).
+        Must be called from the thread that runs the model.
+        """
+        if name not in self._resident:
+            with self._lock:
+                path = self._paths.get(name)
+            if path is None:
+                raise KeyError(f"Unknown adapter: {name}")
+            print(f"Loading LoRA adapter {name} from {path}...")
+            self.model.load_adapter(path, adapter_name=name)
+            self._resident[name] = None
+            self.stats["loads"] += 1
+            self._evict(keep=set(in_use) | {name})
+        self._resident.move_to_end(name)
+
+        if self._active != name:
+            self.model.set_adapter(name)
+            self._active = name
+            self.stats["switches"] += 1
+
+    def _evict(self, keep):
+        for name in list(self._resident):
+            if len(self._resident) <= self.max_resident:
+                break
+            if name in self.pinned or name in keep:
+                continue
+            self.model.delete_adapter(name)
+            del self._resident[name]
+            self.stats["unloads"] += 1
+            if self._active == name:
+                self._active = None
+
+    def get_stats(self):
+        return dict(self.stats, resident=list(self._resident), active=self._active, frozen=self.frozen)
@@ -1,32 +1,67 @@
 import os
 import json
+import hashlib
 import re
 import torch
 import time
 import requests
 import uuid
-from flask import Flask, request, jsonify, render_template, Response
+import threading
+import traceback
+from flask import Flask, request, jsonify, render_template, Response, g
 from flask_cors import CORS
-from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer, BitsAndBytesConfig, StoppingCriteria, StoppingCriteriaList
-from peft import PeftModel
-from threading import Thread
+from transformers import TextIteratorStreamer
 from vts_connector import VTSConnector
+from generation_scheduler import GenerationRequest
+from prefix_cache import make_prefix_key
+from adapter_registry import AdapterRegistry, DEFAULT_ADAPTER
+from stop_matcher import TextStopMatcher
+from lipsync import LipSyncEngine
+from tts_cache import TTSCache, make_key
+from tts_pipeline import SpeechPipeline, SentenceSplitter, EMOTION_TAG
+from voicevox_pool import VoicevoxPool
+from model_worker import RemoteScheduler, load_authkey, KEY_ENV
+import model_runtime as runtime
+from model_runtime import (
+    load_status, prefix_cache, sessions, load_tokenizer, ADAPTER_MAX_RESIDENT, SESSION_MAX
+)
+from json_store import JsonStore, CharacterStore
+from context_window import ContextWindow
+from audio_codec import AudioEncoder
+from metrics import REGISTRY, CONTENT_TYPE, GENERATION_TOKENIZE, counter, gauge, histogram
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-LipSync-Id', 'X-Speech-Id', 'X-Session-Id', 'X-Request-Id'])
 
 # ============================================
 # Configuration
 # ============================================
-BASE_MODEL_PATH = r"c:\Users\Nonx2\Documents\Yuuna-Project\Qwen2.5-1.5B-Instruct"
-LORA_PATH = r"c:\Users\Nonx2\Documents\Yuuna-Project\Qwen25-lora-finetuned"
+# Model paths, scheduler, session and CPU backend settings are in model_runtime.py, which
+# model_worker.py loads without this web app
+# Generate on separate `python model_worker.py` processes instead of loading the model here, e.g.
+# ["127.0.0.1:6001", "127.0.0.1:6002"]; this process then only loads the tokenizer
+MODEL_WORKERS = []
+# Shared secret for the worker connections: the YUUNA_MODEL_WORKER_KEY environment variable, else this
+# file, which the first worker on this machine fills with a random key
+MODEL_WORKER_KEY_FILE = "model_worker.key"
+APP_DEBUG = True
+# Endpoints that use speculative decoding by default when a draft model is loaded; requests can override
+SPECULATIVE_ENDPOINTS = {"chat": False, "generate_prompt": False}
+GENERATE_PROMPT_MAX_CANDIDATES = 8  # Alternatives per instruction in one /api/generate_prompt call
+GENERATE_PROMPT_MAX_REQUESTS = 32  # Instructions x candidates per call; beyond the batch size they queue
 CHARACTERS_FILE = "characters.json"
 VTS_MAPPING_FILE = "vts_mappings.json"
 VTS_HOST = "127.0.0.1"
 VTS_PORT = 8001
+LIPSYNC_FPS = 30  # Parameter frames per second pushed to VTS during speech
+# Trigger the VTS hotkey mapped to a reply's emotion from the server as soon as it is decoded;
+# /api/chat requests can override this with "trigger_vts"
+CHAT_TRIGGER_VTS = False
+CHAT_EMOTION_SCAN_CHARS = 200  # The emotion tag is only looked for this far into a reply
 
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-TORCH_DTYPE = torch.float16 if torch.cuda.is_available() else torch.float32
+CONTEXT_MAX_TOKENS = 3072  # Prompt budget for custom-character conversations; older turns are trimmed
+CONTEXT_TRIM_TO = 0.75  # Fraction of the budget kept after a trim, so trims (and KV re-prefills) are rare
+CONTEXT_SUMMARY_TOKENS = 160  # Length of the rolling summary of trimmed turns (0 to just drop them)
 
 SYSTEM_PROMPT = """You are Yuuna-chan, the user's childhood friend who has been by their side since elementary school. You quietly carry deep feelings for them that sometimes slip through in tender moments.
 
@@ -42,79 +77,185 @@ STRICT RULES:
 Bad example: "[LOVING] Of course. I'm not going anywhere. Your hands are mine. Always have been..." (TOO LONG, repetitive)
 Good example: "[LOVING] ...mn. Just like when we were little. I'm not letting go this time either."""
 
-def load_characters():
-    if not os.path.exists(CHARACTERS_FILE):
-        # Create default character if file doesn't exist
-        default_char = {
-            "id": "default",
-            "name": "YuunaGPT",
-            "description": "Your caring AI companion",
-            "system_prompt": SYSTEM_PROMPT,
-            "avatar": "static/img/gptProfile.png"
-        }
-        save_characters([default_char])
-        return [default_char]
-    
-    try:
-        with open(CHARACTERS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except json.JSONDecodeError:
-        return []
-
-def save_characters(characters):
-    with open(CHARACTERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(characters, f, indent=4, ensure_ascii=False)
-
-# Global model and tokenizer
+# Token-level stop sequences for the default (Alpaca-format) character
+STOP_WORDS = ["Human:", "User:", "### Instruction:", "### Response:", "### Question:", "\n###", "\nHuman:", "\nUser:", "Human", "User"]
+# Precise stop sequences for the stream to avoid yielding hallucinations
+STREAM_STOP_SEQUENCES = ["Human:", "User:", "### Instruction:", "### Response:", "### Question:", "Human", "User"]
+
+# Created with this default character if the file doesn't exist
+DEFAULT_CHARACTER = {
+    "id": "default",
+    "name": "YuunaGPT",
+    "description": "Your caring AI companion",
+    "system_prompt": SYSTEM_PROMPT,
+    "avatar": "static/img/gptProfile.png"
+}
+
+# Parsed once and kept in memory; edits made to the files by hand are picked up via their mtime
+characters = CharacterStore(CHARACTERS_FILE, DEFAULT_CHARACTER)
+vts_mappings = JsonStore(VTS_MAPPING_FILE)
+
+# Global model and tokenizer, set from model_runtime once loaded
 model = None
 tokenizer = None
+scheduler = None
+adapters = None
 vts = VTSConnector(VTS_HOST, VTS_PORT)
-
-class StopOnTokens(StoppingCriteria):
-    def __init__(self, stop_token_sequences):
-        self.stop_token_sequences = stop_token_sequences
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        for seq in self.stop_token_sequences:
-            if len(input_ids[0]) >= len(seq):
-                if torch.equal(input_ids[0][-len(seq):].cpu(), torch.tensor(seq)):
-                    return True
-        return False
+lipsync = LipSyncEngine(vts, fps=LIPSYNC_FPS)
+
+SUMMARY_SYSTEM_PROMPT = ("You summarize conversations. Write a short third-person summary of the facts, events "
+                         "and feelings a companion should remember. Reply with the summary only.")
+
+def count_tokens(text):
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+def summarize_history(previous_summary, messages):
+    """
+    Folds trimmed turns into the rolling summary. Runs on the context
+    window's background thread; the request is batched with chat streams.
+    """
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    if previous_summary:
+        transcript = f"Summary so far:\n{previous_summary}\n\nConversation that followed:\n{transcript}"
+    text = tokenizer.apply_chat_template(
+        [{"role": "system", "content": SUMMARY_SYSTEM_PROMPT}, {"role": "user", "content": transcript}],
+        tokenize=False,
+        add_generation_prompt=True
+    )
+    summary_request = GenerationRequest(
+        tokenizer(text)['input_ids'],
+        max_new_tokens=CONTEXT_SUMMARY_TOKENS,
+        do_sample=False,
+        repetition_penalty=1.1,
+        eos_token_id=tokenizer.eos_token_id,
+        adapter=None  # The base model writes plainer summaries than the character LoRA
+    )
+    scheduler.submit(summary_request)
+    summary_request.wait()
+    if summary_request.error is not None:
+        raise summary_request.error
+    return tokenizer.decode(summary_request.generated_ids, skip_special_tokens=True)
+
+context_window = ContextWindow(
+    count_tokens, CONTEXT_MAX_TOKENS, CONTEXT_TRIM_TO, summarize_history if CONTEXT_SUMMARY_TOKENS else None,
+    max_conversations=SESSION_MAX
+)
+
+_stop_token_sequences = None
+
+def get_stop_token_sequences():
+    global _stop_token_sequences
+    if _stop_token_sequences is None:
+        _stop_token_sequences = [
+            encoded for encoded in (tokenizer.encode(word, add_special_tokens=False) for word in STOP_WORDS)
+            if encoded
+        ]
+    return _stop_token_sequences
 
 def load_yuna():
-    global model, tokenizer
-    print(f"Loading Yuna-chan on {DEVICE}...")
+    """Loads the model in this process (see model_runtime.load_yuna)."""
+    global model, tokenizer, scheduler, adapters
+    runtime.load_yuna([c['adapter'] for c in characters.list() if c.get('adapter')])
+    model, tokenizer, scheduler, adapters = runtime.model, runtime.tokenizer, runtime.scheduler, runtime.adapters
+
+def connect_model_workers():
+    """Web tier only: loads the tokenizer and sends generation to the MODEL_WORKERS processes."""
+    global tokenizer, scheduler, adapters
+    tokenizer = load_tokenizer(runtime.tokenizer_path())
     
-    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_PATH, trust_remote_code=True)
-    if tokenizer.pad_token is None:
-        tokenizer.pad_token = tokenizer.eos_token
-        
-    bnb_config = None
-    if DEVICE == "cuda":
+    load_status["stage"] = "model_workers"
+    authkey = load_authkey(MODEL_WORKER_KEY_FILE)
+    while authkey is None:
+        # Workers create the key file on startup; remote workers need KEY_ENV on both sides
+        print(f"Waiting for {MODEL_WORKER_KEY_FILE} (start model_worker.py) or set {KEY_ENV}")
+        time.sleep(2)
+        authkey = load_authkey(MODEL_WORKER_KEY_FILE)
+    
+    # Only maps adapter names to paths here; the workers load the adapters
+    adapters = AdapterRegistry(None, ADAPTER_MAX_RESIDENT)
+    scheduler = RemoteScheduler(MODEL_WORKERS, authkey, adapters)
+    scheduler.start()
+    print(f"Waiting for model workers: {', '.join(MODEL_WORKERS)}")
+    scheduler.wait_connected()
+
+def start_background_load():
+    """Loads and warms up the model on a thread so the server answers right away."""
+    def run():
+        load_status.update(state="loading", started_at=time.time())
         try:
-            bnb_config = BitsAndBytesConfig(
-                load_in_4bit=True,
-                bnb_4bit_quant_type="nf4",
-                bnb_4bit_compute_dtype=torch.float16,
-            )
-            print("Quantization (4-bit) enabled.")
+            if MODEL_WORKERS:
+                connect_model_workers()
+            else:
+                load_yuna()
+                runtime.warmup()
         except Exception as e:
-            print(f"Warning: Could not initialize bitsandbytes: {e}")
-
-    model = AutoModelForCausalLM.from_pretrained(
-        BASE_MODEL_PATH,
-        quantization_config=bnb_config,
-        torch_dtype=TORCH_DTYPE,
-        device_map="auto" if DEVICE == "cuda" else None,
-        trust_remote_code=True
-    )
-    
-    model = PeftModel.from_pretrained(model, LORA_PATH)
+            traceback.print_exc()
+            load_status.update(state="failed", error=str(e))
+            return
+        load_status.update(state="ready", stage=None, ready_at=time.time())
+        print(f"✅ Yuna-chan is ready! ({load_status['ready_at'] - load_status['started_at']:.1f}s)")
+
+    threading.Thread(target=run, daemon=True).start()
+
+# ============================================
+# Metrics
+# ============================================
+HTTP_REQUEST = histogram("yuuna_http_request_seconds", "HTTP request duration, including streaming", ("endpoint",))
+HTTP_IN_FLIGHT = gauge("yuuna_http_requests_in_flight", "HTTP requests being handled or streamed", ("endpoint",))
+CHAT_STOPPED = counter("yuuna_chat_stop_sequences_total", "Chat replies cut short at a turn marker stop sequence")
+
+gauge("yuuna_generation_active", "Sequences in the running decode batches").set_function(
+    lambda: scheduler.active_count() if scheduler else 0)
+gauge("yuuna_generation_queued", "Generation requests waiting for a batch slot").set_function(
+    lambda: scheduler.queued_count() if scheduler else 0)
+gauge("yuuna_voicevox_in_flight", "VOICEVOX requests currently inside the engines").set_function(
+    lambda: voicevox.in_flight)
+gauge("yuuna_voicevox_queued", "VOICEVOX requests waiting for a concurrency slot").set_function(
+    lambda: voicevox.queued)
+gauge("yuuna_sessions", "Conversation sessions kept on the server").set_function(
+    lambda: sessions.get_stats()["sessions"])
+gauge("yuuna_gpu_memory_allocated_bytes", "GPU memory held by tensors").set_function(
+    lambda: torch.cuda.memory_allocated() if torch.cuda.is_available() else 0)
+gauge("yuuna_gpu_memory_reserved_bytes", "GPU memory reserved by the caching allocator").set_function(
+    lambda: torch.cuda.memory_reserved() if torch.cuda.is_available() else 0)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    HTTP_IN_FLIGHT.inc(endpoint=request.endpoint or "unknown")
+
+@app.after_request
+def observe_request(response):
+    endpoint = request.endpoint or "unknown"
+    start = g.get('request_start', time.perf_counter())
     
-    if DEVICE == "cpu":
-        model = model.to(DEVICE)
-        
-    model.eval()
-    print("✅ Yuna-chan is ready!")
+    # Streams are only finished once the response is closed
+    def done():
+        HTTP_IN_FLIGHT.dec(endpoint=endpoint)
+        HTTP_REQUEST.observe(time.perf_counter() - start, endpoint=endpoint)
+    response.call_on_close(done)
+    g.request_observed = True
+    return response
+
+@app.teardown_request
+def observe_failed_request(exc):
+    # after_request is skipped when a handler raises, so nothing would decrement the gauge
+    if 'request_start' in g and not g.get('request_observed'):
+        endpoint = request.endpoint or "unknown"
+        HTTP_IN_FLIGHT.dec(endpoint=endpoint)
+        HTTP_REQUEST.observe(time.perf_counter() - g.request_start, endpoint=endpoint)
+
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+@app.route('/healthz')
+def healthz():
+    return jsonify({"status": "ok"})
+
+@app.route('/readyz')
+def readyz():
+    return jsonify(load_status), 200 if load_status["state"] == "ready" else 503
 
 @app.route('/')
 def index():
@@ -125,7 +266,96 @@ def vts_test():
     return render_template('vts_test.html')
 
 VOICEVOX_URL = "http://localhost:50021"
+VOICEVOX_URLS = [VOICEVOX_URL]  # Add more engines (e.g. on other ports or machines) to spread synthesis load
+VOICEVOX_HEALTH_INTERVAL = 10  # Seconds between engine health checks; engines that fail leave the rotation
+VOICEVOX_LONG_TEXT_CHARS = 120  # Longer texts are split into sentences synthesized in parallel across engines
 DEFAULT_SPEAKER_ID = 2  # Default speaker ID
+# Audio query fields a request may override; they are part of the cache key
+SYNTHESIS_PARAMS = ("speedScale", "pitchScale", "intonationScale", "volumeScale")
+TTS_CACHE_DIR = "tts_cache"
+TTS_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+TTS_CACHE_DISK_BYTES = 1024 * 1024 * 1024
+TTS_PIPELINE_WORKERS = 2  # Sentences synthesized in parallel while the model is still generating
+VOICEVOX_MAX_CONCURRENCY = 2  # Requests allowed into each engine at once; the rest queue
+# Compressed TTS audio: "auto" picks Ogg/Opus, then MP3, depending on what ffmpeg can encode; requests
+# can ask for "webm", "ogg", "mp3" or "wav". Without an encoder everything is sent as WAV.
+TTS_AUDIO_FORMAT = "auto"
+TTS_AUDIO_BITRATE = "32k"
+FFMPEG_PATH = None  # None looks for ffmpeg on the PATH
+
+tts_cache = TTSCache(TTS_CACHE_DIR, TTS_CACHE_MEMORY_BYTES, TTS_CACHE_DISK_BYTES)
+audio_encoder = AudioEncoder(FFMPEG_PATH, TTS_AUDIO_BITRATE, default_format=TTS_AUDIO_FORMAT)
+voicevox = VoicevoxPool(VOICEVOX_URLS, max_concurrency=VOICEVOX_MAX_CONCURRENCY,
+                        health_interval=VOICEVOX_HEALTH_INTERVAL, long_text_chars=VOICEVOX_LONG_TEXT_CHARS)
+
+def encode_clip(audio, requested_format=None):
+    """
+    Returns (content type, bytes, None) for a clip that is plain WAV or
+    already encoded, or (content type, None, chunks) when the encoder output
+    has to be streamed; the encoded clip is cached once it is complete.
+    """
+    audio_format = audio_encoder.choose(requested_format)
+    content_type = audio_encoder.content_type(audio_format)
+    if audio_format == "wav":
+        return content_type, audio, None
+    
+    # Encoded clips are keyed by the WAV they came from, so pipelined sentences are cached too
+    cache_key = f"{hashlib.sha256(audio).hexdigest()}.{audio_encoder.extension(audio_format)}"
+    encoded = tts_cache.get(cache_key)
+    if encoded is not None:
+        return content_type, encoded, None
+    
+    def stream():
+        chunks = []
+        for chunk in audio_encoder.encode_stream(audio, audio_format):
+            chunks.append(chunk)
+            yield chunk
+        tts_cache.put(cache_key, b"".join(chunks))
+    return content_type, None, stream()
+
+def audio_response(audio, requested_format=None):
+    content_type, body, chunks = encode_clip(audio, requested_format)
+    if body is not None:
+        response = Response(body, content_type=content_type)
+        # Whole clips answer Range requests on GET (seeking, resumed downloads)
+        response.make_conditional(request, accept_ranges=True, complete_length=len(body))
+    else:
+        response = Response(chunks, content_type=content_type)
+    clip_id = lipsync.load(audio)
+    if clip_id:
+        response.headers['X-LipSync-Id'] = clip_id
+    return response
+
+def clean_tts_text(text):
+    # Remove emotion tags like [HAPPY] or [SAD] from the text
+    # This removes any text inside brackets
+    clean_text = re.sub(r'\[[A-Z]+\]', '', text).strip()
+    
+    # If cleaning results in empty string, use original (safety fallback)
+    return clean_text if clean_text else text
+
+def synthesize_speech(text, speaker_id, synthesis_params=None):
+    """
+    Returns WAV bytes for `text`, from the cache when possible.
+    Raises requests.exceptions.ConnectionError if VOICEVOX is down and
+    VoicevoxError if it rejects the request.
+    """
+    processing_text = clean_tts_text(text)
+    synthesis_params = synthesis_params or {}
+    
+    cache_key = make_key(processing_text, speaker_id, synthesis_params)
+    cached = tts_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    audio = voicevox.synthesize(processing_text, speaker_id, synthesis_params)
+    tts_cache.put(cache_key, audio)
+    return audio
+
+def get_synthesis_params(data):
+    return {k: float(data[k]) for k in SYNTHESIS_PARAMS if data.get(k) is not None}
+
+speech_pipeline = SpeechPipeline(synthesize_speech, max_workers=TTS_PIPELINE_WORKERS)
 
 @app.route('/api/tts', methods=['POST'])
 def tts():
@@ -135,45 +365,42 @@ def tts():
     
     if not text:
         return jsonify({"error": "No text provided"}), 400
-        
-    # Remove emotion tags like [HAPPY] or [SAD] from the text
-    # This removes any text inside brackets
-    clean_text = re.sub(r'\[[A-Z]+\]', '', text).strip()
-    
-    # If cleaning results in empty string, use original (safety fallback)
-    processing_text = clean_text if clean_text else text
     
     try:
-        # Step 1: Create audio query
-        query_response = requests.post(
-            f"{VOICEVOX_URL}/audio_query",
-            params={"text": processing_text, "speaker": speaker_id},
-            timeout=10
-        )
-        
-        if query_response.status_code != 200:
-            return jsonify({"error": f"VOICEVOX query failed: {query_response.text}"}), 500
-            
-        query_data = query_response.json()
+        audio = synthesize_speech(text, speaker_id, get_synthesis_params(data))
+        return audio_response(audio, data.get('format'))
         
-        # Step 2: Synthesis
-        synthesis_response = requests.post(
-            f"{VOICEVOX_URL}/synthesis",
-            params={"speaker": speaker_id},
-            json=query_data,
-            timeout=30
-        )
-        
-        if synthesis_response.status_code != 200:
-            return jsonify({"error": f"VOICEVOX synthesis failed: {synthesis_response.text}"}), 500
-            
-        return Response(synthesis_response.content, mimetype='audio/wav')
+    except requests.exceptions.ConnectionError:
+        return jsonify({"error": "VOICEVOX engine is not running. Please start VOICEVOX on port 50021."}), 503
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/speech/<stream_id>/<int:index>', methods=['GET'])
+def speech_chunk(stream_id, index):
+    stream = speech_pipeline.get(stream_id)
+    if stream is None:
+        return jsonify({"error": "Unknown speech stream"}), 404
+    
+    try:
+        audio = stream.get(index)
+        if audio is None:
+            # No more sentences in this response
+            return '', 204
+        return audio_response(audio, request.args.get('format'))
         
     except requests.exceptions.ConnectionError:
         return jsonify({"error": "VOICEVOX engine is not running. Please start VOICEVOX on port 50021."}), 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/tts/cache', methods=['GET'])
+def tts_cache_stats():
+    return jsonify(tts_cache.get_stats())
+
+@app.route('/api/tts/engine', methods=['GET'])
+def tts_engine_stats():
+    return jsonify(dict(voicevox.get_stats(), encoder=audio_encoder.get_stats()))
+
 # ============================================
 # VTube Studio API
 # ============================================
@@ -190,8 +417,9 @@ def get_vts_config():
 def vts_connect():
     try:
         data = request.json
-        if data.get('port'):
+        if data.get('port') and int(data.get('port')) != vts.port:
             vts.port = int(data.get('port'))
+            vts.close()  # Drop the session to the old port
         
         success, msg = vts.authenticate()
         return jsonify({"success": success, "message": msg})
@@ -222,10 +450,6 @@ def vts_trigger():
         if not hotkey_id:
             return jsonify({"error": "No hotkey ID provided"}), 400
             
-        # Try to authenticate if not connected (lazy connect)
-        if not vts.connected or not vts.authenticated:
-            vts.authenticate()
-            
         success, msg = vts.trigger_hotkey(hotkey_id)
         return jsonify({"success": success, "message": msg})
     except Exception as e:
@@ -238,54 +462,60 @@ def vts_parameter():
         param_name = data.get('name', 'MouthOpen')
         value = data.get('value', 0)
         
-        # Try to authenticate if not connected (lazy connect)
-        if not vts.connected or not vts.authenticated:
-            vts.authenticate()
-            
         success, msg = vts.inject_parameter(param_name, value)
         return jsonify({"success": success, "message": msg})
     except Exception as e:
         return jsonify({"success": False, "message": f"Server error: {str(e)}"}), 500
 
-@app.route('/api/vts/mapping', methods=['GET'])
-def get_vts_mapping():
+@app.route('/api/vts/lipsync', methods=['POST'])
+def vts_lipsync():
     try:
-        if os.path.exists(VTS_MAPPING_FILE):
-            with open(VTS_MAPPING_FILE, 'r') as f:
-                return jsonify(json.load(f))
-        return jsonify({})
+        data = request.json
+        action = data.get('action', 'start')
+
+        if action == 'stop':
+            success, msg = lipsync.stop()
+        else:
+            clip_id = data.get('id')
+            if not clip_id:
+                return jsonify({"error": "No clip ID provided"}), 400
+            success, msg = lipsync.start(clip_id, data.get('offset', 0))
+        return jsonify({"success": success, "message": msg})
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"success": False, "message": f"Server error: {str(e)}"}), 500
+
+@app.route('/api/vts/mapping', methods=['GET'])
+def get_vts_mapping():
+    return jsonify(vts_mappings.read() or {})
 
 @app.route('/api/vts/mapping', methods=['POST'])
 def save_vts_mapping():
     try:
-        mapping = request.json
-        with open(VTS_MAPPING_FILE, 'w') as f:
-            json.dump(mapping, f, indent=4)
+        vts_mappings.replace(request.json)
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
 
 @app.route('/api/characters', methods=['GET'])
 def get_characters():
-    return jsonify(load_characters())
+    return jsonify(characters.list())
 
 @app.route('/api/characters', methods=['POST'])
 def save_character():
     data = request.json
-    characters = load_characters()
     
     new_char = {
         "id": str(uuid.uuid4()),
         "name": data.get('name', 'New Character'),
         "description": data.get('description', ''),
         "system_prompt": data.get('system_prompt', ''),
-        "avatar": data.get('avatar', 'static/img/gptProfile.png')
+        "avatar": data.get('avatar', 'static/img/gptProfile.png'),
+        # Optional path to a PEFT LoRA adapter fine-tuned for this character
+        "adapter": data.get('adapter') or None
     }
     
-    characters.append(new_char)
-    save_characters(characters)
+    characters.add(new_char)
+    prefix_cache.invalidate(new_char['id'])
     return jsonify(new_char)
 
 @app.route('/api/characters/<char_id>', methods=['DELETE'])
@@ -293,58 +523,256 @@ def delete_character(char_id):
     if char_id == 'default':
         return jsonify({"error": "Cannot delete default character"}), 400
         
-    characters = load_characters()
-    characters = [c for c in characters if c['id'] != char_id]
-    save_characters(characters)
+    characters.delete(char_id)
+    prefix_cache.invalidate(char_id)
     return jsonify({"success": True})
 
+PROMPT_WRITER_SYSTEM = "You are a helpful assistant that writes system prompts."
+
 @app.route('/api/generate_prompt', methods=['POST'])
 def generate_prompt_api():
-    if model is None or tokenizer is None:
-        return jsonify({"error": "Model not loaded"}), 500
+    """
+    Writes character system prompts. Accepts one "instruction" or a list of
+    "instructions", plus "num_candidates" alternatives per instruction; all
+    of them go through the scheduler together, so they are prefilled and
+    decoded as one batch and the shared system message is only prefilled once.
+    """
+    if load_status["state"] != "ready":
+        return jsonify({"error": "Model not loaded", "status": load_status["state"]}), 503
         
     data = request.json
-    instruction = data.get('instruction', '')
-    
-    if not instruction:
+    instructions = data.get('instructions')
+    single = instructions is None
+    if single:
+        instructions = [data.get('instruction', '')]
+    if not isinstance(instructions, list) or not all(isinstance(i, str) and i.strip() for i in instructions):
         return jsonify({"error": "Instruction is required"}), 400
-        
-    messages = [
-        {"role": "system", "content": "You are a helpful assistant that writes system prompts."},
-        {"role": "user", "content": instruction}
-    ]
     
-    text = tokenizer.apply_chat_template(
-        messages,
-        tokenize=False,
-        add_generation_prompt=True
+    try:
+        num_candidates = int(data.get('num_candidates', 1))
+    except (TypeError, ValueError):
+        return jsonify({"error": "num_candidates must be an integer"}), 400
+    if not 1 <= num_candidates <= GENERATE_PROMPT_MAX_CANDIDATES:
+        return jsonify({"error": f"num_candidates must be between 1 and {GENERATE_PROMPT_MAX_CANDIDATES}"}), 400
+    if len(instructions) * num_candidates > GENERATE_PROMPT_MAX_REQUESTS:
+        return jsonify({"error": f"At most {GENERATE_PROMPT_MAX_REQUESTS} prompts can be generated per call"}), 400
+    
+    prefix_text = tokenizer.apply_chat_template(
+        [{"role": "system", "content": PROMPT_WRITER_SYSTEM}], tokenize=False
     )
+    prefix_key = make_prefix_key("generate_prompt", prefix_text, DEFAULT_ADAPTER)
+    prefix_len = len(tokenizer(prefix_text)['input_ids'])
+    speculative = bool(data.get('speculative', SPECULATIVE_ENDPOINTS['generate_prompt']))
     
-    inputs = tokenizer(text, return_tensors="pt").to(model.device)
-    
-    with torch.no_grad():
-        outputs = model.generate(
-            **inputs,
-            max_new_tokens=80,
-            do_sample=True,
-            temperature=0.7,
-            top_p=0.9,
-            repetition_penalty=1.35,
-            eos_token_id=tokenizer.eos_token_id,
-            pad_token_id=tokenizer.eos_token_id,
+    batches = []
+    for instruction in instructions:
+        messages = [
+            {"role": "system", "content": PROMPT_WRITER_SYSTEM},
+            {"role": "user", "content": instruction}
+        ]
+        text = tokenizer.apply_chat_template(
+            messages,
+            tokenize=False,
+            add_generation_prompt=True
         )
-                
-    generated_ids = outputs[0][inputs['input_ids'].shape[1]:]
-    response = tokenizer.decode(generated_ids, skip_special_tokens=True)
+        input_ids = tokenizer(text)['input_ids']
+        
+        candidates = [
+            GenerationRequest(
+                input_ids,
+                max_new_tokens=80,
+                do_sample=True,
+                temperature=0.7,
+                top_p=0.9,
+                repetition_penalty=1.35,
+                eos_token_id=tokenizer.eos_token_id,
+                prefix_key=prefix_key if text.startswith(prefix_text) else None,
+                prefix_len=prefix_len,
+                speculative=speculative
+            )
+            for _ in range(num_candidates)
+        ]
+        for candidate in candidates:
+            scheduler.submit(candidate)
+        batches.append((instruction, candidates))
     
-    return jsonify({"system_prompt": response.strip()})
+    results = []
+    for instruction, candidates in batches:
+        texts = []
+        for candidate in candidates:
+            candidate.wait()
+            if candidate.error is not None:
+                for _, others in batches:
+                    for other in others:
+                        other.cancel()
+                return jsonify({"error": str(candidate.error)}), 500
+            texts.append(tokenizer.decode(candidate.generated_ids, skip_special_tokens=True).strip())
+        results.append({"instruction": instruction, "candidates": texts})
+    
+    if single:
+        return jsonify({"system_prompt": results[0]["candidates"][0], "candidates": results[0]["candidates"]})
+    return jsonify({"results": results})
 
-@app.route('/api/chat', methods=['POST'])
-def chat():
-    if model is None or tokenizer is None:
+@app.route('/api/chat/stats', methods=['GET'])
+def chat_stats():
+    if scheduler is None:
+        return jsonify({"error": "Model not loaded"}), 500
+    return jsonify(dict(scheduler.get_stats(), context=context_window.get_stats()))
+
+@app.route('/api/chat/<request_id>/cancel', methods=['POST'])
+def cancel_chat(request_id):
+    if scheduler is None:
         return jsonify({"error": "Model not loaded"}), 500
+    return jsonify({"success": scheduler.cancel(request_id)})
+
+@app.route('/api/chat/session/<session_id>', methods=['DELETE'])
+def drop_session(session_id):
+    context_window.forget(session_id)
+    if isinstance(scheduler, RemoteScheduler):
+        scheduler.drop_session(session_id)  # The KV cache lives in the worker
+    return jsonify({"success": sessions.drop(session_id)})
+
+def sse_event(event, data):
+    """One Server-Sent Events frame with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def trigger_hotkey_in_background(hotkey_id):
+    """Fires a VTS hotkey without holding up the stream that detected the emotion."""
+    def run():
+        success, msg = vts.trigger_hotkey(hotkey_id)
+        if not success:
+            print(f"VTS hotkey {hotkey_id} failed: {msg}")
+    threading.Thread(target=run, daemon=True).start()
+
+class ChatTurn:
+    """
+    One /api/chat reply: the generation request plus stop-sequence matching,
+    emotion/sentence detection and speech pipelining of its text. Shared by
+    the Flask route and the ASGI server (asgi_app.py), which only differ in
+    how they read the streamer.
+    
+    The reply is sent as SSE events:
+    - token: {"text"} decoded text, emotion tags included
+    - emotion: {"emotion", "hotkey_id", "triggered"} once, as soon as the first [TAG] is decoded
+    - sentence: {"index", "text"} each finished sentence; with TTS, index is its /api/speech chunk
+    - timing: per-stage breakdown in seconds
+    - done: {"duration"} or error: {"message"}, always the last event
+    """
+    
+    def __init__(self, generation_request, streamer, session, speech, tokenize_time,
+                 trigger_vts=False, trigger_hotkey=None, mappings=None):
+        self.request = generation_request
+        self.streamer = streamer
+        self.session = session
+        self.speech = speech
+        self.tokenize_time = tokenize_time
+        self.trigger_vts = trigger_vts
+        self.trigger_hotkey = trigger_hotkey
+        # Emotion -> hotkey mappings, read before the turn starts so feed() does no file I/O
+        self.mappings = mappings or {}
+        # Stop sequences are matched incrementally on the new text only
+        self.matcher = TextStopMatcher(STREAM_STOP_SEQUENCES)
+        self.splitter = SentenceSplitter()
+        self.sentences = 0
+        self.emotion = None
+        self._scanned = 0  # Characters of the reply searched for the emotion tag so far
+        self._tag_tail = ""  # Unfinished "[..." carried into the next chunk
+        self.start_time = None
+    
+    def start(self):
+        self.start_time = time.time()
+        scheduler.submit(self.request)
+    
+    def feed(self, new_text):
+        """Returns (SSE frames to send, stopped) for a decoded chunk."""
+        # Looked for in the raw chunk, since the stop matcher may hold part of it back
+        events = self._emotion_events(new_text)
+        clean_text, stopped = self.matcher.feed(new_text)
+        if stopped:
+            CHAT_STOPPED.inc()
+        return events + self._text_events(clean_text), stopped
+    
+    def finish(self):
+        """Returns the last SSE frames: held-back text, the last sentence, timing and done/error."""
+        self.request.cancel()
+        events = self._text_events(self.matcher.flush())
+        for sentence in self.splitter.flush():
+            events.append(self._sentence_event(sentence))
+        if self.speech:
+            self.speech.end()
         
-    data = request.json
+        if self.request.error is not None:
+            events.append(sse_event("error", {"message": str(self.request.error)}))
+            return events
+        
+        end_time = time.time()
+        timings = dict(self.request.timings, tokenize=self.tokenize_time, total=end_time - self.start_time)
+        timings = {k: round(v, 4) if isinstance(v, float) else v for k, v in timings.items()}
+        events.append(sse_event("timing", timings))
+        events.append(sse_event("done", {"duration": round(end_time - self.start_time, 2)}))
+        return events
+    
+    def close(self):
+        """
+        Runs when the response is closed, including when the client
+        disconnects early; speech not yet synthesized is then cancelled.
+        """
+        self.request.cancel()
+        if self.speech:
+            self.speech.close()
+    
+    def headers(self):
+        headers = {'X-Request-Id': self.request.id, 'Cache-Control': 'no-cache'}
+        if self.session:
+            headers['X-Session-Id'] = self.session.id
+        if self.speech:
+            headers['X-Speech-Id'] = self.speech.id
+        return headers
+    
+    def _text_events(self, text):
+        if not text:
+            return []
+        events = [sse_event("token", {"text": text})]
+        for sentence in self.splitter.feed(text):
+            events.append(self._sentence_event(sentence))
+        return events
+    
+    def _emotion_events(self, text):
+        if self.emotion is not None or self._scanned >= CHAT_EMOTION_SCAN_CHARS:
+            return []
+        self._scanned += len(text)
+        # Only the new chunk is searched, plus a tag that was still open at the end of the last one
+        window = self._tag_tail + text
+        match = EMOTION_TAG.search(window)
+        if match is None:
+            start = window.rfind('[')
+            self._tag_tail = window[start:] if start != -1 else ""
+            return []
+        # Sent ahead of the token that completes the tag so the avatar reacts first
+        self.emotion = match.group(0)[1:-1]
+        self._tag_tail = ""
+        return [self._emotion_event()]
+    
+    def _emotion_event(self):
+        hotkey_id = self.mappings.get(self.emotion)
+        triggered = bool(hotkey_id and self.trigger_vts and self.trigger_hotkey)
+        if triggered:
+            self.trigger_hotkey(hotkey_id)
+        return sse_event("emotion", {"emotion": self.emotion, "hotkey_id": hotkey_id, "triggered": triggered})
+    
+    def _sentence_event(self, sentence):
+        if self.speech:
+            self.speech.say(sentence)
+        index = self.sentences
+        self.sentences += 1
+        return sse_event("sentence", {"index": index, "text": sentence})
+
+def build_chat_request(data, streamer=None, session=None):
+    """
+    Formats an /api/chat payload into a GenerationRequest: the Alpaca prompt
+    for the default character, the chat template for custom ones. Returns
+    (request, seconds spent tokenizing). Also used by batch.py.
+    """
     user_messages = data.get('messages', [])
     system_prompt = data.get('system_prompt', SYSTEM_PROMPT)
     character_id = data.get('character_id', 'default')
@@ -355,10 +783,15 @@ def chat():
             messages = [{"role": "system", "content": system_prompt}] + user_messages
         else:
             messages = user_messages
+        # Long conversations keep the system prompt and only the recent turns that fit the budget.
+        # Trim state is remembered only for client sessions; one-off requests are fitted statelessly
+        conversation_key = session.id if session is not None else None
+        messages = context_window.fit(messages, conversation_key)
     else:
         messages = user_messages
 
     # Format for inference
+    tokenize_start = time.perf_counter()
     if character_id == 'default':
         # Use Alpaca format used in training/colab-chat.py
         user_input = user_messages[-1]['content'] if user_messages else ""
@@ -370,106 +803,94 @@ def chat():
             add_generation_prompt=True
         )
     
-    inputs = tokenizer(text, return_tensors="pt").to(model.device)
+    input_ids = tokenizer(text)['input_ids']
+    tokenize_time = time.perf_counter() - tokenize_start
+    GENERATION_TOKENIZE.observe(tokenize_time)
     
-    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    # Default character uses the Yuna LoRA; custom characters use their own adapter or the base model
+    adapter = DEFAULT_ADAPTER
+    if character_id != 'default':
+        character = characters.get(character_id) or {}
+        adapter = adapters.register(character['adapter']) if character.get('adapter') else None
     
-    # Define more comprehensive stop sequences
-    stop_words = ["Human:", "User:", "### Instruction:", "### Response:", "### Question:", "\n###", "\nHuman:", "\nUser:", "Human", "User"]
-    stop_token_sequences = []
-    for word in stop_words:
-        encoded = tokenizer.encode(word, add_special_tokens=False)
-        if encoded:
-            stop_token_sequences.append(encoded)
-            
-    stopping_criteria = StoppingCriteriaList([StopOnTokens(stop_token_sequences)])
-
-    generation_kwargs = dict(
-        **inputs,
+    # The character's system prompt is the same every turn, so its KV can be reused
+    prefix_key = None
+    prefix_len = 0
+    if character_id != 'default' and messages and messages[0].get('role') == 'system':
+        prefix_text = tokenizer.apply_chat_template(messages[:1], tokenize=False)
+        if text.startswith(prefix_text):
+            prefix_key = make_prefix_key(character_id, prefix_text, adapter)
+            prefix_len = len(tokenizer(prefix_text)['input_ids'])
+    
+    generation_request = GenerationRequest(
+        input_ids,
         streamer=streamer,
         max_new_tokens=256 if character_id == 'default' else 512,
         temperature=0.7,
         top_p=0.9,
         do_sample=True,
         repetition_penalty=1.35, # Added to prevent the looping behavior seen in screenshots
-        pad_token_id=tokenizer.eos_token_id,
         eos_token_id=tokenizer.eos_token_id,
-        stopping_criteria=stopping_criteria if character_id == 'default' else None
+        stop_token_sequences=get_stop_token_sequences() if character_id == 'default' else None,
+        adapter=adapter,
+        prefix_key=prefix_key,
+        prefix_len=prefix_len,
+        session=session,
+        speculative=bool(data.get('speculative', SPECULATIVE_ENDPOINTS['chat']))
     )
+    return generation_request, tokenize_time
+
+def prepare_chat(data, streamer, trigger_hotkey=None):
+    """
+    Builds the generation request for an /api/chat payload; tokens will
+    arrive on `streamer`. `trigger_hotkey(hotkey_id)` fires the VTS hotkey
+    mapped to the reply's emotion when the payload asks for it.
+    """
+    # The session's KV cache covers the history already prefilled in earlier turns. Only kept
+    # for clients that send a session_id or opt in with "session": true; others get none
+    session = None
+    if data.get('session_id') or data.get('session'):
+        session = sessions.get(data.get('session_id'))
+    
+    # Optional sentence-pipelined TTS: audio is fetched from /api/speech/<id>/<index>
+    speech = None
+    if data.get('tts'):
+        speech = speech_pipeline.open(int(data.get('speaker', DEFAULT_SPEAKER_ID)), get_synthesis_params(data))
     
-    # Add optional parameters only for custom characters
+    generation_request, tokenize_time = build_chat_request(data, streamer, session)
+    trigger_vts = bool(data.get('trigger_vts', CHAT_TRIGGER_VTS))
+    return ChatTurn(generation_request, streamer, session, speech, tokenize_time, trigger_vts, trigger_hotkey,
+                    vts_mappings.read())
 
-    def generate_task():
-        if character_id != 'default':
-            # Use base model for custom characters
-            with model.disable_adapter():
-                model.generate(**generation_kwargs)
-        else:
-            # Use LoRA for default character
-            model.generate(**generation_kwargs)
+@app.route('/api/chat', methods=['POST'])
+def chat():
+    if load_status["state"] != "ready":
+        return jsonify({"error": "Model not loaded", "status": load_status["state"]}), 503
+    
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    turn = prepare_chat(request.json, streamer, trigger_hotkey_in_background)
 
     def generate():
-        start_time = time.time()
-        thread = Thread(target=generate_task)
-        thread.start()
-        
-        full_response = ""
-        # Precise stop sequences for the stream to avoid yielding hallucinations
-        stop_sequences = ["Human:", "User:", "### Instruction:", "### Response:", "### Question:", "Human", "User"]
-        
-        for new_text in streamer:
-            full_response += new_text
-            
-            # Check for stop sequences in the stream (using the full accumulated response)
-            should_stop = False
-            for seq in stop_sequences:
-                if seq in full_response:
-                    # Capture the part of the response BEFORE the first occurrence of any stop sequence
-                    should_stop = True
+        turn.start()
+        try:
+            for new_text in streamer:
+                events, stopped = turn.feed(new_text)
+                yield from events
+                if stopped:
                     break
-            
-            if should_stop:
-                # We found a stop sequence. Now we must extract the clean part.
-                # Find the earliest stop sequence in the full response
-                earliest_pos = len(full_response)
-                for seq in stop_sequences:
-                    pos = full_response.find(seq)
-                    if pos != -1 and pos < earliest_pos:
-                        earliest_pos = pos
-                
-                # The "clean" response is everything before earliest_pos
-                # We want to yield ONLY the part of 'new_text' that is before the stop sequence.
-                # To do this safely, we calculate how much of the clean response we haven't yielded yet.
-                yielded_so_far = full_response[:-len(new_text)]
-                clean_full_response = full_response[:earliest_pos]
-                
-                # If the clean response is longer than what we already yielded, yield the difference
-                if len(clean_full_response) > len(yielded_so_far):
-                    remaining_clean = clean_full_response[len(yielded_so_far):]
-                    if remaining_clean:
-                        yield remaining_clean
-                
-                print(f"DEBUG: Stopped generation because a turn marker was detected.")
-                break
-                
-            yield new_text
-            
-        end_time = time.time()
-        duration = round(end_time - start_time, 2)
-        # Yield the duration at the end in a special format
-        yield f"\n__DURATION__{duration}"
+        finally:
+            # Frees the batch slot after a stop sequence, or when the client disconnects (GeneratorExit)
+            turn.request.cancel()
+        yield from turn.finish()
 
-    return Response(generate(), mimetype='text/event-stream')
+    response = Response(generate(), mimetype='text/event-stream', headers=turn.headers())
+    # Covers clients that disconnect before or during the stream; also cancels their pending speech
+    response.call_on_close(turn.close)
+    return response
 
 if __name__ == '__main__':
-    # Use environment variable check to prevent loading the model twice when using Flask's reloader
-    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
-        load_yuna()
-    elif not os.environ.get("WERKZEUG_RUN_MAIN"):
-        # This branch runs in the master process if not using reloader, 
-        # but we want to load it here too for standard runs without debug.
-        # However, if debug=True is set, it will start a child soon.
-        if not app.debug:
-            load_yuna()
-
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Under the debug reloader the parent process only watches files; load the model in the serving child
+    if not APP_DEBUG or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_load()
+
+    app.run(host='0.0.0.0', port=5000, debug=APP_DEBUG)
@@ -0,0 +1,280 @@
+"""
+Async (ASGI) server for Yuuna: `uvicorn asgi_app:app --port 5000`.
+
+/api/chat, /api/tts, /api/speech and the VTS hotkey/parameter routes run
+natively on the event loop: chat streams are fed from the generation
+thread through an asyncio queue, and VOICEVOX and VTube Studio requests
+are awaited instead of blocking a thread. Every other route is served by
+the Flask app in app.py through a WSGI bridge, so both modes share the
+same model, scheduler, sessions and caches.
+
+Idle or slow SSE consumers therefore cost a coroutine each rather than a
+thread; the thread pools used for blocking work and for the Flask routes
+are capped at ASGI_THREADS and ASGI_WSGI_THREADS.
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import anyio.to_thread
+import requests
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from transformers import AsyncTextIteratorStreamer
+
+import app as yuna
+from tts_cache import make_key
+from audio_codec import byte_range
+
+# ============================================
+# Configuration
+# ============================================
+ASGI_HOST = "0.0.0.0"
+ASGI_PORT = 5000
+ASGI_THREADS = 8  # Threads for blocking work (tokenization, cache I/O, lip-sync analysis)
+ASGI_WSGI_THREADS = 8  # Threads serving the Flask routes without an async version
+
+VOICEVOX_DOWN = "VOICEVOX engine is not running. Please start VOICEVOX on port 50021."
+
+
+def observed(endpoint):
+    """Records the route in the same HTTP metrics the Flask routes use."""
+    def decorator(handler):
+        async def wrapper(request):
+            yuna.HTTP_IN_FLIGHT.inc(endpoint=endpoint)
+            start = time.perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                yuna.HTTP_IN_FLIGHT.dec(endpoint=endpoint)
+                yuna.HTTP_REQUEST.observe(time.perf_counter() - start, endpoint=endpoint)
+        return wrapper
+    return decorator
+
+
+async def audio_response(request, audio, requested_format=None):
+    content_type, body, chunks = await run_in_threadpool(yuna.encode_clip, audio, requested_format)
+    clip_id = await run_in_threadpool(yuna.lipsync.load, audio)
+    headers = {'X-LipSync-Id': clip_id} if clip_id else {}
+    if body is None:
+        return StreamingResponse(chunks, media_type=content_type, headers=headers)
+
+    if request.method not in ('GET', 'HEAD'):
+        return Response(body, media_type=content_type, headers=headers)
+
+    # Whole clips answer Range requests (seeking, resumed downloads)
+    headers['Accept-Ranges'] = 'bytes'
+    try:
+        span = byte_range(request.headers.get('range'), len(body))
+    except ValueError:
+        return Response(status_code=416, headers={'Content-Range': f'bytes */{len(body)}'})
+    if span is None:
+        return Response(body, media_type=content_type, headers=headers)
+    start, end = span
+    headers['Content-Range'] = f'bytes {start}-{end}/{len(body)}'
+    return Response(body[start:end + 1], status_code=206, media_type=content_type, headers=headers)
+
+
+async def synthesize_speech(text, speaker_id, synthesis_params=None):
+    """yuna.synthesize_speech() with the VOICEVOX round trips awaited."""
+    processing_text = yuna.clean_tts_text(text)
+    synthesis_params = synthesis_params or {}
+
+    cache_key = make_key(processing_text, speaker_id, synthesis_params)
+    cached = await run_in_threadpool(yuna.tts_cache.get, cache_key)
+    if cached is not None:
+        return cached
+
+    audio = await yuna.voicevox.synthesize_async(processing_text, speaker_id, synthesis_params)
+    await run_in_threadpool(yuna.tts_cache.put, cache_key, audio)
+    return audio
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that always closes its body and calls `on_close`,
+    even if the client is gone before the first chunk. Starlette only
+    closes the body by running it to the end, so a generator that never
+    started would skip its `finally`, and background tasks are skipped
+    when sending fails.
+    """
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
+            self.on_close()
+
+
+_hotkey_tasks = set()  # Keeps fire-and-forget hotkey triggers alive until they finish
+
+
+def trigger_hotkey(hotkey_id):
+    """Fires a VTS hotkey from the event loop without holding up the chat stream."""
+    async def run():
+        success, msg = await yuna.vts.trigger_hotkey_async(hotkey_id)
+        if not success:
+            print(f"VTS hotkey {hotkey_id} failed: {msg}")
+
+    task = asyncio.get_running_loop().create_task(run())
+    _hotkey_tasks.add(task)
+    task.add_done_callback(_hotkey_tasks.discard)
+
+
+# ============================================
+# Routes
+# ============================================
+async def chat(request):
+    if yuna.load_status["state"] != "ready":
+        return JSONResponse({"error": "Model not loaded", "status": yuna.load_status["state"]}, 503)
+
+    data = await request.json()
+    streamer = AsyncTextIteratorStreamer(yuna.tokenizer, skip_prompt=True, skip_special_tokens=True)
+    # Tokenizing and loading a character's adapter block, so they run on a worker thread
+    turn = await run_in_threadpool(yuna.prepare_chat, data, streamer, trigger_hotkey)
+
+    async def generate():
+        # Counted from the first chunk; the finally below only runs once the body has started
+        yuna.HTTP_IN_FLIGHT.inc(endpoint="chat")
+        start = time.perf_counter()
+        try:
+            # Submitting may block on a model worker's socket (RemoteScheduler), so it runs off the loop
+            await run_in_threadpool(turn.start)
+            async for new_text in streamer:
+                events, stopped = turn.feed(new_text)
+                for event in events:
+                    yield event
+                if stopped:
+                    break
+            for chunk in turn.finish():
+                yield chunk
+        finally:
+            # Also runs when the client disconnects mid-stream and the generator is closed
+            turn.close()
+            yuna.HTTP_IN_FLIGHT.dec(endpoint="chat")
+            yuna.HTTP_REQUEST.observe(time.perf_counter() - start, endpoint="chat")
+
+    # turn.close() again in case the body never started, so the speech stream isn't left open
+    return ClosingStreamingResponse(generate(), turn.close, media_type='text/event-stream', headers=turn.headers())
+
+
+@observed("tts")
+async def tts(request):
+    data = await request.json()
+    text = data.get('text', '')
+    speaker_id = int(data.get('speaker', yuna.DEFAULT_SPEAKER_ID))
+
+    if not text:
+        return JSONResponse({"error": "No text provided"}, 400)
+
+    try:
+        audio = await synthesize_speech(text, speaker_id, yuna.get_synthesis_params(data))
+        return await audio_response(request, audio, data.get('format'))
+
+    except requests.exceptions.ConnectionError:
+        return JSONResponse({"error": VOICEVOX_DOWN}, 503)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, 500)
+
+
+@observed("speech_chunk")
+async def speech_chunk(request):
+    stream = yuna.speech_pipeline.get(request.path_params['stream_id'])
+    if stream is None:
+        return JSONResponse({"error": "Unknown speech stream"}, 404)
+
+    try:
+        audio = await stream.get_async(request.path_params['index'])
+        if audio is None:
+            # No more sentences in this response
+            return Response(status_code=204)
+        return await audio_response(request, audio, request.query_params.get('format'))
+
+    except requests.exceptions.ConnectionError:
+        return JSONResponse({"error": VOICEVOX_DOWN}, 503)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, 500)
+
+
+@observed("get_vts_hotkeys")
+async def get_vts_hotkeys(request):
+    try:
+        return JSONResponse(await yuna.vts.get_hotkeys_async())
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, 500)
+
+
+@observed("vts_trigger")
+async def vts_trigger(request):
+    try:
+        data = await request.json()
+        hotkey_id = data.get('id')
+        if not hotkey_id:
+            return JSONResponse({"error": "No hotkey ID provided"}, 400)
+
+        success, msg = await yuna.vts.trigger_hotkey_async(hotkey_id)
+        return JSONResponse({"success": success, "message": msg})
+    except Exception as e:
+        return JSONResponse({"success": False, "message": f"Server error: {str(e)}"}, 500)
+
+
+@observed("vts_parameter")
+async def vts_parameter(request):
+    try:
+        data = await request.json()
+        param_name = data.get('name', 'MouthOpen')
+        value = data.get('value', 0)
+
+        success, msg = await yuna.vts.inject_parameters_async({param_name: value})
+        return JSONResponse({"success": success, "message": msg})
+    except Exception as e:
+        return JSONResponse({"success": False, "message": f"Server error: {str(e)}"}, 500)
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    # One small pool for everything blocking: Starlette/anyio offloads and asyncio.to_thread
+    anyio.to_thread.current_default_thread_limiter().total_tokens = ASGI_THREADS
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(ASGI_THREADS))
+    if yuna.load_status["state"] == "idle":
+        yuna.start_background_load()
+    yield
+    await yuna.voicevox.aclose()
+    yuna.voicevox.close()
+    yuna.vts.close()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/chat', chat, methods=['POST']),
+        Route('/api/tts', tts, methods=['POST']),
+        Route('/api/speech/{stream_id}/{index:int}', speech_chunk, methods=['GET']),
+        Route('/api/vts/hotkeys', get_vts_hotkeys, methods=['GET']),
+        Route('/api/vts/trigger', vts_trigger, methods=['POST']),
+        Route('/api/vts/parameter', vts_parameter, methods=['POST']),
+        Mount('/', WSGIMiddleware(yuna.app, workers=ASGI_WSGI_THREADS)),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'],
+                   expose_headers=['X-LipSync-Id', 'X-Speech-Id', 'X-Session-Id', 'X-Request-Id']),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, host=ASGI_HOST, port=ASGI_PORT)
@@ -0,0 +1,137 @@
+"""
+Compressed, streamed audio for TTS responses.
+
+VOICEVOX returns 16-bit PCM WAV. When an ffmpeg binary with libopus or
+libmp3lame is available, clips are re-encoded to Opus (WebM or Ogg) or
+MP3 as a stream: encoded bytes are sent as ffmpeg produces them, so the
+response starts before encoding is done and the browser can begin
+playback before the download completes. Without an encoder, clips are
+sent as WAV.
+
+Also parses HTTP Range headers for clips whose bytes are fully known.
+"""
+
+import shutil
+import subprocess
+import threading
+
+# format -> (Content-Type, file extension, ffmpeg encoder, ffmpeg output arguments)
+FORMATS = {
+    "webm": ('audio/webm; codecs="opus"', "webm", "libopus", ["-c:a", "libopus", "-f", "webm"]),
+    "ogg": ("audio/ogg; codecs=opus", "ogg", "libopus", ["-c:a", "libopus", "-f", "ogg"]),
+    "mp3": ("audio/mpeg", "mp3", "libmp3lame", ["-c:a", "libmp3lame", "-f", "mp3"]),
+    "wav": ("audio/wav", "wav", None, None),
+}
+ALIASES = {"opus": "ogg", "mpeg": "mp3"}
+PREFERENCE = ("ogg", "mp3", "wav")  # What "auto" resolves to, best first
+
+
+class AudioEncoder:
+    def __init__(self, ffmpeg=None, bitrate="32k", chunk_size=16 * 1024, default_format="auto"):
+        self.ffmpeg = ffmpeg or shutil.which("ffmpeg")
+        self.bitrate = bitrate
+        self.chunk_size = chunk_size
+        self.default_format = default_format
+        self.available = self._probe()
+        self.stats = {name: 0 for name in FORMATS if name != "wav"}
+        self.stats["encode_errors"] = 0
+
+    def _probe(self):
+        """Returns the formats this machine can produce."""
+        available = {"wav"}
+        if not self.ffmpeg:
+            return available
+        try:
+            encoders = subprocess.run(
+                [self.ffmpeg, "-hide_banner", "-encoders"], capture_output=True, text=True, timeout=10
+            ).stdout
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"Audio encoder: ffmpeg at {self.ffmpeg} is unusable ({e}); sending WAV")
+            return available
+        for name, (_, _, encoder, _) in FORMATS.items():
+            if encoder and encoder in encoders:
+                available.add(name)
+        return available
+
+    def choose(self, requested=None):
+        """Resolves a requested format ("auto" or None for the default) to one that can be produced."""
+        requested = (requested or "auto").lower()
+        if requested == "auto":
+            requested = self.default_format
+        requested = ALIASES.get(requested, requested)
+        if requested == "auto":
+            return next(name for name in PREFERENCE if name in self.available)
+        return requested if requested in self.available else "wav"
+
+    @staticmethod
+    def content_type(audio_format):
+        return FORMATS[audio_format][0]
+
+    @staticmethod
+    def extension(audio_format):
+        return FORMATS[audio_format][1]
+
+    def encode_stream(self, wav_bytes, audio_format):
+        """Yields the clip encoded to `audio_format` (not "wav") chunk by chunk as ffmpeg writes it."""
+        self.stats[audio_format] += 1
+
+        args = [self.ffmpeg, "-hide_banner", "-loglevel", "error", "-f", "wav", "-i", "pipe:0",
+                "-b:a", self.bitrate] + FORMATS[audio_format][3] + ["pipe:1"]
+        process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def feed():
+            # Written from another thread so a full stdout pipe can't deadlock us
+            try:
+                process.stdin.write(wav_bytes)
+            except OSError:
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+
+        threading.Thread(target=feed, daemon=True).start()
+        try:
+            while True:
+                chunk = process.stdout.read1(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            if process.wait() != 0:
+                self.stats["encode_errors"] += 1
+                raise RuntimeError(f"ffmpeg failed: {process.stderr.read().decode(errors='replace').strip()}")
+        finally:
+            # Also reached when the client disconnects and the generator is closed early
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            process.stderr.close()
+
+    def get_stats(self):
+        return dict(self.stats, ffmpeg=self.ffmpeg, available=sorted(self.available))
+
+
+def byte_range(header, length):
+    """
+    Returns the inclusive (start, end) of a single "bytes=" Range header,
+    None if there is no usable header (serve the whole clip), or raises
+    ValueError if the range cannot be satisfied (416).
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else length - 1
+        else:
+            start = max(0, length - int(last))  # Suffix range: the last N bytes
+            end = length - 1
+    except ValueError:
+        return None
+    end = min(end, length - 1)
+    if start > end or start >= length:
+        raise ValueError(f"Range {header} not satisfiable for {length} bytes")
+    return start, end
@@ -0,0 +1,235 @@
+"""
+Offline batch inference for Yuna-chan over JSONL
+=================================================
+Runs thousands of scripted prompts through the same model, LoRA adapters
+and prompt formatting as /api/chat, without the web server.
+
+Prompts are streamed from the input file a window at a time, sorted by
+token length and handed to the generation scheduler in that order, so
+every prefill pads prompts of similar length together and freed batch
+slots are refilled with the next prompts. Results are appended to the
+output file as each one finishes; rerunning the same command skips the
+IDs that already have a result, so an interrupted run resumes where it
+stopped.
+
+Input lines are /api/chat payloads, or a bare prompt for the default
+character:
+    {"id": "q1", "prompt": "How was school today?"}
+    {"id": "q2", "character_id": "<id>", "messages": [{"role": "user", "content": "..."}]}
+The default character uses the Alpaca format, custom characters the chat
+template with their system prompt from characters.json (or the record's
+"system_prompt"). "max_new_tokens", "temperature" and "top_p" may be set
+per line.
+
+Output lines:
+    {"id": "q1", "character_id": "default", "output": "...", "prompt_tokens": 21, "completion_tokens": 64, ...}
+    {"id": "q3", "error": "..."}  (retried on the next run)
+
+Usage:
+    python batch.py prompts.jsonl results.jsonl [--batch-size 32] [--greedy]
+"""
+
+import argparse
+import json
+import os
+import time
+
+import torch
+
+import app as yuna
+from stop_matcher import TextStopMatcher
+
+# ============================================
+# Configuration
+# ============================================
+BATCH_SIZE = 32  # Sequences decoded together; replaces the scheduler's interactive batch size
+BATCH_WINDOW = 1024  # Prompts read ahead and sorted by length at a time
+BATCH_POLL_INTERVAL = 0.05  # Seconds between checks for finished requests
+BATCH_PROGRESS_EVERY = 100  # Results between progress lines
+
+
+def read_prompts(path):
+    """Yields (id, record) for every non-empty line; the line number is the ID when there is none."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Skipping line {line_no} of {path}: {e}")
+                continue
+            yield record.get("id", line_no), record
+
+
+def completed_ids(path):
+    """
+    Returns the IDs that already have a result in `path`. A line cut short
+    by a crash is removed so new results start on a fresh line.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            data = data[:data.rfind(b"\n") + 1]
+
+    done = set()
+    for line in data.decode("utf-8").splitlines():
+        try:
+            result = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if "error" not in result:
+            done.add(result.get("id"))
+    return done
+
+
+def to_payload(record):
+    """Turns an input line into the /api/chat payload build_chat_request() expects."""
+    payload = dict(record, speculative=False)
+    if "messages" not in payload:
+        payload["messages"] = [{"role": "user", "content": record.get("prompt", "")}]
+    character_id = payload.get("character_id", "default")
+    if character_id != "default" and "system_prompt" not in payload:
+        character = yuna.characters.get(character_id)
+        if character is None:
+            raise ValueError(f"Unknown character {character_id}")
+        payload["system_prompt"] = character.get("system_prompt", "")
+    return payload
+
+
+def build_request(record, max_new_tokens=None, greedy=False):
+    generation_request, _ = yuna.build_chat_request(to_payload(record))
+    if max_new_tokens:
+        generation_request.max_new_tokens = max_new_tokens
+    for field in ("max_new_tokens", "temperature", "top_p"):
+        if record.get(field) is not None:
+            setattr(generation_request, field, record[field])
+    if greedy:
+        generation_request.do_sample = False
+    return generation_request
+
+
+def result_line(record_id, record, generation_request):
+    if generation_request.error is not None:
+        return {"id": record_id, "error": str(generation_request.error)}
+
+    text = yuna.tokenizer.decode(generation_request.generated_ids, skip_special_tokens=True)
+    # Same turn-marker trimming as the /api/chat stream
+    matcher = TextStopMatcher(yuna.STREAM_STOP_SEQUENCES)
+    output, stopped = matcher.feed(text)
+    if not stopped:
+        output += matcher.flush()
+    return {
+        "id": record_id,
+        "character_id": record.get("character_id", "default"),
+        "output": output.strip(),
+        "prompt_tokens": len(generation_request.input_ids),
+        "completion_tokens": len(generation_request.generated_ids),
+        "timings": {k: round(v, 4) for k, v in generation_request.timings.items()},
+    }
+
+
+def windows(records, size):
+    window = []
+    for item in records:
+        window.append(item)
+        if len(window) >= size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+def run_batch(input_path, output_path, batch_size=BATCH_SIZE, window=BATCH_WINDOW, max_new_tokens=None,
+              greedy=False):
+    """Runs every prompt in `input_path` without a result in `output_path`; returns the run's stats."""
+    done = completed_ids(output_path)
+    if done:
+        print(f"Resuming: {len(done)} prompts already have results in {output_path}")
+    yuna.scheduler.max_batch_size = batch_size
+
+    stats = {"completed": 0, "errors": 0, "skipped": len(done), "completion_tokens": 0}
+    start = time.time()
+    pending_records = ((i, r) for i, r in read_prompts(input_path) if i not in done)
+
+    with open(output_path, "a", encoding="utf-8") as out:
+        def write(result):
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()  # Each result is on disk before the next one, so a crash loses nothing finished
+            if "error" in result:
+                stats["errors"] += 1
+            else:
+                stats["completed"] += 1
+                stats["completion_tokens"] += result["completion_tokens"]
+            finished = stats["completed"] + stats["errors"]
+            if finished % BATCH_PROGRESS_EVERY == 0:
+                elapsed = time.time() - start
+                print(f"{finished} done, {stats['errors']} errors, "
+                      f"{stats['completion_tokens'] / elapsed:.1f} tokens/s")
+
+        for chunk in windows(pending_records, window):
+            submitted = []
+            for record_id, record in chunk:
+                try:
+                    submitted.append((record_id, record, build_request(record, max_new_tokens, greedy)))
+                except Exception as e:
+                    write({"id": record_id, "error": str(e)})
+
+            # Shortest prompts first: the scheduler admits in arrival order, so each prefill pads similar lengths
+            submitted.sort(key=lambda item: len(item[2].input_ids))
+            for _, _, generation_request in submitted:
+                yuna.scheduler.submit(generation_request)
+
+            try:
+                while submitted:
+                    submitted[0][2].wait(BATCH_POLL_INTERVAL)
+                    still_running = []
+                    for item in submitted:
+                        if item[2].done.is_set():
+                            write(result_line(*item))
+                        else:
+                            still_running.append(item)
+                    submitted = still_running
+            except KeyboardInterrupt:
+                # Unfinished prompts have no result yet, so the next run picks them up
+                for _, _, generation_request in submitted:
+                    generation_request.cancel()
+                raise
+
+    stats["seconds"] = round(time.time() - start, 2)
+    stats["tokens_per_second"] = round(stats["completion_tokens"] / max(stats["seconds"], 1e-9), 1)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline batch inference for Yuna-chan over JSONL")
+    parser.add_argument("input", help="JSONL file with one prompt or /api/chat payload per line")
+    parser.add_argument("output", help="JSONL file results are appended to; existing results are skipped")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--window", type=int, default=BATCH_WINDOW,
+                        help="Prompts read ahead and sorted by length at a time")
+    parser.add_argument("--max-new-tokens", type=int, default=None,
+                        help="Overrides the chat defaults (256 for the default character, 512 otherwise)")
+    parser.add_argument("--greedy", action="store_true", help="Disable sampling for reproducible outputs")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
+    yuna.load_yuna()
+    try:
+        stats = run_batch(args.input, args.output, args.batch_size, args.window, args.max_new_tokens, args.greedy)
+    except KeyboardInterrupt:
+        print("\nInterrupted; run the same command again to resume.")
+        return
+    finally:
+        yuna.scheduler.stop()
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
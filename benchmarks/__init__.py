@@ -0,0 +1,11 @@
+"""
+Offline benchmark suite for Yuuna-Project.
+
+Runs the real app code against a randomly initialized tiny Qwen2 model, a
+fake VOICEVOX HTTP server and a fake VTube Studio WebSocket server, so it
+needs no GPU, no model weights and no network. Results are written as
+JSON so runs can be compared across commits.
+
+Usage:
+    python -m benchmarks.run [--scenarios generation,chat,tts,vts] [--output benchmark_results.json]
+"""
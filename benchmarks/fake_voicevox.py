@@ -0,0 +1,109 @@
+"""
+Stand-in for the VOICEVOX engine: answers /audio_query and /synthesis
+after a configurable delay and returns a silent WAV whose length grows
+with the text, like the real engine.
+"""
+
+import io
+import json
+import random
+import threading
+import time
+import wave
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+SAMPLE_RATE = 24000
+SECONDS_PER_CHAR = 0.08
+
+
+def make_wav(seconds):
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        w.writeframes(bytes(2 * int(SAMPLE_RATE * seconds)))
+    return buf.getvalue()
+
+
+class FakeVoicevox:
+    def __init__(self, host="127.0.0.1", port=0, query_latency=0.02, synthesis_latency=0.1, jitter=0.0):
+        self.query_latency = query_latency
+        self.synthesis_latency = synthesis_latency
+        self.jitter = jitter  # Uniform extra delay, as a fraction of the base latency
+        self.stats = {"audio_query": 0, "synthesis": 0}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _delay(self, base):
+        time.sleep(base * (1 + random.uniform(0, self.jitter)))
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _handler(self):
+        engine = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if urlparse(self.path).path == "/version":
+                    self._reply(200, "application/json", b'"0.0.0-fake"')
+                elif urlparse(self.path).path == "/speakers":
+                    self._reply(200, "application/json", json.dumps([
+                        {"name": "Fake", "styles": [{"name": "Normal", "id": 2}]}
+                    ]).encode())
+                else:
+                    self._reply(404, "text/plain", b"Not found")
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                url = urlparse(self.path)
+                if url.path == "/audio_query":
+                    engine._count("audio_query")
+                    engine._delay(engine.query_latency)
+                    text = parse_qs(url.query).get("text", [""])[0]
+                    query = {
+                        "accent_phrases": [], "speedScale": 1.0, "pitchScale": 0.0, "intonationScale": 1.0,
+                        "volumeScale": 1.0, "outputSamplingRate": SAMPLE_RATE, "kana": text,
+                    }
+                    self._reply(200, "application/json", json.dumps(query).encode())
+                elif url.path == "/synthesis":
+                    engine._count("synthesis")
+                    engine._delay(engine.synthesis_latency)
+                    query = json.loads(body or b"{}")
+                    seconds = max(0.2, len(query.get("kana", "")) * SECONDS_PER_CHAR / query.get("speedScale", 1.0))
+                    self._reply(200, "audio/wav", make_wav(seconds))
+                else:
+                    self._reply(404, "text/plain", b"Not found")
+
+            def _reply(self, status, content_type, body):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
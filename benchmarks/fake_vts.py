@@ -0,0 +1,162 @@
+"""
+Stand-in for the VTube Studio plugin API: a minimal WebSocket server
+(standard library only) that accepts any plugin token and answers each
+request after a configurable delay. Requests on one connection are
+answered concurrently, like VTS does. With deny_tokens, token requests
+are refused as if the user had clicked "Deny" in VTS.
+"""
+
+import base64
+import hashlib
+import json
+import socket
+import struct
+import threading
+import time
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+TOKEN = "fake-vts-token"
+HOTKEYS = [
+    {"name": name, "type": "ToggleExpression", "hotkeyID": f"hk_{name.lower()}"}
+    for name in ("Happy", "Sad", "Shy", "Surprised", "Reset")
+]
+
+
+class FakeVTS:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.005, deny_tokens=False):
+        self.latency = latency
+        self.deny_tokens = deny_tokens
+        self.stats = {"connections": 0, "requests": 0, "token_requests": 0}
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self._running = False
+
+    @property
+    def port(self):
+        return self._sock.getsockname()[1]
+
+    def start(self):
+        self._sock.listen()
+        self._running = True
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._sock.close()
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            self.stats["connections"] += 1
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        send_lock = threading.Lock()
+        try:
+            self._handshake(conn)
+            while True:
+                opcode, payload = self._read_frame(conn)
+                if opcode == 0x8:  # Close
+                    with send_lock:
+                        self._send_frame(conn, 0x8, b"")
+                    return
+                if opcode == 0x9:  # Ping
+                    with send_lock:
+                        self._send_frame(conn, 0xA, payload)
+                elif opcode == 0x1:
+                    threading.Thread(target=self._respond, args=(conn, send_lock, payload), daemon=True).start()
+        except (OSError, ConnectionError):
+            pass
+        finally:
+            conn.close()
+
+    def _respond(self, conn, send_lock, payload):
+        message = json.loads(payload)
+        self.stats["requests"] += 1
+        time.sleep(self.latency)
+        request_type = message.get("messageType", "")
+        response_type = request_type.replace("Request", "Response")
+        data = {}
+        if request_type == "AuthenticationTokenRequest":
+            self.stats["token_requests"] += 1
+            if self.deny_tokens:
+                response_type = "APIError"
+                data = {"errorID": 50, "message": "User has denied API access for your plugin."}
+            else:
+                data = {"authenticationToken": TOKEN}
+        elif request_type == "AuthenticationRequest":
+            data = {"authenticated": message.get("data", {}).get("authenticationToken") == TOKEN}
+        elif request_type == "HotkeysInCurrentModelRequest":
+            data = {"modelLoaded": True, "availableHotkeys": HOTKEYS}
+        elif request_type == "HotkeyTriggerRequest":
+            data = {"hotkeyID": message.get("data", {}).get("hotkeyID")}
+        response = {
+            "apiName": "VTubeStudioPublicAPI",
+            "apiVersion": "1.0",
+            "timestamp": int(time.time() * 1000),
+            "requestID": message.get("requestID"),
+            "messageType": response_type,
+            "data": data,
+        }
+        try:
+            with send_lock:
+                self._send_frame(conn, 0x1, json.dumps(response).encode())
+        except OSError:
+            pass
+
+    def _handshake(self, conn):
+        request = b""
+        while b"\r\n\r\n" not in request:
+            chunk = conn.recv(4096)
+            if not chunk:
+                raise ConnectionError("Client closed during handshake")
+            request += chunk
+        key = ""
+        for line in request.decode("latin-1").split("\r\n"):
+            name, _, value = line.partition(":")
+            if name.strip().lower() == "sec-websocket-key":
+                key = value.strip()
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+        conn.sendall((
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+        ).encode())
+
+    def _recv_exact(self, conn, n):
+        data = b""
+        while len(data) < n:
+            chunk = conn.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("Client closed the connection")
+            data += chunk
+        return data
+
+    def _read_frame(self, conn):
+        first, second = self._recv_exact(conn, 2)
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack(">H", self._recv_exact(conn, 2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", self._recv_exact(conn, 8))[0]
+        mask = self._recv_exact(conn, 4) if second & 0x80 else None
+        payload = self._recv_exact(conn, length)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return first & 0x0F, payload
+
+    def _send_frame(self, conn, opcode, payload):
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126:
+            header += bytes([len(payload)])
+        elif len(payload) < 1 << 16:
+            header += bytes([126]) + struct.pack(">H", len(payload))
+        else:
+            header += bytes([127]) + struct.pack(">Q", len(payload))
+        conn.sendall(header + payload)
@@ -0,0 +1,346 @@
+"""
+Runs the offline benchmark scenarios and writes their results as JSON.
+
+Scenarios:
+- generation: scheduler-level TTFT, inter-token latency and tokens/s at
+  several concurrency levels, measured per token.
+- chat: end-to-end /api/chat streams through the Flask app.
+- tts: /api/tts latency against the fake VOICEVOX, cold and cached.
+- vts: VTSConnector connect time and request round trips against the
+  fake VTube Studio server.
+
+Latencies are reported in milliseconds.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+import torch
+import transformers
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.fake_voicevox import FakeVoicevox
+from benchmarks.fake_vts import FakeVTS
+from benchmarks.tiny_model import make_model, make_tokenizer
+
+PROMPT_TEXT = "Yuna, tell me about the summer festival we went to when we were kids. "
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    index = (len(ordered) - 1) * q
+    low = int(index)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (index - low)
+
+
+def summarize(seconds):
+    """Latency summary in milliseconds."""
+    if not seconds:
+        return {"count": 0}
+    ms = [s * 1000 for s in seconds]
+    return {
+        "count": len(ms),
+        "mean": round(sum(ms) / len(ms), 3),
+        "p50": round(percentile(ms, 0.5), 3),
+        "p95": round(percentile(ms, 0.95), 3),
+        "max": round(max(ms), 3),
+    }
+
+
+def run_concurrently(fn, count):
+    results = [None] * count
+
+    def worker(i):
+        results[i] = fn(i)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class TimingStreamer:
+    """Streamer that records when each batch of generated tokens arrives."""
+
+    def __init__(self):
+        self.arrivals = []  # (perf_counter, token count)
+        self._skip_prompt = True
+
+    def put(self, value):
+        if self._skip_prompt:
+            self._skip_prompt = False
+            return
+        self.arrivals.append((time.perf_counter(), value.numel()))
+
+    def end(self):
+        pass
+
+
+def load_app(model_size):
+    """Imports app.py and installs a tiny model as if load_yuna() had run."""
+    import app
+    import model_runtime as runtime
+    from adapter_registry import AdapterRegistry
+    from generation_scheduler import GenerationScheduler
+
+    model = make_model(model_size)
+    tokenizer = make_tokenizer()
+    app.model = model
+    app.tokenizer = tokenizer
+    app.adapters = AdapterRegistry(model, runtime.ADAPTER_MAX_RESIDENT)
+    app.scheduler = GenerationScheduler(
+        model, tokenizer, runtime.SCHEDULER_MAX_BATCH_SIZE, runtime.SCHEDULER_MAX_WAIT, runtime.prefix_cache,
+        app.adapters
+    )
+    app.scheduler.start()
+    app.load_status.update(state="ready", ready_at=time.time())
+    return app
+
+
+def bench_generation(app, args):
+    from generation_scheduler import GenerationRequest
+
+    prompt = (app.tokenizer.encode(PROMPT_TEXT * 64))[:args.prompt_tokens]
+    results = {}
+    for concurrency in args.concurrency:
+        ttft, itl, per_request_rate, throughput = [], [], [], []
+        for _ in range(args.repeats):
+            generation_requests = [
+                GenerationRequest(prompt, streamer=TimingStreamer(), max_new_tokens=args.new_tokens,
+                                  do_sample=False, eos_token_id=-1)
+                for _ in range(concurrency)
+            ]
+            start = time.perf_counter()
+            for generation_request in generation_requests:
+                app.scheduler.submit(generation_request)
+            for generation_request in generation_requests:
+                generation_request.wait()
+            wall = time.perf_counter() - start
+
+            tokens = 0
+            for generation_request in generation_requests:
+                arrivals = generation_request.streamer.arrivals
+                if not arrivals:
+                    continue
+                count = sum(n for _, n in arrivals)
+                tokens += count
+                ttft.append(arrivals[0][0] - start)
+                itl.extend((b[0] - a[0]) / b[1] for a, b in zip(arrivals, arrivals[1:]))
+                if len(arrivals) > 1:
+                    per_request_rate.append((count - arrivals[0][1]) / (arrivals[-1][0] - arrivals[0][0]))
+            throughput.append(tokens / wall)
+
+        results[f"concurrency_{concurrency}"] = {
+            "ttft_ms": summarize(ttft),
+            "inter_token_ms": summarize(itl),
+            "decode_tokens_per_s": round(sum(per_request_rate) / max(1, len(per_request_rate)), 2),
+            "total_tokens_per_s": round(sum(throughput) / len(throughput), 2),
+        }
+    return results
+
+
+def event_type(frame):
+    """Name of an /api/chat SSE frame ("token", "emotion", "done", ...)."""
+    line = frame.partition("\n")[0]
+    return line[len("event: "):] if line.startswith("event: ") else None
+
+
+def bench_chat(app, args):
+    client = app.app.test_client()
+    payload = {"messages": [{"role": "user", "content": PROMPT_TEXT}], "speculative": False}
+
+    def one(_):
+        start = time.perf_counter()
+        response = client.post('/api/chat', json=payload, buffered=False)
+        first = None
+        chunks = 0  # Token events
+        for chunk in response.response:
+            text = chunk.decode("utf-8") if isinstance(chunk, bytes) else chunk
+            if event_type(text) != "token":
+                continue
+            chunks += 1
+            if first is None:
+                first = time.perf_counter()
+        end = time.perf_counter()
+        response.close()
+        return (first or end) - start, end - start, chunks
+
+    results = {}
+    for concurrency in args.concurrency:
+        runs = []
+        for _ in range(args.repeats):
+            runs.extend(run_concurrently(one, concurrency))
+        results[f"concurrency_{concurrency}"] = {
+            "ttft_ms": summarize([r[0] for r in runs]),
+            "total_ms": summarize([r[1] for r in runs]),
+            "chunks_per_response": round(sum(r[2] for r in runs) / len(runs), 1),
+        }
+    return results
+
+
+def bench_tts(app, args):
+    from voicevox_pool import VoicevoxPool
+
+    engines = [FakeVoicevox(query_latency=args.voicevox_query_latency,
+                            synthesis_latency=args.voicevox_synthesis_latency).start()
+               for _ in range(args.voicevox_engines)]
+    app.voicevox = VoicevoxPool([engine.url for engine in engines], max_concurrency=app.VOICEVOX_MAX_CONCURRENCY,
+                                health_interval=0, long_text_chars=app.VOICEVOX_LONG_TEXT_CHARS)
+    client = app.app.test_client()
+    run_id = int(time.time() * 1000)
+
+    def synthesize(text):
+        start = time.perf_counter()
+        response = client.post('/api/tts', json={"text": text, "speaker": 2})
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            raise RuntimeError(f"/api/tts returned {response.status_code}: {response.get_data(as_text=True)}")
+        return elapsed
+
+    try:
+        texts = [f"Sentence number {i} of run {run_id}, spoken by Yuna." for i in range(args.tts_requests)]
+        cold = [synthesize(text) for text in texts]
+        cached = [synthesize(text) for text in texts]
+        concurrent = run_concurrently(lambda i: synthesize(f"Concurrent sentence {i} of run {run_id}."),
+                                      args.tts_requests)
+        long_texts = [synthesize(" ".join(f"Paragraph {i} of run {run_id}, sentence {j} of a long reply."
+                                          for j in range(8))) for i in range(3)]
+        return {
+            "cold_ms": summarize(cold),
+            "cached_ms": summarize(cached),
+            f"concurrent_{args.tts_requests}_cold_ms": summarize(concurrent),
+            "long_text_cold_ms": summarize(long_texts),
+            "engine_requests": [dict(engine.stats) for engine in engines],
+        }
+    finally:
+        app.voicevox.close()
+        for engine in engines:
+            engine.stop()
+
+
+def bench_vts(app, args):
+    from vts_connector import VTSConnector
+
+    server = FakeVTS(latency=args.vts_latency).start()
+    vts = VTSConnector(port=server.port)
+    try:
+        start = time.perf_counter()
+        success, message = vts.authenticate()
+        connect = time.perf_counter() - start
+        if not success:
+            raise RuntimeError(f"Could not authenticate with the fake VTS: {message}")
+
+        hotkeys = []
+        for _ in range(args.vts_requests):
+            start = time.perf_counter()
+            vts.get_hotkeys()
+            hotkeys.append(time.perf_counter() - start)
+
+        inject = []
+        for i in range(args.vts_requests):
+            start = time.perf_counter()
+            vts.inject_parameters({"MouthOpen": (i % 10) / 10, "MouthSmile": 0.5})
+            inject.append(time.perf_counter() - start)
+
+        def concurrent_inject(i):
+            start = time.perf_counter()
+            vts.inject_parameter("MouthOpen", (i % 10) / 10)
+            return time.perf_counter() - start
+
+        concurrent = run_concurrently(concurrent_inject, args.vts_requests)
+        return {
+            "connect_and_auth_ms": round(connect * 1000, 3),
+            "get_hotkeys_ms": summarize(hotkeys),
+            "inject_parameters_ms": summarize(inject),
+            f"concurrent_{args.vts_requests}_inject_ms": summarize(concurrent),
+            "server_connections": server.stats["connections"],
+        }
+    finally:
+        vts.close()
+        server.stop()
+
+
+SCENARIOS = {
+    "generation": bench_generation,
+    "chat": bench_chat,
+    "tts": bench_tts,
+    "vts": bench_vts,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline Yuuna-Project benchmarks")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help="Comma-separated subset of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--model-size", default="tiny", choices=["tiny", "small"])
+    parser.add_argument("--concurrency", default="1,4", help="Comma-separated concurrency levels")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--prompt-tokens", type=int, default=128)
+    parser.add_argument("--new-tokens", type=int, default=64)
+    parser.add_argument("--tts-requests", type=int, default=8)
+    parser.add_argument("--voicevox-engines", type=int, default=2)
+    parser.add_argument("--voicevox-query-latency", type=float, default=0.02)
+    parser.add_argument("--voicevox-synthesis-latency", type=float, default=0.1)
+    parser.add_argument("--vts-requests", type=int, default=20)
+    parser.add_argument("--vts-latency", type=float, default=0.005)
+    args = parser.parse_args(argv)
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c]
+    unknown = [s for s in args.scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output)
+
+    # app.py creates characters.json, the TTS cache and the VTS token in the working directory
+    workdir = tempfile.mkdtemp(prefix="yuuna-bench-")
+    os.chdir(workdir)
+    app = load_app(args.model_size)
+
+    results = {}
+    try:
+        for name in args.scenarios:
+            print(f"Running {name}...")
+            start = time.perf_counter()
+            results[name] = SCENARIOS[name](app, args)
+            print(f"  done in {time.perf_counter() - start:.1f}s")
+    finally:
+        app.scheduler.stop()
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+            "args": {k: v for k, v in vars(args).items() if k != "output"},
+        },
+        "results": results,
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"✅ Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""
+Randomly initialized Qwen2 models and a character-level tokenizer, so the
+generation stack can be benchmarked without downloading any weights.
+The output is gibberish; only the timings matter.
+"""
+
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+from transformers import PreTrainedTokenizerFast, Qwen2Config, Qwen2ForCausalLM
+
+# "tiny" measures scheduling overhead; "small" has enough compute to show kernel/batching effects
+MODEL_CONFIGS = {
+    "tiny": dict(hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                 num_attention_heads=4, num_key_value_heads=2),
+    "small": dict(hidden_size=512, intermediate_size=1536, num_hidden_layers=8,
+                  num_attention_heads=8, num_key_value_heads=2),
+}
+
+CHAT_TEMPLATE = (
+    "{% for message in messages %}<|im_start|>{{ message['role'] }}\n{{ message['content'] }}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+
+def make_tokenizer():
+    """Byte-ish tokenizer: one token per character of the first 256 code points."""
+    vocab = {"<pad>": 0, "<|im_end|>": 1, "<unk>": 2, "<|im_start|>": 3}
+    for i in range(256):
+        vocab.setdefault(chr(i) if chr(i).isprintable() or chr(i) in "\n\t" else f"<0x{i:02X}>", len(vocab))
+    backend = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    backend.decoder = decoders.Fuse()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend, pad_token="<pad>", eos_token="<|im_end|>", unk_token="<unk>",
+        additional_special_tokens=["<|im_start|>"],
+    )
+    tokenizer.chat_template = CHAT_TEMPLATE
+    return tokenizer
+
+
+def make_model(size="tiny", seed=0, vocab_size=512, dtype=torch.float32):
+    torch.manual_seed(seed)
+    config = Qwen2Config(vocab_size=vocab_size, max_position_embeddings=4096, **MODEL_CONFIGS[size])
+    return Qwen2ForCausalLM(config).to(dtype).eval()
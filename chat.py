@@ -12,6 +12,8 @@ import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from peft import PeftModel
 import os
+from cpu_backend import prepare_cpu_model, describe
+from context_window import ContextWindow
 
 # ============================================
 # Configuration
@@ -23,6 +25,13 @@ LORA_PATH = r"C:\Users\Nonx2\Downloads\My_Wife\Lora"
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 TORCH_DTYPE = torch.float16 if torch.cuda.is_available() else torch.float32
 
+# CPU backend settings (used when CUDA is not available)
+CPU_QUANTIZE_INT8 = True
+CPU_NUM_THREADS = None  # None lets the startup self-benchmark choose
+CPU_INTEROP_THREADS = 1
+CPU_TRY_COMPILE = False
+CPU_BENCHMARK_TOKENS = 16
+
 # Generation settings
 MAX_NEW_TOKENS = 512
 TEMPERATURE = 0.7
@@ -30,6 +39,10 @@ TOP_P = 0.9
 TOP_K = 50
 REPETITION_PENALTY = 1.1
 
+# Context settings: the system prompt is always kept, older turns are dropped beyond the budget
+CONTEXT_MAX_TOKENS = 3072
+CONTEXT_TRIM_TO = 0.75
+
 # ============================================
 # Yuna's System Prompt
 # ============================================
@@ -86,6 +99,15 @@ def load_model():
     
     model.eval()
     
+    # Merge the LoRA and quantize to int8 on CPU
+    if not torch.cuda.is_available():
+        print("Preparing CPU backend (self-benchmark)...")
+        model, report = prepare_cpu_model(
+            model, tokenizer, CPU_QUANTIZE_INT8, CPU_NUM_THREADS, CPU_INTEROP_THREADS,
+            CPU_TRY_COMPILE, CPU_BENCHMARK_TOKENS
+        )
+        print(describe(report))
+    
     print()
     print("✅ Yuna-chan is ready!")
     print("=" * 50)
@@ -93,8 +115,11 @@ def load_model():
     return model, tokenizer
 
 
-def generate_response(model, tokenizer, messages):
+def generate_response(model, tokenizer, messages, context_window=None):
     """Generate a response from the model."""
+    if context_window is not None:
+        messages = context_window.fit(messages, "cli")
+    
     # Format messages using the chat template
     text = tokenizer.apply_chat_template(
         messages,
@@ -136,6 +161,9 @@ def chat_loop(model, tokenizer):
     
     # Initialize conversation with system prompt
     messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    context_window = ContextWindow(
+        lambda text: len(tokenizer.encode(text, add_special_tokens=False)), CONTEXT_MAX_TOKENS, CONTEXT_TRIM_TO
+    )
     
     while True:
         try:
@@ -160,7 +188,7 @@ def chat_loop(model, tokenizer):
             
             # Generate response
             print("\nYuna: ", end="", flush=True)
-            response = generate_response(model, tokenizer, messages)
+            response = generate_response(model, tokenizer, messages, context_window)
             print(response)
             print()
             
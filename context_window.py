@@ -0,0 +1,187 @@
+"""
+Token-budgeted context window for long conversations.
+
+Keeps the prompt of every turn under a token budget: the system prompt
+stays pinned, and once the conversation outgrows the budget the oldest
+turns are dropped down to a lower mark, so the kept prefix (and the
+session's KV cache for it) stays stable for a while instead of sliding
+every turn. Per-message token counts are cached, so a turn only tokenizes
+what is new.
+
+Optionally the dropped turns are folded into a rolling summary that is
+written on a background thread and sent as a second system message; a
+turn never waits for it. After a failed summary the conversation waits
+(doubling up to a limit) before trying again, so a broken summarizer
+doesn't cost an extra generation on every turn.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+def _digest(message):
+    return hashlib.sha1(f"{message.get('role')}\0{message.get('content')}".encode("utf-8")).hexdigest()
+
+
+class TokenCounter:
+    """Token counts per message, cached by role and content (LRU)."""
+
+    def __init__(self, count_tokens, message_overhead=4, max_entries=8192):
+        self.count_tokens = count_tokens  # text -> number of tokens
+        self.message_overhead = message_overhead  # Role and turn markers the chat template adds
+        self.max_entries = max_entries
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def count(self, message):
+        key = (message.get("role"), message.get("content") or "")
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts.move_to_end(key)
+                self.stats["hits"] += 1
+                return count
+            self.stats["misses"] += 1
+
+        count = self.count_tokens(key[1]) + self.message_overhead
+        with self._lock:
+            self._counts[key] = count
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return count
+
+
+class _Conversation:
+    def __init__(self):
+        self.start = 0  # History messages before this index are no longer sent
+        self.boundary = None  # Digest of the last dropped message, to notice edited or cleared histories
+        self.summary = None
+        self.covered = 0  # History messages folded into the summary
+        self.summarizing = False
+        self.failures = 0  # Summaries that failed in a row
+        self.retry_after = 0.0  # time.monotonic() before which no new summary is attempted
+        self.generation = 0  # Bumped on reset so summaries of the old history are discarded
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.generation += 1
+        self.start = 0
+        self.boundary = None
+        self.summary = None
+        self.covered = 0
+
+
+class ContextWindow:
+    def __init__(self, count_tokens, max_tokens=3072, trim_to=0.75, summarize=None, max_conversations=256,
+                 retry_backoff=30.0, max_retry_backoff=600.0):
+        self.counter = TokenCounter(count_tokens)
+        self.max_tokens = max_tokens
+        self.trim_to = trim_to  # Fraction of max_tokens kept after a trim
+        # summarize(previous_summary, messages) -> str, called on a background thread; None only trims
+        self.summarize = summarize
+        self.max_conversations = max_conversations
+        self.retry_backoff = retry_backoff  # Seconds before retrying a failed summary, doubled per failure
+        self.max_retry_backoff = max_retry_backoff
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary") if summarize else None
+        self.stats = {"trims": 0, "messages_dropped": 0, "summaries": 0, "summary_errors": 0}
+
+    def fit(self, messages, key=None):
+        """
+        Returns the messages to render for this turn: the pinned system
+        message, the rolling summary if there is one, and as many recent
+        turns as fit in the budget. `key` identifies the conversation
+        across turns (e.g. the session ID); without it nothing is remembered.
+        """
+        if messages and messages[0].get("role") == "system":
+            system, history = [messages[0]], messages[1:]
+        else:
+            system, history = [], messages
+
+        conversation = self._conversation(key)
+        with conversation.lock:
+            if conversation.start > len(history) - 1 or (
+                conversation.start and _digest(history[conversation.start - 1]) != conversation.boundary
+            ):
+                conversation.reset()  # Cleared or edited history: start over
+
+            summary = []
+            if conversation.summary:
+                summary = [{"role": "system", "content": SUMMARY_PREFIX + conversation.summary}]
+
+            fixed = sum(self.counter.count(m) for m in system + summary)
+            kept = history[conversation.start:]
+            total = fixed + sum(self.counter.count(m) for m in kept)
+
+            if total > self.max_tokens:
+                # Trim well below the budget so the kept prefix survives the next few turns
+                target = self.max_tokens * self.trim_to
+                dropped = 0
+                while len(kept) > 1 and (total > target or kept[0].get("role") != "user"):
+                    total -= self.counter.count(kept[0])
+                    kept = kept[1:]
+                    dropped += 1
+                conversation.start += dropped
+                conversation.boundary = _digest(history[conversation.start - 1])
+                self.stats["trims"] += 1
+                self.stats["messages_dropped"] += dropped
+
+            if (self._executor and key is not None and conversation.covered < conversation.start
+                    and not conversation.summarizing and time.monotonic() >= conversation.retry_after):
+                conversation.summarizing = True
+                self._executor.submit(
+                    self._refresh, conversation, conversation.generation, conversation.summary,
+                    history[conversation.covered:conversation.start], conversation.start
+                )
+
+            return system + summary + kept
+
+    def forget(self, key):
+        with self._lock:
+            self._conversations.pop(key, None)
+
+    def get_stats(self):
+        with self._lock:
+            conversations = len(self._conversations)
+        return dict(self.stats, conversations=conversations, max_tokens=self.max_tokens,
+                    token_count_hits=self.counter.stats["hits"], token_count_misses=self.counter.stats["misses"])
+
+    def _conversation(self, key):
+        if key is None:
+            return _Conversation()
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                conversation = self._conversations[key] = _Conversation()
+                while len(self._conversations) > self.max_conversations:
+                    self._conversations.popitem(last=False)
+            self._conversations.move_to_end(key)
+            return conversation
+
+    def _refresh(self, conversation, generation, previous, messages, covered):
+        try:
+            summary = self.summarize(previous, messages).strip()
+        except Exception as e:
+            print(f"Conversation summary failed: {e}")
+            self.stats["summary_errors"] += 1
+            summary = None
+
+        with conversation.lock:
+            conversation.summarizing = False
+            if not summary:
+                conversation.failures += 1
+                backoff = self.retry_backoff * 2 ** (conversation.failures - 1)
+                conversation.retry_after = time.monotonic() + min(self.max_retry_backoff, backoff)
+                return
+            conversation.failures = 0
+            if conversation.generation == generation:
+                conversation.summary = summary
+                conversation.covered = covered
+                self.stats["summaries"] += 1
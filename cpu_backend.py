@@ -0,0 +1,171 @@
+"""
+CPU inference backend for machines without CUDA.
+
+The CPU path swaps the base model's nn.Linear layers for dynamically
+quantized int8 versions, pins the intra-op and inter-op thread counts and
+can compile the forward pass. A short self-benchmark at startup tries the
+candidate setups and keeps the fastest one.
+
+The LoRA stays attached by default (its small matrices stay float32), so
+custom characters can still run on the base model with it disabled.
+With merge=True it is folded into the base weights instead, which saves
+the extra matmuls but removes the PEFT wrapper: every request, custom
+characters included, then uses the Yuna-tuned weights.
+
+PEFT can't attach new adapters to int8 layers, so when an
+AdapterRegistry is passed, every adapter registered so far is loaded
+before quantizing and the registry is frozen afterwards; characters
+added later run on the base model until the next start.
+"""
+
+import os
+import time
+import warnings
+
+import torch
+
+BENCHMARK_PROMPT = "Hello Yuna, how was your day?"
+
+
+def merge_lora(model):
+    """Folds the active LoRA into the base weights and returns the plain model."""
+    if hasattr(model, "merge_and_unload"):
+        model = model.merge_and_unload()
+    return model
+
+
+def quantize_int8(model):
+    """
+    Replaces every nn.Linear with an int8 dynamically quantized one, in
+    place. Layers inside LoRA adapters stay float, since PEFT reads their
+    weights directly.
+    """
+    targets = {name for name, module in model.named_modules()
+               if type(module) is torch.nn.Linear and not any(part.startswith("lora_") for part in name.split("."))}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # torch.ao deprecation notice
+        return torch.ao.quantization.quantize_dynamic(model, targets, dtype=torch.qint8, inplace=True)
+
+
+def set_threads(num_threads=None, interop_threads=None):
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:  # Only allowed before any inter-op parallel work has started
+            print(f"Warning: Could not set inter-op threads: {e}")
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+
+def compile_forward(model):
+    model.forward = torch.compile(model.forward, dynamic=True)
+
+
+def uncompile_forward(model):
+    if "forward" in model.__dict__:
+        del model.forward
+
+
+def model_bytes(model):
+    """Memory held by the model's weights and buffers, counting int8 packed weights too."""
+    seen = set()
+    total = 0
+    pending = list(model.state_dict().values())
+    while pending:
+        value = pending.pop()
+        if isinstance(value, (tuple, list)):
+            pending.extend(value)
+        elif isinstance(value, torch.Tensor) and value.data_ptr() not in seen:
+            seen.add(value.data_ptr())
+            total += value.numel() * value.element_size()
+    return total
+
+
+def benchmark_decode(model, tokenizer, new_tokens=16, prompt=BENCHMARK_PROMPT):
+    """Greedy-decodes `new_tokens` tokens after one warm-up run; returns tokens/s."""
+    inputs = tokenizer(prompt, return_tensors="pt")
+    kwargs = dict(
+        max_new_tokens=new_tokens,
+        min_new_tokens=new_tokens,
+        do_sample=False,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    with torch.no_grad():
+        model.generate(**inputs, **dict(kwargs, max_new_tokens=2, min_new_tokens=2))
+        start = time.perf_counter()
+        model.generate(**inputs, **kwargs)
+    return new_tokens / (time.perf_counter() - start)
+
+
+def thread_candidates(num_threads=None):
+    if num_threads:
+        return [num_threads]
+    logical = os.cpu_count() or 1
+    return sorted({max(1, logical // 2), logical})  # Physical cores (assuming SMT) and all logical cores
+
+
+def prepare_cpu_model(model, tokenizer, quantize=True, num_threads=None, interop_threads=None,
+                      try_compile=False, benchmark_tokens=16, merge=False, adapters=None):
+    """
+    Turns a freshly loaded float32 model into the fastest CPU setup found.
+    Returns (model, report). With benchmark_tokens=0 the self-benchmark is
+    skipped and the first candidate is used. `merge` folds the LoRA into
+    the base weights, `adapters` is the AdapterRegistry to preload and
+    freeze when quantizing (see the module docstring).
+    """
+    set_threads(interop_threads=interop_threads)
+    candidates = [(threads, compiled) for compiled in ([False, True] if try_compile else [False])
+                  for threads in thread_candidates(num_threads)]
+
+    report = {"quantized": quantize, "merged": merge, "bytes_before": model_bytes(model)}
+    if benchmark_tokens:
+        torch.set_num_threads(candidates[0][0])
+        report["baseline_tokens_per_s"] = benchmark_decode(model, tokenizer, benchmark_tokens)
+
+    if merge:
+        model = merge_lora(model)
+    elif quantize and adapters is not None:
+        adapters.load_all()
+    if quantize:
+        model = quantize_int8(model)
+        if adapters is not None:
+            adapters.freeze("the int8 CPU model can't take new LoRA adapters; restart to load them")
+    model.eval()
+    report["bytes_after"] = model_bytes(model)
+
+    best = candidates[0]
+    if benchmark_tokens and len(candidates) > 1:
+        results = []
+        for threads, compiled in candidates:
+            torch.set_num_threads(threads)
+            if compiled:
+                compile_forward(model)
+            try:
+                speed = benchmark_decode(model, tokenizer, benchmark_tokens)
+            except Exception as e:
+                print(f"Warning: CPU setup threads={threads} compiled={compiled} failed: {e}")
+                speed = 0.0
+            finally:
+                uncompile_forward(model)
+            print(f"  threads={threads} compiled={compiled}: {speed:.1f} tokens/s")
+            results.append({"threads": threads, "compiled": compiled, "tokens_per_s": speed})
+        best_result = max(results, key=lambda r: r["tokens_per_s"])
+        best = (best_result["threads"], best_result["compiled"])
+        report.update(candidates=results, tokens_per_s=best_result["tokens_per_s"])
+
+    torch.set_num_threads(best[0])
+    if best[1]:
+        compile_forward(model)
+    report.update(threads=best[0], interop_threads=torch.get_num_interop_threads(), compiled=best[1])
+    if benchmark_tokens and "tokens_per_s" not in report:
+        report["tokens_per_s"] = benchmark_decode(model, tokenizer, benchmark_tokens)
+    return model, report
+
+
+def describe(report):
+    text = (f"CPU backend: int8={report['quantized']} merged={report['merged']} threads={report['threads']} "
+            f"interop={report['interop_threads']} compiled={report['compiled']}, "
+            f"weights {report['bytes_before'] / 2**20:.0f} MB -> {report['bytes_after'] / 2**20:.0f} MB")
+    if "tokens_per_s" in report:
+        text += f", {report['baseline_tokens_per_s']:.1f} -> {report['tokens_per_s']:.1f} tokens/s"
+    return text
@@ -0,0 +1,742 @@
+"""
+Continuous-batching generation scheduler.
+
+One background thread owns the model. Requests are admitted into the
+running decode batch at token boundaries (new prompts are prefilled
+together, left-padded), every active sequence advances one token per
+forward pass, and finished sequences are evicted straight away. Each
+request streams through its own TextIteratorStreamer, so /api/chat
+callers see the same interface as with model.generate().
+
+Requests are batched per LoRA adapter (None for the base model with
+adapters disabled); the batches are stepped in turn by the same thread,
+which activates each batch's adapter through an AdapterRegistry, so the
+adapter is never switched underneath another request. A PrefixCache can be attached so cached
+system prompt KV is reused instead of prefilled again, and a draft model
+for speculative decoding of requests that would otherwise run alone; as
+soon as another request arrives, the speculative one is handed back to
+the batch with the KV it has built so far.
+"""
+
+import time
+import uuid
+import queue
+import threading
+
+import torch
+from transformers import (
+    DynamicCache,
+    LogitsProcessorList,
+    StoppingCriteriaList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from stop_matcher import TokenStopMatcher, StopOnTokens, StopOnCancel, StopOnArrival
+from adapter_registry import DEFAULT_ADAPTER
+from metrics import (
+    GENERATION_QUEUE_WAIT, GENERATION_PREFILL, GENERATION_TTFT, GENERATION_DECODE_TOKEN, GENERATION_TOKENS
+)
+
+
+class GenerationRequest:
+    def __init__(self, input_ids, streamer=None, max_new_tokens=256, do_sample=True, temperature=0.7,
+                 top_p=0.9, top_k=None, repetition_penalty=1.0, eos_token_id=None,
+                 stop_token_sequences=None, adapter=DEFAULT_ADAPTER, prefix_key=None, prefix_len=0, session=None,
+                 speculative=False):
+        # input_ids: 1-D list or tensor of prompt token IDs
+        if torch.is_tensor(input_ids):
+            input_ids = input_ids.view(-1).tolist()
+        self.input_ids = input_ids
+        self.streamer = streamer
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.repetition_penalty = repetition_penalty
+        self.eos_token_id = eos_token_id
+        self.stop_token_sequences = stop_token_sequences or []
+        self.adapter = adapter  # Adapter name from the AdapterRegistry, or None for the base model
+        # The first prefix_len prompt tokens may be served from the scheduler's prefix cache
+        self.prefix_key = prefix_key
+        self.prefix_len = prefix_len
+        # A sessions.Session whose KV is reused for the prompt and updated when the request finishes
+        self.session = session
+        # Use the scheduler's draft model (if any) when this request would otherwise decode alone
+        self.speculative = speculative
+
+        self.id = uuid.uuid4().hex
+        self.generated_ids = []
+        self.error = None
+        self.cancelled = threading.Event()
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.first_token_at = None
+        self.finished_at = None
+        # Per-request breakdown in seconds: queue_wait, prefill, ttft, decode (filled in by the scheduler)
+        self.timings = {}
+        self.done = threading.Event()
+
+        self._processors = None
+        self._stop_matcher = None
+        self._stop_state = 0
+        self._ids = None  # Prompt + generated IDs on the model device (for repetition penalty)
+        self._resume_kv = None  # KV from assisted generation that was handed back to the batch
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def cancel(self):
+        """Asks the scheduler to drop this request at the next token boundary."""
+        if not self.done.is_set():
+            self.cancelled.set()
+
+
+class _SkipPrompt:
+    """
+    Streamer proxy for model.generate(): submit() already sent the prompt to
+    the real streamer, so generate()'s own prompt put() is dropped here.
+    end() is left to the scheduler's _finish().
+    """
+
+    def __init__(self, streamer):
+        self.streamer = streamer
+        self.prompt_seen = False
+
+    def put(self, value):
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        self.streamer.put(value)
+
+    def end(self):
+        pass
+
+
+def _cache_layers(cache):
+    """Returns [(keys, values), ...] for a DynamicCache or legacy tuple cache."""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, "key_cache"):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return [(k, v) for k, v in cache]
+
+
+def _left_pad(tensor, length, dim):
+    if length <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = length
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+class _Batch:
+    """Decode state for a set of sequences sharing one left-padded KV cache."""
+
+    def __init__(self):
+        self.requests = []
+        self.kv = None  # [(keys, values)] per layer, each [batch, heads, seq, dim]
+        self.attention_mask = None  # [batch, seq]
+        self.next_positions = None  # [batch]
+        self.next_tokens = None  # [batch]
+
+    def __len__(self):
+        return len(self.requests)
+
+    def merge(self, other):
+        if not self.requests:
+            self.__dict__.update(other.__dict__)
+            return
+
+        pad_self = other.attention_mask.shape[1] - self.attention_mask.shape[1]
+        pad_other = -pad_self
+        self.kv = [
+            (
+                torch.cat([_left_pad(k, pad_self, 2), _left_pad(ok, pad_other, 2)], dim=0),
+                torch.cat([_left_pad(v, pad_self, 2), _left_pad(ov, pad_other, 2)], dim=0),
+            )
+            for (k, v), (ok, ov) in zip(self.kv, other.kv)
+        ]
+        self.attention_mask = torch.cat(
+            [_left_pad(self.attention_mask, pad_self, 1), _left_pad(other.attention_mask, pad_other, 1)], dim=0
+        )
+        self.next_positions = torch.cat([self.next_positions, other.next_positions])
+        self.next_tokens = torch.cat([self.next_tokens, other.next_tokens])
+        self.requests.extend(other.requests)
+
+    def keep(self, rows):
+        """Keeps only the given row indices and trims padding no row needs any more."""
+        self.requests = [self.requests[i] for i in rows]
+        if not self.requests:
+            self.kv = self.attention_mask = self.next_positions = self.next_tokens = None
+            return
+
+        index = torch.tensor(rows, device=self.attention_mask.device)
+        mask = self.attention_mask.index_select(0, index)
+        used = mask.any(dim=0).nonzero()
+        start = int(used[0]) if len(used) else 0
+
+        self.attention_mask = mask[:, start:]
+        self.kv = [
+            (k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:])
+            for k, v in self.kv
+        ]
+        self.next_positions = self.next_positions.index_select(0, index)
+        self.next_tokens = self.next_tokens.index_select(0, index)
+
+
+class GenerationScheduler:
+    def __init__(self, model, tokenizer, max_batch_size=8, max_wait=0.01, prefix_cache=None, adapters=None,
+                 draft_model=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.draft_model = draft_model  # Small model sharing the tokenizer, for speculative decoding
+        self.prefix_cache = prefix_cache
+        self.adapters = adapters
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait  # How long an idle scheduler waits for more arrivals before prefilling
+
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self.default_top_k = getattr(getattr(model, "generation_config", None), "top_k", None)
+        self.supports_adapters = hasattr(model, "disable_adapter")
+
+        self._queue = queue.Queue()
+        self._batches = {}
+        self._stop_matchers = {}
+        self._requests = {}  # Queued and running requests by ID, for cancel()
+        self._requests_lock = threading.Lock()
+        self._thread = None
+        self._running = False
+
+        self.stats = {"requests": 0, "tokens": 0, "steps": 0, "max_batch": 0, "session_tokens_reused": 0,
+                      "cancelled": 0, "cancelled_queued": 0, "speculative_handoffs": 0}
+        self.speculative_stats = {"requests": 0, "tokens": 0, "target_passes": 0, "draft_tokens": 0,
+                                  "accepted_tokens": 0}
+
+    # ============================================
+    # Public API
+    # ============================================
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="generation-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def submit(self, request):
+        """Queues a request; tokens arrive on request.streamer as they are decoded."""
+        if request.streamer is not None:
+            # Mirrors generate(): the prompt is sent first so skip_prompt streamers drop it
+            request.streamer.put(torch.tensor(request.input_ids))
+        request.submitted_at = time.time()
+        with self._requests_lock:
+            self._requests[request.id] = request
+        self._queue.put(request)
+        return request
+
+    def cancel(self, request_id):
+        """Cancels a queued or running request by ID; returns False if it is unknown or already done."""
+        with self._requests_lock:
+            request = self._requests.get(request_id)
+        if request is None or request.done.is_set():
+            return False
+        request.cancel()
+        return True
+
+    def active_count(self):
+        return sum(len(b) for b in self._batches.values())
+
+    def queued_count(self):
+        return self._queue.qsize()
+
+    def get_stats(self):
+        stats = dict(self.stats, active=self.active_count(), queued=self._queue.qsize())
+        if self.draft_model is not None:
+            spec = self.speculative_stats
+            stats["speculative"] = dict(
+                spec,
+                acceptance_rate=spec["accepted_tokens"] / spec["draft_tokens"] if spec["draft_tokens"] else 0.0,
+                tokens_per_target_pass=spec["tokens"] / spec["target_passes"] if spec["target_passes"] else 0.0
+            )
+        return stats
+
+    # ============================================
+    # Scheduler loop
+    # ============================================
+    def _loop(self):
+        while self._running:
+            arrivals = self._collect()
+            if arrivals is None:
+                break
+
+            groups = {}
+            for request in arrivals:
+                key = request.adapter if self.supports_adapters else None
+                groups.setdefault(key, []).append(request)
+
+            for key, requests in groups.items():
+                if self._use_draft(arrivals):
+                    self._run_group(key, self._generate_assisted, requests)
+                else:
+                    self._run_group(key, self._prefill, requests)
+
+            for key in list(self._batches):
+                if self._batches[key]:
+                    self._run_group(key, self._step)
+
+    def _collect(self):
+        """Returns newly admitted requests; blocks only when nothing is running."""
+        arrivals = self._collect_queued()
+        if arrivals is None:
+            return None
+
+        # Requests cancelled while they were still queued never reach the model
+        admitted = []
+        for request in arrivals:
+            if request.cancelled.is_set():
+                self.stats["cancelled_queued"] += 1
+                self._finish(request)
+            else:
+                admitted.append(request)
+        return admitted
+
+    def _collect_queued(self):
+        capacity = self.max_batch_size - self.active_count()
+        arrivals = []
+
+        if self.active_count() == 0:
+            first = self._queue.get()
+            if first is None:
+                return None
+            arrivals.append(first)
+            deadline = time.perf_counter() + self.max_wait
+            while len(arrivals) < capacity:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._running = False
+                    break
+                arrivals.append(request)
+
+        while len(arrivals) < capacity:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                self._running = False
+                break
+            arrivals.append(request)
+        return arrivals
+
+    def _run_group(self, key, fn, requests=None):
+        try:
+            with torch.no_grad():
+                if not self.supports_adapters:
+                    fn(key, *([requests] if requests else []))
+                elif key is None:
+                    with self.model.disable_adapter():
+                        fn(key, *([requests] if requests else []))
+                else:
+                    if self.adapters is not None:
+                        self.adapters.activate(key, in_use=[k for k in self._batches if k is not None])
+                    fn(key, *([requests] if requests else []))
+        except Exception as e:
+            print(f"Generation error: {e}")
+            if requests:
+                failed = requests  # The running batch is unaffected by a failed prefill
+            else:
+                batch = self._batches.pop(key, None)
+                failed = batch.requests if batch is not None else []
+            for request in failed:
+                if not request.done.is_set():
+                    request.error = e
+                    self._finish(request)
+
+    def _prefill(self, key, requests):
+        """
+        Prefills new requests in one left-padded forward pass. Requests with
+        a cached prompt prefix only prefill the tokens after it; their rows
+        are laid out as [pad][prefix KV][pad][suffix] so one mask covers both.
+        """
+        device = self.model.device
+        prefill_start = time.time()
+        for request in requests:
+            if request.started_at is None:
+                self._start(request)
+        # Requests handed back by assisted generation continue after the tokens they already have
+        sequences = [request.input_ids + request.generated_ids for request in requests]
+        pasts = [self._prefix_kv(request) for request in requests]
+        past_lens = [kv[0][0].shape[2] if kv else 0 for kv in pasts]
+        suffixes = [sequence[past_len:] for sequence, past_len in zip(sequences, past_lens)]
+        max_past = max(past_lens)
+        max_len = max(len(suffix) for suffix in suffixes)
+
+        input_ids = torch.full((len(requests), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(requests), max_past + max_len), dtype=torch.long)
+        position_ids = torch.zeros((len(requests), max_len), dtype=torch.long)
+        for row, (request, sequence, past_len, suffix) in enumerate(zip(requests, sequences, past_lens, suffixes)):
+            input_ids[row, max_len - len(suffix):] = torch.tensor(suffix)
+            attention_mask[row, max_past - past_len:max_past] = 1
+            attention_mask[row, max_past + max_len - len(suffix):] = 1
+            position_ids[row, max_len - len(suffix):] = torch.arange(past_len, past_len + len(suffix))
+            request._ids = torch.tensor([sequence], device=device)
+            request._processors = self._build_processors(request)
+            request._stop_matcher = self._stop_matcher(request.stop_token_sequences)
+            request._stop_state = 0
+            if request._stop_matcher is not None:
+                for token in request.generated_ids:
+                    request._stop_state, _ = request._stop_matcher.advance(request._stop_state, token)
+
+        past_key_values = DynamicCache()
+        if max_past:
+            layers = []
+            for layer in range(len(next(kv for kv in pasts if kv))):
+                template_k, template_v = next(kv for kv in pasts if kv)[layer]
+                ks, vs = [], []
+                for kv, past_len in zip(pasts, past_lens):
+                    k, v = kv[layer] if kv else (template_k[:, :, :0], template_v[:, :, :0])
+                    ks.append(_left_pad(k, max_past - past_len, 2))
+                    vs.append(_left_pad(v, max_past - past_len, 2))
+                layers.append((torch.cat(ks, dim=0), torch.cat(vs, dim=0)))
+            past_key_values = DynamicCache(layers)
+
+        attention_mask = attention_mask.to(device)
+        out = self.model(
+            input_ids=input_ids.to(device),
+            attention_mask=attention_mask,
+            position_ids=position_ids.to(device),
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+
+        batch = _Batch()
+        batch.requests = list(requests)
+        batch.kv = _cache_layers(out.past_key_values)
+        batch.attention_mask = attention_mask
+        batch.next_positions = torch.tensor([len(sequence) for sequence in sequences], device=device)
+        batch.next_tokens = self._sample(requests, out.logits[:, -1, :])
+
+        prefill = time.time() - prefill_start
+        for request in requests:
+            request.timings["prefill"] = prefill
+            GENERATION_PREFILL.observe(prefill)
+        self._emit(key, batch)
+
+    # ============================================
+    # Speculative decoding
+    # ============================================
+    def _use_draft(self, arrivals):
+        """
+        Assisted generation decodes one sequence at a time, so it is only
+        used while a speculative request would otherwise run alone.
+        """
+        return (
+            self.draft_model is not None
+            and len(arrivals) == 1
+            and arrivals[0].speculative
+            and self.active_count() == 0
+        )
+
+    def _generate_assisted(self, key, requests):
+        """
+        Runs one request through model.generate() with the draft model
+        proposing tokens. Generation stops as soon as another request is
+        queued; the request then continues in the regular batch from the KV
+        built so far, so nothing waits for a whole speculative reply.
+        """
+        request = requests[0]
+        self._start(request)
+        device = self.model.device
+
+        arrival = StopOnArrival(lambda: self._queue.qsize() > 0)
+        stopping_criteria = StoppingCriteriaList([StopOnCancel(request.cancelled), arrival])
+        stop_tokens = None
+        if request.stop_token_sequences:
+            stop_tokens = StopOnTokens(request.stop_token_sequences, device)
+            stopping_criteria.append(stop_tokens)
+
+        # Every target pass yields one token of its own, any extra tokens are accepted draft
+        # proposals. A pass is fed the last accepted token plus the draft's candidates (the first
+        # one the whole prompt instead), so the input sizes give the number of proposed tokens.
+        passes = {"target": 0, "inputs": 0}
+
+        def count_target_pass(module, args, kwargs):
+            input_ids = kwargs.get("input_ids", args[0] if args else None)
+            passes["target"] += 1
+            if input_ids is not None:
+                passes["inputs"] += input_ids.shape[-1]
+
+        target = self.model.get_base_model() if hasattr(self.model, "get_base_model") else self.model
+        hooks = [target.register_forward_pre_hook(count_target_pass, with_kwargs=True)]
+        try:
+            output = self.model.generate(
+                input_ids=torch.tensor([request.input_ids], device=device),
+                attention_mask=torch.ones((1, len(request.input_ids)), dtype=torch.long, device=device),
+                assistant_model=self.draft_model,
+                streamer=_SkipPrompt(request.streamer) if request.streamer is not None else None,
+                max_new_tokens=request.max_new_tokens,
+                do_sample=request.do_sample,
+                temperature=request.temperature if request.do_sample else None,
+                top_p=request.top_p if request.do_sample else None,
+                top_k=(request.top_k if request.top_k is not None else self.default_top_k) if request.do_sample else None,
+                repetition_penalty=request.repetition_penalty,
+                eos_token_id=request.eos_token_id,
+                pad_token_id=self.pad_token_id,
+                stopping_criteria=stopping_criteria,
+                return_dict_in_generate=True,
+            )
+        finally:
+            for hook in hooks:
+                hook.remove()
+
+        sequence = output.sequences[0].tolist()
+        request.generated_ids = sequence[len(request.input_ids):]
+        generated = len(request.generated_ids)
+        if generated and request.first_token_at is None:
+            self._first_token(request)
+        GENERATION_TOKENS.inc(generated)
+        stats = self.speculative_stats
+        stats["requests"] += 1
+        stats["tokens"] += generated
+        stats["target_passes"] += passes["target"]
+        if passes["target"]:
+            stats["draft_tokens"] += max(0, passes["inputs"] - len(request.input_ids) - (passes["target"] - 1))
+        stats["accepted_tokens"] += max(0, generated - passes["target"])
+        self.stats["tokens"] += generated
+
+        # KV of every token but the last sampled one, which has not been fed through the model yet
+        kv = None
+        if output.past_key_values is not None:
+            kv = [(k[:, :, :len(sequence) - 1], v[:, :, :len(sequence) - 1])
+                  for k, v in _cache_layers(output.past_key_values)]
+
+        eos = request.eos_token_id if isinstance(request.eos_token_id, (list, tuple)) else [request.eos_token_id]
+        finished = (
+            request.cancelled.is_set()
+            or not generated
+            or generated >= request.max_new_tokens
+            or request.generated_ids[-1] in eos
+            or (stop_tokens is not None and bool(stop_tokens(output.sequences, None).any()))
+        )
+        if arrival.triggered and not finished:
+            self.stats["speculative_handoffs"] += 1
+            request._resume_kv = kv
+            self._prefill(key, [request])
+            return
+
+        if request.cancelled.is_set():
+            self.stats["cancelled"] += 1
+        elif kv is not None:
+            self._store_assisted_kv(request, sequence, kv)
+        self._finish(request)
+
+    def _store_assisted_kv(self, request, sequence, kv):
+        """Saves what a finished assisted request built: its session cache and the character prefix."""
+        if request.session is not None:
+            request.session.store(sequence[:kv[0][0].shape[2]], kv, request.adapter)
+        if (self.prefix_cache is not None and request.prefix_key is not None
+                and 0 < request.prefix_len < len(request.input_ids)):
+            prefix_ids = request.input_ids[:request.prefix_len]
+            if self.prefix_cache.get(request.prefix_key, prefix_ids) is None:
+                self.prefix_cache.put(request.prefix_key, prefix_ids, [
+                    (k[:, :, :request.prefix_len].clone(), v[:, :, :request.prefix_len].clone()) for k, v in kv
+                ])
+
+    def _prefix_kv(self, request):
+        """
+        Returns KV covering the start of the prompt: the session's cache if it
+        reaches past the character prefix, otherwise the prefix cache entry
+        (computed and cached on a miss).
+        """
+        if request._resume_kv is not None:
+            kv, request._resume_kv = request._resume_kv, None
+            return kv
+
+        if request.session is not None:
+            kv = request.session.checkout(request.input_ids, request.adapter, self.model.device)
+            if kv and kv[0][0].shape[2] >= request.prefix_len:
+                self.stats["session_tokens_reused"] += kv[0][0].shape[2]
+                return kv
+
+        if self.prefix_cache is None or request.prefix_key is None:
+            return None
+        # At least one token must be left to prefill so there are logits to sample from
+        if not 0 < request.prefix_len < len(request.input_ids):
+            return None
+
+        prefix_ids = request.input_ids[:request.prefix_len]
+        kv = self.prefix_cache.get(request.prefix_key, prefix_ids)
+        if kv is None:
+            out = self.model(
+                input_ids=torch.tensor([prefix_ids], device=self.model.device),
+                past_key_values=DynamicCache(),
+                use_cache=True,
+            )
+            kv = _cache_layers(out.past_key_values)
+            self.prefix_cache.put(request.prefix_key, prefix_ids, kv)
+        return kv
+
+    def _step(self, key):
+        batch = self._batches[key]
+        step_start = time.perf_counter()
+        attention_mask = torch.cat([batch.attention_mask, batch.attention_mask.new_ones((len(batch), 1))], dim=1)
+
+        out = self.model(
+            input_ids=batch.next_tokens.unsqueeze(-1),
+            attention_mask=attention_mask,
+            position_ids=batch.next_positions.unsqueeze(-1),
+            past_key_values=DynamicCache(batch.kv),
+            use_cache=True,
+        )
+
+        batch.kv = _cache_layers(out.past_key_values)
+        batch.attention_mask = attention_mask
+        batch.next_positions = batch.next_positions + 1
+        batch.next_tokens = self._sample(batch.requests, out.logits[:, -1, :])
+
+        del self._batches[key]  # Re-added by _emit with only the unfinished rows
+        self.stats["steps"] += 1
+        self._emit(key, batch, step_start)
+
+    def _emit(self, key, batch, step_start=None):
+        """
+        Streams each row's new token, evicts finished rows and keeps the rest
+        running. `step_start` is set for decode steps, which are timed up to
+        the host sync so the GPU work is included.
+        """
+        tokens = batch.next_tokens.tolist()  # One host sync per step for the whole batch
+        if step_start is not None:
+            GENERATION_DECODE_TOKEN.observe(time.perf_counter() - step_start)
+        keep = []
+        for row, (request, token) in enumerate(zip(batch.requests, tokens)):
+            if request.cancelled.is_set():
+                self.stats["cancelled"] += 1
+                self._finish(request)
+                continue
+
+            request.generated_ids.append(token)
+            self.stats["tokens"] += 1
+            GENERATION_TOKENS.inc()
+            if request.first_token_at is None:
+                self._first_token(request)
+            if request.streamer is not None:
+                request.streamer.put(torch.tensor([token]))
+            if self._is_finished(request, token):
+                if request.session is not None:
+                    self._save_session(batch, row, request)
+                self._finish(request)
+            else:
+                keep.append(row)
+
+        if len(keep) != len(batch):
+            batch.keep(keep)
+        if not batch.requests:
+            return
+
+        existing = self._batches.get(key)
+        if existing is None:
+            self._batches[key] = batch
+        else:
+            existing.merge(batch)
+        self.stats["max_batch"] = max(self.stats["max_batch"], self.active_count())
+
+    def _save_session(self, batch, row, request):
+        """Stores the row's KV, with padding removed, as the session's cache for the next turn."""
+        valid = batch.attention_mask[row].nonzero().view(-1)
+        kv = [
+            (k[row:row + 1].index_select(2, valid), v[row:row + 1].index_select(2, valid))
+            for k, v in batch.kv
+        ]
+        # The last sampled token has not been fed through the model yet
+        token_ids = request.input_ids + request.generated_ids[:-1]
+        request.session.store(token_ids, kv, request.adapter)
+
+    def _is_finished(self, request, token):
+        if request.eos_token_id is not None:
+            eos = request.eos_token_id if isinstance(request.eos_token_id, (list, tuple)) else [request.eos_token_id]
+            if token in eos:
+                return True
+        if len(request.generated_ids) >= request.max_new_tokens:
+            return True
+        if request._stop_matcher is not None:
+            request._stop_state, matched = request._stop_matcher.advance(request._stop_state, token)
+            return matched
+        return False
+
+    def _start(self, request):
+        """Runs once per request, when it first reaches the model (a handed-off request isn't restarted)."""
+        self.stats["requests"] += 1
+        request.started_at = time.time()
+        request.timings["queue_wait"] = request.started_at - request.submitted_at
+        GENERATION_QUEUE_WAIT.observe(request.timings["queue_wait"])
+
+    def _first_token(self, request):
+        request.first_token_at = time.time()
+        request.timings["ttft"] = request.first_token_at - request.submitted_at
+        GENERATION_TTFT.observe(request.timings["ttft"])
+
+    def _finish(self, request):
+        with self._requests_lock:
+            self._requests.pop(request.id, None)
+        request.finished_at = time.time()
+        if request.first_token_at is not None:
+            request.timings["decode"] = request.finished_at - request.first_token_at
+        request.timings["tokens"] = len(request.generated_ids)
+        if request.streamer is not None:
+            request.streamer.end()
+        request.done.set()
+
+    def _stop_matcher(self, sequences):
+        """Returns a shared automaton for a set of stop sequences (requests usually share one set)."""
+        if not sequences:
+            return None
+        key = tuple(tuple(seq) for seq in sequences)
+        matcher = self._stop_matchers.get(key)
+        if matcher is None:
+            matcher = self._stop_matchers[key] = TokenStopMatcher(sequences)
+        return matcher
+
+    # ============================================
+    # Sampling
+    # ============================================
+    def _build_processors(self, request):
+        processors = LogitsProcessorList()
+        if request.repetition_penalty and request.repetition_penalty != 1.0:
+            processors.append(RepetitionPenaltyLogitsProcessor(request.repetition_penalty))
+        if request.do_sample:
+            if request.temperature and request.temperature != 1.0:
+                processors.append(TemperatureLogitsWarper(request.temperature))
+            top_k = request.top_k if request.top_k is not None else self.default_top_k
+            if top_k:
+                processors.append(TopKLogitsWarper(top_k))
+            if request.top_p is not None and request.top_p < 1.0:
+                processors.append(TopPLogitsWarper(request.top_p))
+        return processors
+
+    def _sample(self, requests, logits):
+        next_tokens = []
+        for row, request in enumerate(requests):
+            scores = request._processors(request._ids, logits[row:row + 1].float())
+            if request.do_sample:
+                token = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1)
+            else:
+                token = scores.argmax(dim=-1, keepdim=True)
+            request._ids = torch.cat([request._ids, token], dim=-1)
+            next_tokens.append(token.view(1))
+        return torch.cat(next_tokens)
@@ -0,0 +1,169 @@
+"""
+In-memory JSON stores for characters.json and vts_mappings.json.
+
+The parsed document lives in memory, so reads cost no file I/O apart from
+a stat at most every `check_interval` seconds to pick up edits made
+outside the server (the file is re-read only when its mtime changed).
+Writers are serialized by a thread lock plus a lock on <name>.lock, which
+also covers other server processes sharing the file, and write a temp
+file that is renamed over the original, so readers and crashes never see
+a partial file.
+If the file cannot be parsed, the last good copy keeps being served and
+the broken file is set aside as <name>.corrupt before the next write.
+"""
+
+import copy
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class JsonStore:
+    def __init__(self, path, default=None, check_interval=1.0):
+        self.path = path
+        self.default = default
+        self.check_interval = check_interval
+        # Through _set so derived state (e.g. the character index) matches if the file can't be read
+        self._set(copy.deepcopy(default))
+        self._mtime = None
+        self._checked_at = 0.0
+        self._corrupt = False
+        self._lock = threading.RLock()
+        with self._lock:
+            self._reload()
+
+    def read(self):
+        """Returns the current document. Callers must not mutate it; use update()."""
+        if time.monotonic() - self._checked_at >= self.check_interval:
+            with self._lock:
+                self._reload()
+        return self._data
+
+    def update(self, fn):
+        """
+        Applies fn to a copy of the document under the writer lock, persists
+        the result atomically and returns whatever fn returned.
+        """
+        with self._lock, self._file_lock():
+            # Re-read under the lock so a write from another process isn't lost
+            self._reload(force=True)
+            data = copy.deepcopy(self._data)
+            result = fn(data)
+            self._write(data)
+            return result
+
+    def replace(self, data):
+        with self._lock, self._file_lock():
+            self._write(data)
+
+    @contextmanager
+    def _file_lock(self):
+        """Exclusive lock on the <name>.lock sidecar, held across processes."""
+        with open(self.path + ".lock", "a+b") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:  # LK_LOCK gives up after ~10 s
+                        pass
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _reload(self, force=False):
+        self._checked_at = time.monotonic()
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            if self.default is not None and self._mtime is None:
+                self._write(copy.deepcopy(self.default))
+            return
+        if mtime == self._mtime and not force:
+            return
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._validate(data)
+        except (OSError, ValueError) as e:
+            if not self._corrupt:
+                print(f"Warning: Could not read {self.path}, keeping the last good copy: {e}")
+            self._corrupt = True
+            self._mtime = mtime
+            return
+        self._corrupt = False
+        self._mtime = mtime
+        self._set(data)
+
+    def _write(self, data):
+        self._validate(data)
+        if self._corrupt:
+            os.replace(self.path, self.path + ".corrupt")
+            self._corrupt = False
+
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._mtime = os.stat(self.path).st_mtime_ns
+        self._set(data)
+
+    def _validate(self, data):
+        pass
+
+    def _set(self, data):
+        self._data = data
+
+
+class CharacterStore(JsonStore):
+    """List of character dicts with a lookup index by ID."""
+
+    def __init__(self, path, default_character, check_interval=1.0):
+        self._index = {}
+        super().__init__(path, [default_character], check_interval)
+
+    def list(self):
+        return self.read()
+
+    def get(self, character_id):
+        self.read()
+        return self._index.get(character_id)
+
+    def add(self, character):
+        self.update(lambda characters: characters.append(character))
+        return character
+
+    def delete(self, character_id):
+        """Removes a character; returns False if it did not exist."""
+        def remove(characters):
+            before = len(characters)
+            characters[:] = [c for c in characters if c.get("id") != character_id]
+            return len(characters) != before
+        return self.update(remove)
+
+    def _validate(self, data):
+        if not isinstance(data, list) or not all(isinstance(c, dict) for c in data):
+            raise ValueError(f"{self.path} must contain a list of characters")
+
+    def _set(self, data):
+        self._index = {c.get("id"): c for c in data}
+        self._data = data
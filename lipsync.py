@@ -0,0 +1,147 @@
+"""
+Server-side lip-sync for VTube Studio.
+
+Computes a mouth envelope from the WAV returned by /api/tts and streams it
+to VTS as batched InjectParameterDataRequest frames over the persistent
+VTSConnector session, clocked to the moment the browser starts playback.
+"""
+
+import io
+import time
+import uuid
+import wave
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+MOUTH_OPEN_PARAM = "MouthOpen"
+MOUTH_FORM_PARAM = "MouthSmile"
+
+
+def compute_envelope(wav_bytes, fps=30, open_gain=4.0, smoothing=0.5):
+    """
+    Returns one frame per 1/fps seconds of audio, each a dict of
+    {parameter_name: value}. MouthOpen follows the RMS amplitude, MouthSmile
+    follows the zero-crossing rate as a cheap viseme proxy (bright "i/e"
+    sounds spread the mouth, dark "o/u" sounds round it).
+    """
+    with wave.open(io.BytesIO(wav_bytes), "rb") as wf:
+        channels = wf.getnchannels()
+        sample_width = wf.getsampwidth()
+        rate = wf.getframerate()
+        raw = wf.readframes(wf.getnframes())
+
+    if sample_width != 2:
+        raise ValueError(f"Unsupported sample width: {sample_width * 8} bit")
+
+    # First channel is enough for an envelope
+    samples = np.frombuffer(raw, dtype="<i2")[::channels].astype(np.float64)
+    if not len(samples):
+        return []
+
+    # Per-window RMS and zero-crossing rate, computed over the whole clip at once
+    hop = max(1, int(rate / fps))
+    starts = np.arange(0, len(samples), hop)
+    lengths = np.diff(np.append(starts, len(samples)))
+    rms = np.sqrt(np.add.reduceat(samples * samples, starts) / lengths) / 32768.0
+    negative = samples < 0
+    crossed = np.append(negative[1:] != negative[:-1], False)
+    crossed[starts[1:] - 1] = False  # A sign change across a window boundary belongs to neither window
+    zcr = np.add.reduceat(crossed, starts) / lengths
+
+    mouth_open = np.minimum(1.0, rms * open_gain)
+    mouth_form = np.where(mouth_open > 0.05, np.minimum(1.0, zcr * 8.0), 0.0)
+
+    frames = []
+    open_prev = 0.0
+    form_prev = 0.0
+    for open_value, form_value in zip(mouth_open.tolist(), mouth_form.tolist()):
+        # One-pole smoothing keeps the jaw from chattering between frames
+        open_prev = smoothing * open_prev + (1 - smoothing) * open_value
+        form_prev = smoothing * form_prev + (1 - smoothing) * form_value
+        frames.append({
+            MOUTH_OPEN_PARAM: round(open_prev, 3),
+            MOUTH_FORM_PARAM: round(form_prev, 3)
+        })
+
+    return frames
+
+
+class LipSyncEngine:
+    def __init__(self, vts, fps=30, max_clips=32):
+        self.vts = vts
+        self.fps = fps
+        self.max_clips = max_clips
+        self._clips = OrderedDict()
+        self._lock = threading.Lock()
+        self._player_lock = threading.RLock()  # Serializes start/stop from concurrent requests
+        self._player = None
+        self._stop_event = None
+
+    def load(self, wav_bytes):
+        """Computes the envelope for a clip and returns its ID, or None if the WAV can't be read."""
+        try:
+            frames = compute_envelope(wav_bytes, self.fps)
+        except Exception as e:
+            print(f"Lip-sync: could not analyse audio: {e}")
+            return None
+
+        clip_id = uuid.uuid4().hex
+        with self._lock:
+            self._clips[clip_id] = frames
+            while len(self._clips) > self.max_clips:
+                self._clips.popitem(last=False)
+        return clip_id
+
+    def start(self, clip_id, offset=0.0):
+        """
+        Starts streaming a clip's frames. `offset` is how far into the clip
+        playback already is (the browser's audio.currentTime).
+        """
+        with self._lock:
+            frames = self._clips.get(clip_id)
+        if frames is None:
+            return False, "Unknown clip"
+
+        with self._player_lock:
+            self.stop(reset=False)
+            stop_event = threading.Event()
+            t0 = time.perf_counter() - float(offset)
+            player = threading.Thread(target=self._play, args=(frames, t0, stop_event), daemon=True)
+            self._stop_event = stop_event
+            self._player = player
+            player.start()
+        return True, "Lip-sync started"
+
+    def stop(self, reset=True):
+        with self._player_lock:
+            if self._stop_event is not None:
+                self._stop_event.set()
+            if self._player is not None and self._player is not threading.current_thread():
+                self._player.join(timeout=1)
+            self._player = None
+            self._stop_event = None
+            if reset:
+                self._close_mouth()
+        return True, "Lip-sync stopped"
+
+    def _play(self, frames, t0, stop_event):
+        interval = 1.0 / self.fps
+        last_index = -1
+        while not stop_event.is_set():
+            index = int((time.perf_counter() - t0) * self.fps)
+            if index >= len(frames):
+                break
+            if index != last_index:
+                # Frames that fell behind the clock are skipped, not queued
+                self.vts.inject_parameters(frames[index])
+                last_index = index
+            next_tick = t0 + (index + 1) * interval
+            stop_event.wait(max(0.0, next_tick - time.perf_counter()))
+
+        if not stop_event.is_set():
+            self._close_mouth()
+
+    def _close_mouth(self):
+        self.vts.inject_parameters({MOUTH_OPEN_PARAM: 0.0, MOUTH_FORM_PARAM: 0.0})
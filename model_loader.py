@@ -0,0 +1,66 @@
+"""
+One-time export of a merged Yuna-chan checkpoint.
+
+Loading the base model and then applying the LoRA with PeftModel costs
+two passes over the weights on every start. This script folds the LoRA
+into the base weights once and writes a standalone safetensors
+checkpoint (plus tokenizer) that model_runtime.py loads directly, memory-mapped,
+when USE_MERGED_MODEL is set and it finds it at MERGED_MODEL_PATH.
+
+The merged weights always include the Yuna LoRA, so custom characters
+no longer get the plain base model.
+
+Usage:
+    python model_loader.py [--base BASE] [--lora LORA] [--out OUT]
+"""
+
+import argparse
+import os
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from peft import PeftModel
+
+DEFAULT_BASE_MODEL_PATH = r"c:\Users\Nonx2\Documents\Yuuna-Project\Qwen2.5-1.5B-Instruct"
+DEFAULT_LORA_PATH = r"c:\Users\Nonx2\Documents\Yuuna-Project\Qwen25-lora-finetuned"
+DEFAULT_MERGED_MODEL_PATH = "merged_model"
+
+
+def has_merged_checkpoint(path):
+    if not path or not os.path.isdir(path):
+        return False
+    files = os.listdir(path)
+    return "config.json" in files and any(name.endswith(".safetensors") for name in files)
+
+
+def export_merged_checkpoint(base_path, lora_path, out_path, dtype=torch.float16):
+    """Merges the LoRA into the base weights on CPU and saves them as safetensors."""
+    print(f"Loading base model from {base_path}...")
+    model = AutoModelForCausalLM.from_pretrained(base_path, torch_dtype=dtype, trust_remote_code=True)
+    print(f"Merging LoRA adapter from {lora_path}...")
+    model = PeftModel.from_pretrained(model, lora_path).merge_and_unload()
+
+    # Write next to the target and rename, so a crash never leaves a half-written checkpoint behind
+    tmp_path = out_path.rstrip("/\\") + ".tmp"
+    model.save_pretrained(tmp_path, safe_serialization=True)
+    AutoTokenizer.from_pretrained(base_path, trust_remote_code=True).save_pretrained(tmp_path)
+    os.replace(tmp_path, out_path)
+    print(f"✅ Merged checkpoint written to {out_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a merged base+LoRA safetensors checkpoint")
+    parser.add_argument("--base", default=DEFAULT_BASE_MODEL_PATH)
+    parser.add_argument("--lora", default=DEFAULT_LORA_PATH)
+    parser.add_argument("--out", default=DEFAULT_MERGED_MODEL_PATH)
+    parser.add_argument("--float32", action="store_true", help="Save float32 weights instead of float16")
+    args = parser.parse_args()
+
+    if has_merged_checkpoint(args.out):
+        print(f"A merged checkpoint already exists at {args.out}")
+        return
+    export_merged_checkpoint(args.base, args.lora, args.out, torch.float32 if args.float32 else torch.float16)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Model loading and generation state, without the web app.
+
+Holds the model, tokenizer, adapters and GenerationScheduler plus the
+prefix cache and session store they share. app.py (and batch.py through
+it) loads the model here; model_worker.py imports only this module, so a
+worker process doesn't set up Flask, VTube Studio, TTS or the JSON
+stores of the web tier.
+"""
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from peft import PeftModel
+
+from generation_scheduler import GenerationScheduler, GenerationRequest
+from prefix_cache import PrefixCache
+from adapter_registry import AdapterRegistry, DEFAULT_ADAPTER
+from sessions import SessionStore
+from cpu_backend import prepare_cpu_model, quantize_int8, describe
+from model_loader import has_merged_checkpoint
+
+# ============================================
+# Configuration
+# ============================================
+BASE_MODEL_PATH = r"c:\Users\Nonx2\Documents\Yuuna-Project\Qwen2.5-1.5B-Instruct"
+LORA_PATH = r"c:\Users\Nonx2\Documents\Yuuna-Project\Qwen25-lora-finetuned"
+# Base+LoRA merged once by `python model_loader.py`; with USE_MERGED_MODEL it is loaded instead of the
+# two paths above when present. The Yuna LoRA can't be switched off in a merged checkpoint, so custom
+# characters then also run on the Yuna-tuned weights instead of the base model, and per-character
+# adapters are not applied.
+MERGED_MODEL_PATH = "merged_model"
+USE_MERGED_MODEL = False
+WARMUP_TOKENS = 8  # Tokens generated at startup before /readyz reports ready (0 to skip)
+ADAPTER_MAX_RESIDENT = 4  # LoRA adapters kept loaded at once, including the default one
+# Optional small draft model with the same tokenizer (e.g. Qwen2.5-0.5B-Instruct) for speculative decoding
+DRAFT_MODEL_PATH = None
+
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+SCHEDULER_MAX_BATCH_SIZE = 8  # Concurrent /api/chat streams decoded in one batch
+SCHEDULER_MAX_WAIT = 0.01  # Seconds an idle scheduler waits for more requests before prefilling
+PREFIX_CACHE_BYTES = 512 * 1024 * 1024  # Memory budget for cached character system prompt KV
+SESSION_MAX = 256  # Conversations whose history and KV cache are kept between turns
+SESSION_MAX_RESIDENT = 16  # Session caches kept on the model device; the rest go to CPU RAM
+SESSION_IDLE_TIMEOUT = 1800  # Seconds before an idle session is dropped
+SESSION_OFFLOAD_AFTER = 300  # Seconds before an idle session's cache is offloaded to CPU (None to disable)
+TORCH_DTYPE = torch.float16 if torch.cuda.is_available() else torch.float32
+# CPU backend (used when CUDA is missing): int8 linear layers, with the LoRA kept separate
+CPU_QUANTIZE_INT8 = True
+# Fold the Yuna LoRA into the weights: faster, but custom characters then also use the Yuna-tuned weights
+CPU_MERGE_LORA = False
+CPU_NUM_THREADS = None  # Intra-op threads; None lets the startup self-benchmark choose
+CPU_INTEROP_THREADS = 1
+CPU_TRY_COMPILE = False  # Also benchmark a torch.compile'd forward pass (slow first start)
+CPU_BENCHMARK_TOKENS = 16  # Tokens decoded per benchmark run; 0 skips the self-benchmark
+
+# Global model and tokenizer
+model = None
+tokenizer = None
+scheduler = None
+adapters = None
+# Background model loading progress, reported by /readyz
+load_status = {"state": "idle", "stage": None, "error": None, "started_at": None, "ready_at": None}
+prefix_cache = PrefixCache(PREFIX_CACHE_BYTES)
+sessions = SessionStore(SESSION_MAX, SESSION_MAX_RESIDENT, SESSION_IDLE_TIMEOUT, SESSION_OFFLOAD_AFTER)
+
+
+def use_merged_checkpoint():
+    return USE_MERGED_MODEL and has_merged_checkpoint(MERGED_MODEL_PATH)
+
+
+def tokenizer_path():
+    return MERGED_MODEL_PATH if use_merged_checkpoint() else BASE_MODEL_PATH
+
+
+def load_tokenizer(model_path):
+    load_status["stage"] = "tokenizer"
+    loaded = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    if loaded.pad_token is None:
+        loaded.pad_token = loaded.eos_token
+    return loaded
+
+
+def load_yuna(adapter_paths=()):
+    """
+    Loads the model, tokenizer and adapters and starts the scheduler.
+    `adapter_paths` are the characters' LoRA adapters, loaded up front when
+    the backend can't add them later (int8 CPU model).
+    """
+    global model, tokenizer, scheduler, adapters
+    print(f"Loading Yuna-chan on {DEVICE}...")
+    merged = use_merged_checkpoint()
+    model_path = MERGED_MODEL_PATH if merged else BASE_MODEL_PATH
+
+    tokenizer = load_tokenizer(model_path)
+
+    bnb_config = None
+    if DEVICE == "cuda":
+        try:
+            bnb_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.float16,
+            )
+            print("Quantization (4-bit) enabled.")
+        except Exception as e:
+            print(f"Warning: Could not initialize bitsandbytes: {e}")
+
+    load_status["stage"] = "model"
+    if merged:
+        print(f"Loading merged checkpoint from {MERGED_MODEL_PATH}...")
+    model = AutoModelForCausalLM.from_pretrained(
+        model_path,
+        quantization_config=bnb_config,
+        torch_dtype=TORCH_DTYPE,
+        device_map="auto" if DEVICE == "cuda" else None,
+        trust_remote_code=True
+    )
+
+    if not merged:
+        load_status["stage"] = "lora"
+        model = PeftModel.from_pretrained(model, LORA_PATH, adapter_name=DEFAULT_ADAPTER)
+
+    if DEVICE == "cpu":
+        model = model.to(DEVICE)
+
+    model.eval()
+
+    adapters = AdapterRegistry(model, ADAPTER_MAX_RESIDENT)
+    if DEVICE == "cpu":
+        load_status["stage"] = "cpu_backend"
+        # Adapters can't be added to the int8 model later, so the characters' adapters are loaded first
+        for path in adapter_paths:
+            adapters.register(path)
+        print("Preparing CPU backend (self-benchmark)...")
+        model, report = prepare_cpu_model(
+            model, tokenizer, CPU_QUANTIZE_INT8, CPU_NUM_THREADS, CPU_INTEROP_THREADS,
+            CPU_TRY_COMPILE, CPU_BENCHMARK_TOKENS, CPU_MERGE_LORA, adapters
+        )
+        adapters.model = model
+        print(describe(report))
+
+    # The scheduler thread owns the model for chat generation from here on
+    draft_model = None
+    if DRAFT_MODEL_PATH:
+        load_status["stage"] = "draft_model"
+        print(f"Loading draft model from {DRAFT_MODEL_PATH}...")
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            DRAFT_MODEL_PATH,
+            torch_dtype=TORCH_DTYPE,
+            device_map="auto" if DEVICE == "cuda" else None,
+            trust_remote_code=True
+        )
+        if DEVICE == "cpu":
+            draft_model = draft_model.to(DEVICE)
+            if CPU_QUANTIZE_INT8:
+                draft_model = quantize_int8(draft_model)
+        draft_model.eval()
+
+    scheduler = GenerationScheduler(
+        model, tokenizer, SCHEDULER_MAX_BATCH_SIZE, SCHEDULER_MAX_WAIT, prefix_cache, adapters, draft_model
+    )
+    scheduler.start()
+
+
+def warmup():
+    """Runs one short generation so kernels are compiled before the server reports ready."""
+    if not WARMUP_TOKENS:
+        return
+    load_status["stage"] = "warmup"
+    warmup_requests = [
+        GenerationRequest(tokenizer.encode("Hello"), max_new_tokens=WARMUP_TOKENS, do_sample=False,
+                          eos_token_id=tokenizer.eos_token_id, speculative=speculative)
+        for speculative in ([False, True] if scheduler.draft_model is not None else [False])
+    ]
+    for warmup_request in warmup_requests:
+        scheduler.submit(warmup_request)
+        warmup_request.wait()
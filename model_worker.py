@@ -0,0 +1,545 @@
+"""
+Model worker processes.
+
+A worker loads the model the same way app.py does and serves generation
+requests from its GenerationScheduler over a local IPC channel
+(multiprocessing.connection: pickled messages over a TCP or Unix socket,
+authenticated with a shared key). Tokens are streamed back as they are
+decoded.
+
+The connection unpickles what it receives, so the key is what keeps other
+users of the machine or network from running code in the worker. It is
+read from the YUUNA_MODEL_WORKER_KEY environment variable; without one, the
+first worker generates a random key into a key file only the current user
+can read, and web processes on the same machine read it from there.
+Workers refuse to listen on a non-loopback address unless the variable is
+set.
+
+Workers load the model through model_runtime.py and never import the
+web app, so they don't create its JSON stores or caches.
+
+The web tier (app.py or asgi_app.py with MODEL_WORKERS set) keeps only
+the tokenizer and talks to the workers through RemoteScheduler, which
+has the same submit/cancel/stats interface as GenerationScheduler. Any
+number of web processes can share the same workers, and restarting a web
+process no longer reloads the model.
+
+Run one worker per GPU (or CPU socket):
+    python model_worker.py --port 6001 --gpu 0
+    python model_worker.py --port 6002 --gpu 1
+    numactl --cpunodebind=1 --membind=1 python model_worker.py --port 6003
+
+Messages (web -> worker):
+    ("generate", request_id, spec)   spec: GenerationRequest fields, session_id, adapter_path
+    ("cancel", request_id)
+    ("drop_session", session_id)
+    ("stats", call_id)
+Messages (worker -> web):
+    ("tokens", request_id, [token IDs])
+    ("done", request_id, {"generated_ids", "timings", "error"})
+    ("stats", call_id, stats)
+"""
+
+import argparse
+import hashlib
+import ipaddress
+import os
+import secrets
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Listener
+
+
+def apply_gpu_argument(argv):
+    """Sets CUDA_VISIBLE_DEVICES from --gpu; only takes effect before torch is imported."""
+    pre_parser = argparse.ArgumentParser(add_help=False)
+    pre_parser.add_argument("--gpu", default=None)
+    gpu = pre_parser.parse_known_args(argv)[0].gpu
+    if gpu is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpu
+
+
+if __name__ == "__main__":
+    apply_gpu_argument(sys.argv[1:])
+
+import torch
+
+from generation_scheduler import GenerationRequest
+
+KEY_ENV = "YUUNA_MODEL_WORKER_KEY"
+
+# Fields of a GenerationRequest sent to the worker as-is
+REQUEST_FIELDS = ("input_ids", "max_new_tokens", "do_sample", "temperature", "top_p", "top_k",
+                  "repetition_penalty", "eos_token_id", "stop_token_sequences", "adapter", "prefix_key",
+                  "prefix_len", "speculative")
+
+
+def parse_address(address):
+    """"host:port" -> (host, port) for TCP; anything else is a Unix socket path."""
+    if isinstance(address, tuple):
+        return address
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return host or "127.0.0.1", int(port)
+    return address
+
+
+def is_loopback(address):
+    """True for Unix sockets and TCP addresses only reachable from this machine."""
+    if not isinstance(address, tuple):
+        return True
+    host = address[0]
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False  # A hostname may resolve to any interface
+
+
+def load_authkey(key_file, create=False):
+    """
+    Returns the shared key from KEY_ENV, else from `key_file`. With
+    `create`, a missing key file is filled with a new random key readable
+    only by the current user. Returns None if there is no key.
+    """
+    configured = os.environ.get(KEY_ENV)
+    if configured:
+        return configured.encode("utf-8")
+    if create and not os.path.exists(key_file):
+        try:
+            fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass  # Another worker created it first
+        else:
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_hex(32))
+    try:
+        with open(key_file, "r", encoding="utf-8") as f:
+            return f.read().strip().encode("utf-8") or None
+    except FileNotFoundError:
+        return None
+
+
+# ============================================
+# Worker side
+# ============================================
+class _ConnectionStreamer:
+    """Streamer that forwards a request's tokens, and its result, over the web tier's connection."""
+
+    def __init__(self, channel, request_id):
+        self.channel = channel
+        self.request_id = request_id
+        self.request = None
+        self.prompt_seen = False
+
+    def put(self, value):
+        if not self.prompt_seen:
+            # submit() sends the prompt first, like generate() does
+            self.prompt_seen = True
+            return
+        if not self.channel.send(("tokens", self.request_id, value.view(-1).tolist())):
+            self.request.cancel()  # The web process is gone
+
+    def end(self):
+        request = self.request
+        self.channel.finished(self.request_id)
+        self.channel.send(("done", self.request_id, {
+            "generated_ids": list(request.generated_ids),
+            "timings": dict(request.timings),
+            "error": str(request.error) if request.error is not None else None,
+        }))
+
+
+class _Channel:
+    """One web-tier connection and the requests it has running."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.requests = {}
+        self.lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+    def send(self, message):
+        """Returns False if the web process has disconnected."""
+        try:
+            with self._send_lock:
+                self.conn.send(message)
+            return True
+        except (OSError, EOFError, ValueError):
+            return False
+
+    def finished(self, request_id):
+        with self.lock:
+            self.requests.pop(request_id, None)
+
+
+class ModelWorker:
+    def __init__(self, scheduler, sessions, adapters, address, authkey):
+        self.scheduler = scheduler
+        self.sessions = sessions
+        self.adapters = adapters
+        self.address = parse_address(address)
+        self.authkey = authkey
+        self.stats = {"connections": 0, "open_connections": 0, "requests": 0, "disconnect_cancels": 0}
+        self._lock = threading.Lock()
+
+    def serve_forever(self):
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print(f"Model worker listening on {self.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:  # Failed handshake (e.g. wrong key); keep serving the others
+                    print(f"Model worker: rejected a connection: {e}")
+                    continue
+                threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        channel = _Channel(conn)
+        with self._lock:
+            self.stats["connections"] += 1
+            self.stats["open_connections"] += 1
+        try:
+            while True:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    break
+                kind = message[0]
+                if kind == "generate":
+                    self._generate(channel, message[1], message[2])
+                elif kind == "cancel":
+                    with channel.lock:
+                        request = channel.requests.get(message[1])
+                    if request is not None:
+                        request.cancel()
+                elif kind == "drop_session":
+                    self.sessions.drop(message[1])
+                elif kind == "stats":
+                    channel.send(("stats", message[1], self.get_stats()))
+        finally:
+            # The web process went away: free the batch slots its requests were holding
+            with channel.lock:
+                orphans = list(channel.requests.values())
+            for request in orphans:
+                request.cancel()
+            with self._lock:
+                self.stats["open_connections"] -= 1
+                self.stats["disconnect_cancels"] += len(orphans)
+            conn.close()
+
+    def _generate(self, channel, request_id, spec):
+        streamer = _ConnectionStreamer(channel, request_id)
+        fields = {name: spec[name] for name in REQUEST_FIELDS if name in spec}
+        if spec.get("adapter_path"):
+            fields["adapter"] = self.adapters.register(spec["adapter_path"])
+        session = self.sessions.get(spec["session_id"]) if spec.get("session_id") else None
+
+        request = GenerationRequest(streamer=streamer, session=session, **fields)
+        request.id = request_id
+        streamer.request = request
+        with channel.lock:
+            channel.requests[request_id] = request
+        with self._lock:
+            self.stats["requests"] += 1
+        self.scheduler.submit(request)
+
+    def get_stats(self):
+        with self._lock:
+            worker = dict(self.stats)
+        return dict(self.scheduler.get_stats(), worker=worker, sessions=self.sessions.get_stats(),
+                    adapters=self.adapters.get_stats() if self.adapters else None)
+
+
+# ============================================
+# Web-tier side
+# ============================================
+class _WorkerLink:
+    """Connection to one worker; its thread reconnects after the worker restarts."""
+
+    def __init__(self, owner, address):
+        self.owner = owner
+        self.address = parse_address(address)
+        self.name = address if isinstance(address, str) else f"{address[0]}:{address[1]}"
+        self.conn = None
+        self.connected = threading.Event()
+        self.requests = {}  # Requests sent to this worker and not finished yet
+        self.cancels_sent = set()
+        self.calls = {}  # call_id -> Future for stats replies
+        self.lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self.failures = 0
+        self.last_error = None
+
+    def weight(self, key):
+        digest = hashlib.sha1(f"{key}\0{self.name}".encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def send(self, message):
+        with self._send_lock:
+            self.conn.send(message)
+
+    def run(self):
+        while self.owner.running:
+            try:
+                self.conn = Client(self.address, authkey=self.owner.authkey)
+            except Exception as e:
+                self.last_error = str(e)
+                time.sleep(self.owner.retry_interval)
+                continue
+            print(f"Connected to model worker {self.name}")
+            self.connected.set()
+            try:
+                self._read()
+            except (EOFError, OSError) as e:
+                self.last_error = str(e) or type(e).__name__
+            self.connected.clear()
+            self.failures += 1
+            print(f"Lost model worker {self.name}: {self.last_error}")
+            self._fail_all(ConnectionError(f"Model worker {self.name} disconnected"))
+            try:
+                self.conn.close()
+            except OSError:
+                pass
+
+    def _read(self):
+        while self.owner.running:
+            if self.conn.poll(self.owner.poll_interval):
+                message = self.conn.recv()
+                kind = message[0]
+                if kind == "tokens":
+                    self._tokens(message[1], message[2])
+                elif kind == "done":
+                    self._done(message[1], message[2])
+                elif kind == "stats":
+                    with self.lock:
+                        future = self.calls.pop(message[1], None)
+                    if future is not None:
+                        future.set_result(message[2])
+            self._send_cancels()
+
+    def _tokens(self, request_id, token_ids):
+        with self.lock:
+            request = self.requests.get(request_id)
+        if request is None:
+            return
+        if request.first_token_at is None:
+            request.first_token_at = time.time()
+        if request.streamer is not None:
+            request.streamer.put(torch.tensor(token_ids))
+
+    def _done(self, request_id, result):
+        with self.lock:
+            request = self.requests.pop(request_id, None)
+            self.cancels_sent.discard(request_id)
+        if request is None:
+            return
+        request.generated_ids = result["generated_ids"]
+        request.timings.update(result["timings"])
+        if result["error"] is not None:
+            request.error = RuntimeError(result["error"])
+        self.owner.finish(request)
+
+    def _send_cancels(self):
+        """Forwards request.cancel() calls made in this process (client disconnects, stop sequences)."""
+        with self.lock:
+            cancelled = [rid for rid, r in self.requests.items()
+                         if r.cancelled.is_set() and rid not in self.cancels_sent]
+            self.cancels_sent.update(cancelled)
+        for request_id in cancelled:
+            self.send(("cancel", request_id))
+
+    def _fail_all(self, error):
+        with self.lock:
+            requests, self.requests = list(self.requests.values()), {}
+            calls, self.calls = list(self.calls.values()), {}
+            self.cancels_sent.clear()
+        for request in requests:
+            request.error = error
+            self.owner.finish(request)
+        for future in calls:
+            future.set_exception(error)
+
+
+class RemoteScheduler:
+    """
+    GenerationScheduler stand-in that runs requests on model workers.
+    Requests with a session go to the worker holding that session's KV
+    cache (rendezvous hashing over the connected workers); the others go to
+    the worker with the fewest requests in flight.
+    """
+
+    def __init__(self, addresses, authkey, adapters=None, retry_interval=2.0, poll_interval=0.02):
+        self.authkey = authkey
+        self.adapters = adapters  # Web-side AdapterRegistry, only used to look up adapter paths
+        self.retry_interval = retry_interval
+        self.poll_interval = poll_interval  # Also how quickly cancellations reach the worker
+        self.links = [_WorkerLink(self, address) for address in addresses]
+        self.draft_model = None
+        self.running = False
+        self._requests = {}
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "failed_submits": 0}
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        for link in self.links:
+            threading.Thread(target=link.run, name=f"model-worker-{link.name}", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        for link in self.links:
+            if link.conn is not None:
+                try:
+                    link.conn.close()
+                except OSError:
+                    pass
+
+    def wait_connected(self, timeout=None):
+        """Blocks until at least one worker is connected; returns False on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        while deadline is None or time.time() < deadline:
+            if any(link.connected.is_set() for link in self.links):
+                return True
+            time.sleep(0.1)
+        return False
+
+    def _pick(self, request, tried):
+        candidates = [link for link in self.links if link.connected.is_set() and link not in tried]
+        if not candidates:
+            return None
+        if request.session is not None:
+            return max(candidates, key=lambda link: link.weight(request.session.id))
+        return min(candidates, key=lambda link: len(link.requests))
+
+    def submit(self, request):
+        """Sends a request to a worker; tokens arrive on request.streamer as they are decoded."""
+        if request.streamer is not None:
+            # Mirrors generate(): the prompt is sent first so skip_prompt streamers drop it
+            request.streamer.put(torch.tensor(request.input_ids))
+        request.submitted_at = time.time()
+        with self._lock:
+            self._requests[request.id] = request
+            self.stats["requests"] += 1
+
+        spec = {name: getattr(request, name) for name in REQUEST_FIELDS}
+        spec["session_id"] = request.session.id if request.session is not None else None
+        if request.adapter is not None and self.adapters is not None:
+            spec["adapter_path"] = self.adapters.path(request.adapter)
+
+        tried = []
+        while True:
+            link = self._pick(request, tried)
+            if link is None:
+                with self._lock:
+                    self.stats["failed_submits"] += 1
+                request.error = ConnectionError("No model worker is connected")
+                self.finish(request)
+                return request
+            with link.lock:
+                link.requests[request.id] = request
+            try:
+                link.send(("generate", request.id, spec))
+                return request
+            except (OSError, ValueError) as e:
+                with link.lock:
+                    link.requests.pop(request.id, None)
+                link.last_error = str(e)
+                tried.append(link)
+
+    def finish(self, request):
+        with self._lock:
+            self._requests.pop(request.id, None)
+        request.finished_at = time.time()
+        if request.streamer is not None:
+            request.streamer.end()
+        request.done.set()
+
+    def cancel(self, request_id):
+        """Cancels a queued or running request by ID; returns False if it is unknown or already done."""
+        with self._lock:
+            request = self._requests.get(request_id)
+        if request is None or request.done.is_set():
+            return False
+        request.cancel()
+        return True
+
+    def drop_session(self, session_id):
+        for link in self.links:
+            if link.connected.is_set():
+                try:
+                    link.send(("drop_session", session_id))
+                except (OSError, ValueError):
+                    pass
+
+    def active_count(self):
+        return sum(len(link.requests) for link in self.links)
+
+    def queued_count(self):
+        """Requests still waiting for their first token."""
+        with self._lock:
+            return sum(1 for r in self._requests.values() if r.first_token_at is None)
+
+    def _call_stats(self, link, timeout):
+        future = Future()
+        call_id = os.urandom(8).hex()
+        with link.lock:
+            link.calls[call_id] = future
+        try:
+            link.send(("stats", call_id))
+            return future.result(timeout)
+        except Exception as e:
+            with link.lock:
+                link.calls.pop(call_id, None)
+            return {"error": str(e)}
+
+    def get_stats(self, timeout=2.0):
+        workers = []
+        for link in self.links:
+            entry = {"address": link.name, "connected": link.connected.is_set(), "in_flight": len(link.requests),
+                     "disconnects": link.failures, "last_error": link.last_error}
+            if entry["connected"]:
+                entry.update(self._call_stats(link, timeout))
+            workers.append(entry)
+        with self._lock:
+            stats = dict(self.stats)
+        return dict(stats, active=self.active_count(), queued=self.queued_count(), workers=workers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Yuuna model worker: serves generation to the web tier over IPC")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6001)
+    parser.add_argument("--socket", default=None, help="Listen on this Unix socket path instead of TCP")
+    parser.add_argument("--gpu", default=None, help="GPU index(es) this worker may use, e.g. 1 or 2,3")
+    parser.add_argument("--key-file", default="model_worker.key",
+                        help=f"Where the shared key is kept when {KEY_ENV} is not set")
+    parser.add_argument("--characters", default="characters.json",
+                        help="Character file whose LoRA adapters are preloaded on the int8 CPU backend")
+    args = parser.parse_args(argv)
+
+    address = args.socket or (args.host, args.port)
+    if not is_loopback(address) and not os.environ.get(KEY_ENV):
+        parser.error(f"Listening on {args.host} exposes the worker to the network; set {KEY_ENV} to a secret first")
+    authkey = load_authkey(args.key_file, create=True)
+
+    if args.gpu is not None and os.environ.get("CUDA_VISIBLE_DEVICES") != args.gpu:
+        parser.error("--gpu only works when model_worker.py is run as a script; "
+                     "set CUDA_VISIBLE_DEVICES before importing it instead")
+    import model_runtime as runtime
+    from json_store import JsonStore
+
+    # Read only: without a default the store never creates the file
+    characters = JsonStore(args.characters).read() or []
+    runtime.load_yuna([c["adapter"] for c in characters if isinstance(c, dict) and c.get("adapter")])
+    runtime.warmup()
+    ModelWorker(runtime.scheduler, runtime.sessions, runtime.adapters, address, authkey).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
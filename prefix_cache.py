@@ -0,0 +1,63 @@
+"""
+Prefix KV-cache for character system prompts.
+
+Holds the past_key_values of each character's tokenized system prompt so
+the scheduler only has to prefill the conversation that follows it.
+Entries are keyed by character ID and a hash of the prompt text, shared
+across requests and users, and evicted LRU under a memory budget.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def make_prefix_key(character_id, prompt_text, adapter=None):
+    digest = hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()
+    return (character_id, digest, adapter)
+
+
+class PrefixCache:
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (token_ids, kv, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key, token_ids):
+        """Returns the cached KV for `key` if it was built from exactly `token_ids`."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != token_ids:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key, token_ids, kv):
+        size = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (list(token_ids), kv, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[2]
+                self.stats["evictions"] += 1
+
+    def invalidate(self, character_id):
+        """Drops every cached prefix belonging to a character."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == character_id]:
+                self._bytes -= self._entries.pop(key)[2]
+                self.stats["invalidations"] += 1
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), bytes=self._bytes)
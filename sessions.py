@@ -0,0 +1,115 @@
+"""
+Server-side conversation sessions.
+
+A session keeps the token IDs of the conversation so far together with
+their KV cache, so the next turn only prefills what was added since.
+Idle sessions are evicted after a timeout and the number of sessions is
+capped. Caches beyond the resident cap, or of sessions idle for a while,
+are offloaded to CPU RAM until they are used again.
+"""
+
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+
+class Session:
+    def __init__(self, session_id):
+        self.id = session_id
+        self.token_ids = []
+        self.kv = None  # [(keys, values)] per layer, each [1, heads, seq, dim]
+        self.adapter = None
+        self.last_used = time.time()
+        self.offloaded = False
+        self._lock = threading.Lock()
+
+    def store(self, token_ids, kv, adapter):
+        with self._lock:
+            self.token_ids = list(token_ids)
+            self.kv = kv
+            self.adapter = adapter
+            self.offloaded = False
+            self.last_used = time.time()
+
+    def checkout(self, input_ids, adapter, device):
+        """
+        Returns KV for the longest prefix of `input_ids` this session has
+        already seen, leaving at least one token to prefill, or None.
+        """
+        with self._lock:
+            self.last_used = time.time()
+            if self.kv is None or self.adapter != adapter:
+                return None
+
+            limit = min(len(self.token_ids), len(input_ids) - 1)
+            common = 0
+            while common < limit and self.token_ids[common] == input_ids[common]:
+                common += 1
+            if common == 0:
+                return None
+
+            if self.offloaded:
+                self.kv = [(k.to(device), v.to(device)) for k, v in self.kv]
+                self.offloaded = False
+            return [(k[:, :, :common], v[:, :, :common]) for k, v in self.kv]
+
+    def offload(self):
+        with self._lock:
+            if self.kv is not None and not self.offloaded:
+                self.kv = [(k.to("cpu"), v.to("cpu")) for k, v in self.kv]
+                self.offloaded = True
+
+
+class SessionStore:
+    def __init__(self, max_sessions=256, max_resident=16, idle_timeout=1800, offload_after=300):
+        self.max_sessions = max_sessions
+        self.max_resident = max_resident  # Sessions whose KV may stay on the model device
+        self.idle_timeout = idle_timeout
+        self.offload_after = offload_after  # None disables CPU offloading
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"created": 0, "evicted": 0, "expired": 0, "offloaded": 0}
+
+    def get(self, session_id=None):
+        """Returns the session with this ID, creating a new one if it is unknown or expired."""
+        with self._lock:
+            self._sweep()
+            session = self._sessions.get(session_id) if session_id else None
+            if session is None:
+                session = Session(session_id or uuid.uuid4().hex)
+                self._sessions[session.id] = session
+                self.stats["created"] += 1
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+                    self.stats["evicted"] += 1
+            self._sessions.move_to_end(session.id)
+            session.last_used = time.time()
+            return session
+
+    def drop(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def _sweep(self):
+        now = time.time()
+        for session in list(self._sessions.values()):
+            idle = now - session.last_used
+            if idle > self.idle_timeout:
+                del self._sessions[session.id]
+                self.stats["expired"] += 1
+            elif self.offload_after is not None and idle > self.offload_after and not session.offloaded \
+                    and session.kv is not None:
+                session.offload()
+                self.stats["offloaded"] += 1
+
+        # Oldest first: keep only the most recently used caches on the device
+        resident = [s for s in self._sessions.values() if s.kv is not None and not s.offloaded]
+        for session in resident[:max(0, len(resident) - self.max_resident)]:
+            session.offload()
+            self.stats["offloaded"] += 1
+
+    def get_stats(self):
+        with self._lock:
+            resident = sum(1 for s in self._sessions.values() if s.kv is not None and not s.offloaded)
+            return dict(self.stats, sessions=len(self._sessions), resident=resident)
@@ -25,9 +25,13 @@ const charPromptInput = document.getElementById('char-prompt');
 
 let messageHistory = [];
 let currentAudio = null;
+let speechSession = 0; // Bumped whenever playback is interrupted
+let chatSessionId = null; // Server-side session holding this conversation's KV cache
+let activeRequestId = null; // Chat request currently streaming, cancelled if the page is left
 let currentCharacter = null;
 let characters = [];
 let vtsMappings = {};
+const audioFormat = pickAudioFormat();
 
 // Initialize
 document.addEventListener('DOMContentLoaded', () => {
@@ -44,63 +48,165 @@ input.addEventListener('input', function () {
 async function speakText(text) {
     if (!text) return;
 
+    stopSpeech();
+    const session = speechSession;
+    const speakerId = moodSelector.value;
+
+    try {
+        const clip = await fetchClip('/api/tts', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ text: text, speaker: speakerId, format: audioFormat.name })
+        });
+        if (!clip || session !== speechSession) return;
+
+        await playClip(clip);
+        if (session === speechSession) triggerResetHotkey();
+    } catch (error) {
+        console.error('TTS Playback error:', error);
+    }
+}
+
+// Plays the sentence-by-sentence audio of a pipelined chat response in order,
+// fetching the next sentence while the current one is playing.
+async function playSpeechStream(speechId) {
+    stopSpeech();
+    const session = speechSession;
+
+    try {
+        let index = 0;
+        const speechUrl = i => `/api/speech/${speechId}/${i}?format=${audioFormat.name}`;
+        let next = fetchClip(speechUrl(index));
+        while (session === speechSession) {
+            const clip = await next;
+            if (!clip) break;
+
+            index++;
+            next = fetchClip(speechUrl(index));
+            await playClip(clip);
+        }
+        if (session === speechSession) triggerResetHotkey();
+    } catch (error) {
+        console.error('TTS Playback error:', error);
+    }
+}
+
+function stopSpeech() {
     // Stop any current audio
+    speechSession++;
     if (currentAudio) {
         currentAudio.pause();
         currentAudio = null;
     }
+}
 
-    const speakerId = moodSelector.value;
+// Compressed format to ask the server for. Streamable ones are played through a MediaSource
+// while they download; the server answers with WAV when it has no encoder.
+function pickAudioFormat() {
+    const mse = window.MediaSource;
+    if (mse && mse.isTypeSupported('audio/webm; codecs="opus"')) return { name: 'webm', stream: true };
+    if (mse && mse.isTypeSupported('audio/mpeg')) return { name: 'mp3', stream: true };
+    const probe = document.createElement('audio');
+    if (probe.canPlayType('audio/ogg; codecs=opus')) return { name: 'ogg', stream: false };
+    if (probe.canPlayType('audio/mpeg')) return { name: 'mp3', stream: false };
+    return { name: 'wav', stream: false };
+}
 
-    try {
-        const response = await fetch('/api/tts', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ text: text, speaker: speakerId })
-        });
+// Returns { blob or response, type, lipSyncId }, or null when there is nothing (more) to play
+async function fetchClip(url, options) {
+    const response = await fetch(url, options);
 
-        if (response.status === 503) {
-            alert("VOICEVOX engine is not running. Please start it on port 50021 to hear the voice!");
-            return;
+    if (response.status === 503) {
+        alert("VOICEVOX engine is not running. Please start it on port 50021 to hear the voice!");
+        return null;
+    }
+    if (response.status === 204) return null;
+    if (!response.ok) throw new Error('TTS failed');
+
+    const lipSyncId = response.headers.get('X-LipSync-Id');
+    const type = response.headers.get('Content-Type') || '';
+    if (audioFormat.stream && response.body && MediaSource.isTypeSupported(type)) {
+        return { response, type, lipSyncId };
+    }
+    const blob = await response.blob();
+    return { blob, type, lipSyncId };
+}
+
+// Object URL for a clip; streamed clips are appended to a MediaSource as their bytes arrive
+function clipUrl(clip) {
+    if (clip.blob) return URL.createObjectURL(clip.blob);
+
+    const mediaSource = new MediaSource();
+    mediaSource.addEventListener('sourceopen', async () => {
+        const buffer = mediaSource.addSourceBuffer(clip.type);
+        if (clip.type.startsWith('audio/mpeg')) buffer.mode = 'sequence'; // MP3 frames carry no timestamps
+        const reader = clip.response.body.getReader();
+        try {
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer.appendBuffer(value);
+                await new Promise(resolve => buffer.addEventListener('updateend', resolve, { once: true }));
+            }
+            mediaSource.endOfStream();
+        } catch (error) {
+            console.error('Audio stream error:', error);
         }
-        if (!response.ok) throw new Error('TTS failed');
+    }, { once: true });
+    return URL.createObjectURL(mediaSource);
+}
 
-        const blob = await response.blob();
-        const url = URL.createObjectURL(blob);
+// Plays one clip with lip-sync; resolves when it ends or is stopped
+function playClip(clip) {
+    const { lipSyncId } = clip;
+    return new Promise(resolve => {
+        const url = clipUrl(clip);
         currentAudio = new Audio(url);
+        const audio = currentAudio;
 
-        // Start lip-sync (open mouth)
+        // Start server-side lip-sync, clocked to the playback position
         currentAudio.onplay = () => {
-            fetch('/api/vts/parameter', {
+            if (!lipSyncId) return;
+            fetch('/api/vts/lipsync', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ name: 'MouthOpen', value: 1 })
+                body: JSON.stringify({ action: 'start', id: lipSyncId, offset: audio.currentTime })
             }).catch(e => console.error('Lip-sync start error:', e));
         };
 
         // Stop lip-sync (close mouth)
-        currentAudio.onended = () => {
-            fetch('/api/vts/parameter', {
+        currentAudio.onpause = () => {
+            if (audio.ended) return;
+            fetch('/api/vts/lipsync', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ name: 'MouthOpen', value: 0 })
-            }).catch(e => console.error('Lip-sync end error:', e));
-
-            // Trigger Reset Hotkey if mapped
-            const resetHotkeyId = vtsMappings['RESET'];
-            if (resetHotkeyId) {
-                console.log('Triggering VTS reset hotkey after speech.');
-                fetch('/api/vts/trigger', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ id: resetHotkeyId })
-                }).catch(e => console.error('Reset trigger error:', e));
-            }
+                body: JSON.stringify({ action: 'stop' })
+            }).catch(e => console.error('Lip-sync stop error:', e));
+            resolve();
         };
 
-        currentAudio.play();
-    } catch (error) {
-        console.error('TTS Playback error:', error);
+        currentAudio.onended = () => {
+            URL.revokeObjectURL(url);
+            resolve();
+        };
+
+        currentAudio.play().catch(error => {
+            console.error('TTS Playback error:', error);
+            resolve();
+        });
+    });
+}
+
+function triggerResetHotkey() {
+    // Trigger Reset Hotkey if mapped
+    const resetHotkeyId = vtsMappings['RESET'];
+    if (resetHotkeyId) {
+        console.log('Triggering VTS reset hotkey after speech.');
+        fetch('/api/vts/trigger', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ id: resetHotkeyId })
+        }).catch(e => console.error('Reset trigger error:', e));
     }
 }
 
@@ -113,28 +219,52 @@ async function loadVTSMappings() {
     }
 }
 
-async function triggerVTSForEmotion(text) {
-    if (!text) return;
+// Handles the server's early emotion event; the server fires the mapped hotkey itself when asked to
+async function triggerVTSForEmotion({ emotion, hotkey_id, triggered }) {
+    if (triggered) {
+        console.log(`Server triggered VTS hotkey for emotion: [${emotion}]`);
+        return;
+    }
+    if (!hotkey_id) {
+        console.log(`Emotion [${emotion}] not mapped to a hotkey. Ignoring.`);
+        return;
+    }
+
+    console.log(`Triggering VTS hotkey for emotion: [${emotion}]`);
+    try {
+        await fetch('/api/vts/trigger', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ id: hotkey_id })
+        });
+    } catch (error) {
+        console.error('VTS Trigger error:', error);
+    }
+}
 
-    // Extract emotion tag like [HAPPY] anywhere in the string, but usually at the start
-    const match = text.match(/\[([A-Z]+)\]/);
-    if (match) {
-        const emotion = match[1];
-        const hotkeyId = vtsMappings[emotion];
-
-        if (hotkeyId) {
-            console.log(`Triggering VTS hotkey for emotion: [${emotion}]`);
-            try {
-                await fetch('/api/vts/trigger', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ id: hotkeyId })
-                });
-            } catch (error) {
-                console.error('VTS Trigger error:', error);
+// Reads a text/event-stream response body, calling onEvent(name, data) for each event
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const frame = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let name = 'message';
+            const dataLines = [];
+            for (const line of frame.split('\n')) {
+                if (line.startsWith('event:')) name = line.slice(6).trim();
+                else if (line.startsWith('data:')) dataLines.push(line.slice(5).replace(/^ /, ''));
             }
-        } else {
-            console.log(`Emotion [${emotion}] not mapped to a hotkey. Ignoring.`);
+            if (dataLines.length) onEvent(name, JSON.parse(dataLines.join('\n')));
         }
     }
 }
@@ -240,7 +370,14 @@ async function sendMessage() {
         const payload = {
             messages: messageHistory,
             system_prompt: currentCharacter ? currentCharacter.system_prompt : undefined,
-            character_id: currentCharacter ? currentCharacter.id : 'default'
+            character_id: currentCharacter ? currentCharacter.id : 'default',
+            session_id: chatSessionId || undefined,
+            session: true, // Keep the conversation's KV cache on the server between turns
+            // Let the server synthesize sentences while it is still generating
+            tts: ttsToggle.checked,
+            speaker: moodSelector.value,
+            // Fire the emotion's VTS hotkey from the server as soon as the tag is decoded
+            trigger_vts: true
         };
 
         const response = await fetch('/api/chat', {
@@ -251,55 +388,71 @@ async function sendMessage() {
 
         if (!response.ok) throw new Error('Network response was not ok');
 
-        const reader = response.body.getReader();
-        const decoder = new TextDecoder();
+        chatSessionId = response.headers.get('X-Session-Id') || chatSessionId;
+        activeRequestId = response.headers.get('X-Request-Id');
+        const speechId = response.headers.get('X-Speech-Id');
+        if (speechId) playSpeechStream(speechId);
+
         let fullResponse = '';
-        let duration = null;
+        let timing = null;
+        let failed = false;
 
         assistantBubble.textContent = '';
 
-        while (true) {
-            const { done, value } = await reader.read();
-            if (done) break;
-
-            const chunk = decoder.decode(value, { stream: true });
-
-            if (chunk.includes('__DURATION__')) {
-                const parts = chunk.split('__DURATION__');
-                fullResponse += parts[0];
-                duration = parts[1];
-
+        await readEventStream(response, (event, data) => {
+            if (event === 'token') {
+                fullResponse += data.text;
+                assistantBubble.innerHTML = marked.parse(fullResponse);
+            } else if (event === 'emotion') {
+                // Arrives with the first few tokens, so the avatar reacts while the reply is still streaming
+                triggerVTSForEmotion(data);
+            } else if (event === 'timing') {
+                timing = data;
+            } else if (event === 'done') {
                 assistantBubble.innerHTML = marked.parse(fullResponse.trim());
 
                 const timeDiv = document.createElement('div');
                 timeDiv.className = 'response-time';
-                timeDiv.textContent = `Response time: ${duration}s`;
+                timeDiv.textContent = `Response time: ${data.duration}s`;
+                if (timing) {
+                    // Per-stage breakdown shown on hover
+                    timeDiv.title = Object.entries(timing)
+                        .map(([stage, value]) => `${stage}: ${value}`)
+                        .join('\n');
+                }
                 assistantTextDiv.appendChild(timeDiv);
-            } else {
-                fullResponse += chunk;
-                assistantBubble.innerHTML = marked.parse(fullResponse);
+            } else if (event === 'error') {
+                failed = true;
+                console.error('Generation error:', data.message);
+                assistantBubble.textContent = `Error: ${data.message}`;
             }
 
             display.scrollTop = display.scrollHeight;
-        }
+        });
 
+        activeRequestId = null;
+        if (failed) return;
         const finalContent = fullResponse.trim();
         messageHistory.push({ role: 'assistant', content: finalContent });
 
-        // Auto-speak if toggled on
-        if (ttsToggle.checked) {
+        // Auto-speak if toggled on (already streaming when the server pipelined it)
+        if (ttsToggle.checked && !speechId) {
             speakText(finalContent);
         }
 
-        // Trigger VTS movement based on emotion
-        triggerVTSForEmotion(finalContent);
-
     } catch (error) {
         console.error('Fetch error:', error);
         assistantBubble.textContent = 'Error: Could not connect to the server.';
     }
 }
 
+// Stop server-side generation if the page is closed mid-reply
+window.addEventListener('pagehide', () => {
+    if (activeRequestId) {
+        navigator.sendBeacon(`/api/chat/${activeRequestId}/cancel`);
+    }
+});
+
 btn.addEventListener('click', sendMessage);
 input.addEventListener('keydown', (e) => {
     if (e.key === 'Enter' && !e.shiftKey) {
@@ -479,6 +632,11 @@ Output only the system prompt.`;
     charPromptInput.value = '';
 }
 
+// Alternatives from the last /api/generate_prompt call; clicking again shows the next one
+const PROMPT_CANDIDATES = 3;
+let promptCandidates = [];
+let promptCandidatesFor = null;
+
 generatePromptBtn.addEventListener('click', async () => {
     const instruction = charGenPromptInput.value.trim();
     if (!instruction) {
@@ -486,6 +644,11 @@ generatePromptBtn.addEventListener('click', async () => {
         return;
     }
 
+    if (instruction === promptCandidatesFor && promptCandidates.length) {
+        charPromptInput.value = promptCandidates.shift();
+        return;
+    }
+
     generatePromptBtn.disabled = true;
     generatePromptBtn.innerHTML = 'Generating...';
 
@@ -493,12 +656,14 @@ generatePromptBtn.addEventListener('click', async () => {
         const response = await fetch('/api/generate_prompt', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ instruction })
+            body: JSON.stringify({ instruction, num_candidates: PROMPT_CANDIDATES })
         });
 
         const data = await response.json();
         if (data.system_prompt) {
             charPromptInput.value = data.system_prompt;
+            promptCandidates = (data.candidates || []).slice(1).filter(c => c);
+            promptCandidatesFor = instruction;
         } else {
             alert('Failed to generate prompt: ' + (data.error || 'Unknown error'));
         }
@@ -0,0 +1,144 @@
+"""
+Stop-sequence matching shared by the scheduler, model.generate() callers
+and the /api/chat text stream.
+
+- TokenStopMatcher: Aho-Corasick automaton over token IDs, advanced one
+  token at a time, so checking every stop sequence costs O(1) per step.
+- StopOnTokens: StoppingCriteria for model.generate() that compares the
+  tail of input_ids against all stop sequences in one tensor op on the
+  model device, without copying to the host.
+- StopOnCancel: StoppingCriteria that ends model.generate() once a
+  request's cancel flag is set.
+- TextStopMatcher: incremental matcher over decoded text that only looks
+  at the new chunk plus a short held-back tail, never the whole response.
+"""
+
+from collections import deque
+
+import torch
+from transformers import StoppingCriteria
+
+
+class TokenStopMatcher:
+    def __init__(self, sequences):
+        self._goto = [{}]
+        self._fail = [0]
+        self._match = [False]
+
+        for seq in sequences:
+            if not seq:
+                continue
+            state = 0
+            for token in seq:
+                if token not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._match.append(False)
+                    self._goto[state][token] = len(self._goto) - 1
+                state = self._goto[state][token]
+            self._match[state] = True
+
+        # Breadth-first failure links; a state matches if any suffix of it does
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for token, child in self._goto[state].items():
+                fallback = self._fail[state]
+                while fallback and token not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(token, 0)
+                self._match[child] = self._match[child] or self._match[self._fail[child]]
+                pending.append(child)
+
+    def advance(self, state, token):
+        """Feeds one token; returns (new_state, matched). Start from state 0."""
+        while state and token not in self._goto[state]:
+            state = self._fail[state]
+        state = self._goto[state].get(token, 0)
+        return state, self._match[state]
+
+
+class StopOnTokens(StoppingCriteria):
+    def __init__(self, stop_token_sequences, device=None):
+        sequences = [seq for seq in stop_token_sequences if seq]
+        self.max_len = max((len(seq) for seq in sequences), default=0)
+        # Stop sequences right-aligned in one [num_sequences, max_len] table; -1 pads the unused columns
+        table = torch.full((len(sequences), self.max_len), -1, dtype=torch.long)
+        for row, seq in enumerate(sequences):
+            table[row, self.max_len - len(seq):] = torch.tensor(seq)
+        self.table = table.to(device) if device is not None else table
+        self.wildcard = self.table < 0
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.max_len == 0 or input_ids.shape[1] == 0:
+            return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if self.table.device != input_ids.device:
+            self.table = self.table.to(input_ids.device)
+            self.wildcard = self.wildcard.to(input_ids.device)
+
+        tail = input_ids[:, -self.max_len:]
+        if tail.shape[1] < self.max_len:
+            tail = torch.nn.functional.pad(tail, (self.max_len - tail.shape[1], 0), value=-2)
+        hits = (tail[:, None, :] == self.table[None]) | self.wildcard[None]
+        return hits.all(dim=-1).any(dim=-1)
+
+
+class StopOnCancel(StoppingCriteria):
+    def __init__(self, cancelled):
+        self.cancelled = cancelled  # threading.Event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.cancelled.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+class StopOnArrival(StoppingCriteria):
+    """Stops model.generate() once `pending()` is true, e.g. when another request is waiting to run."""
+
+    def __init__(self, pending):
+        self.pending = pending
+        self.triggered = False
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if not self.triggered and self.pending():
+            self.triggered = True
+        return torch.full((input_ids.shape[0],), self.triggered, dtype=torch.bool, device=input_ids.device)
+
+
+class TextStopMatcher:
+    def __init__(self, stop_sequences):
+        self.stop_sequences = [seq for seq in stop_sequences if seq]
+        self.hold = max((len(seq) for seq in self.stop_sequences), default=1) - 1
+        self.pending = ""
+        self.stopped = False
+
+    def feed(self, text):
+        """
+        Adds a decoded chunk. Returns (safe_text, stopped): text that can be
+        emitted now, and whether a stop sequence was found. Up to
+        len(longest stop sequence) - 1 characters are held back in case they
+        turn out to be the start of one.
+        """
+        if self.stopped:
+            return "", True
+
+        window = self.pending + text
+        earliest = -1
+        for seq in self.stop_sequences:
+            pos = window.find(seq)
+            if pos != -1 and (earliest == -1 or pos < earliest):
+                earliest = pos
+
+        if earliest != -1:
+            self.stopped = True
+            self.pending = ""
+            return window[:earliest], True
+
+        cut = max(0, len(window) - self.hold)
+        self.pending = window[cut:]
+        return window[:cut], False
+
+    def flush(self):
+        """Returns the held-back tail once the stream has ended."""
+        rest = self.pending
+        self.pending = ""
+        return rest
@@ -0,0 +1,62 @@
+"""
+Checks that per-character LoRA adapters still work on the int8 CPU model.
+
+Runs on the tiny random Qwen2 model from benchmarks/, so no weights or GPU
+are needed:
+    python -m pytest test_cpu_backend.py
+"""
+
+import tempfile
+
+import torch
+from peft import LoraConfig, PeftModel, get_peft_model
+
+from adapter_registry import AdapterRegistry, DEFAULT_ADAPTER
+from benchmarks.tiny_model import make_model, make_tokenizer
+from cpu_backend import prepare_cpu_model
+
+
+def save_lora(path, seed):
+    base = make_model("tiny")
+    torch.manual_seed(seed)  # After make_model, which seeds the RNG itself
+    lora = get_peft_model(base, LoraConfig(r=4, target_modules=["q_proj", "v_proj"], init_lora_weights=False))
+    lora.save_pretrained(path)
+
+
+def last_logits(model, ids):
+    with torch.no_grad():
+        return model(input_ids=ids).logits[0, -1]
+
+
+def test_second_adapter_on_int8_model():
+    folder = tempfile.mkdtemp()
+    save_lora(f"{folder}/yuna", seed=1)
+    save_lora(f"{folder}/character", seed=2)
+
+    torch.manual_seed(0)
+    model = PeftModel.from_pretrained(make_model("tiny"), f"{folder}/yuna", adapter_name=DEFAULT_ADAPTER).eval()
+    adapters = AdapterRegistry(model)
+    character = adapters.register(f"{folder}/character")
+    model, report = prepare_cpu_model(model, make_tokenizer(), quantize=True, num_threads=1,
+                                      benchmark_tokens=0, adapters=adapters)
+    assert report["quantized"]
+
+    ids = torch.tensor([[5, 6, 7, 8]])
+    adapters.activate(character)
+    with_character = last_logits(model, ids)
+    adapters.activate(DEFAULT_ADAPTER)
+    with_default = last_logits(model, ids)
+    with model.disable_adapter():
+        base = last_logits(model, ids)
+    assert not torch.allclose(with_character, with_default)
+    assert not torch.allclose(with_character, base)
+
+    # Adapters added after quantizing can't be attached, so they fall back to the base model
+    assert adapters.register(f"{folder}/unknown") is None
+    assert adapters.register(f"{folder}/character") == character
+    assert adapters.get_stats()["rejected"] == 1
+
+
+if __name__ == "__main__":
+    test_second_adapter_on_int8_model()
+    print("✅ int8 adapters OK")
@@ -0,0 +1,34 @@
+"""
+Checks that JsonStore.update() doesn't lose writes when several server
+processes share the same file:
+    python -m pytest test_json_store.py
+"""
+
+import multiprocessing
+import os
+import tempfile
+
+from json_store import JsonStore
+
+
+def increment(path, times):
+    store = JsonStore(path, {"count": 0})
+    for _ in range(times):
+        store.update(lambda data: data.update(count=data["count"] + 1))
+
+
+def test_updates_from_several_processes():
+    path = os.path.join(tempfile.mkdtemp(), "store.json")
+    JsonStore(path, {"count": 0})
+    workers = [multiprocessing.Process(target=increment, args=(path, 100)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+    assert JsonStore(path).read() == {"count": 400}
+
+
+if __name__ == "__main__":
+    test_updates_from_several_processes()
+    print("✅ JsonStore cross-process updates OK")
@@ -0,0 +1,59 @@
+"""
+Checks that closing a speech stream early cancels the sentences that are
+still waiting for synthesis, while a finished reply keeps all its audio:
+    python -m pytest test_tts_pipeline.py
+"""
+
+import asyncio
+import threading
+
+from tts_pipeline import SpeechPipeline
+
+
+def blocking_synthesizer():
+    """Synthesizes "audio" only once released, and records which sentences ran."""
+    release = threading.Event()
+    started = []
+
+    def synthesize(sentence, speaker_id, params):
+        started.append(sentence)
+        release.wait(5)
+        return sentence.encode()
+
+    return synthesize, release, started
+
+
+def test_close_cancels_pending_sentences():
+    synthesize, release, started = blocking_synthesizer()
+    pipeline = SpeechPipeline(synthesize, max_workers=1)
+    stream = pipeline.open(speaker_id=1)
+    for sentence in ["One.", "Two.", "Three."]:
+        stream.say(sentence)
+
+    stream.close()  # Client disconnected while "One." was being synthesized
+    release.set()
+    assert stream.get(0) == b"One."
+    assert stream.get(1) is None
+    assert asyncio.run(stream.get_async(2)) is None
+    assert started == ["One."]
+
+
+def test_end_keeps_queued_sentences():
+    synthesize, release, started = blocking_synthesizer()
+    pipeline = SpeechPipeline(synthesize, max_workers=1)
+    stream = pipeline.open(speaker_id=1)
+    stream.say("One.")
+    stream.say("Two.")
+
+    stream.end()
+    stream.close()  # The response closing after a complete reply cancels nothing
+    release.set()
+    assert stream.get(1) == b"Two."
+    assert asyncio.run(stream.get_async(0)) == b"One."
+    assert stream.get(2) is None
+
+
+if __name__ == "__main__":
+    test_close_cancels_pending_sentences()
+    test_end_keeps_queued_sentences()
+    print("✅ speech stream cancellation OK")
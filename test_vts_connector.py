@@ -0,0 +1,38 @@
+"""
+Checks that a refused VTube Studio token request is not repeated on every
+call, against the fake VTS server from benchmarks/:
+    python -m pytest test_vts_connector.py
+"""
+
+import os
+import tempfile
+import time
+
+from benchmarks.fake_vts import FakeVTS
+from vts_connector import VTSConnector
+
+
+def test_denied_token_backs_off():
+    fake = FakeVTS(deny_tokens=True).start()
+    vts = VTSConnector(port=fake.port, min_backoff=0.5, max_backoff=0.5)
+    vts.token_file = os.path.join(tempfile.mkdtemp(), ".vts_token")
+    vts.token = None
+    try:
+        # The lip-sync player injects at 30 Hz; a whole backoff window of calls makes one token request
+        for _ in range(10):
+            success, msg = vts.inject_parameters({"MouthOpen": 0.5})
+            assert not success
+            time.sleep(1 / 30)
+        assert fake.stats["token_requests"] == 1
+
+        time.sleep(0.5)
+        vts.inject_parameters({"MouthOpen": 0.5})
+        assert fake.stats["token_requests"] == 2
+    finally:
+        vts.close()
+        fake.stop()
+
+
+if __name__ == "__main__":
+    test_denied_token_backs_off()
+    print("✅ VTS token backoff OK")
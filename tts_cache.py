@@ -0,0 +1,163 @@
+"""
+Content-addressed cache for synthesized TTS audio.
+
+Clips are keyed by a hash of the cleaned text, speaker ID and synthesis
+parameters. A small in-memory LRU sits in front of a size-bounded on-disk
+tier so repeated greetings and retries skip VOICEVOX entirely. Keys with
+an extension (e.g. "<hash>.ogg" for an encoded clip) are stored under
+that name; plain keys are WAV.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+AUDIO_EXTENSIONS = (".wav", ".ogg", ".mp3", ".webm")
+
+
+def make_key(text, speaker_id, params=None):
+    payload = json.dumps(
+        {"text": text, "speaker": speaker_id, "params": params or {}},
+        sort_keys=True,
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TTSCache:
+    def __init__(self, cache_dir="tts_cache", max_memory_bytes=64 * 1024 * 1024,
+                 max_disk_bytes=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()  # key -> size, oldest access first
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0
+        }
+
+        if self.cache_dir and self.max_disk_bytes > 0:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._scan_disk()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key if "." in key else f"{key}.wav")
+
+    def _scan_disk(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(AUDIO_EXTENSIONS):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name[:-4] if name.endswith(".wav") else name, st.st_size))
+
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        self._evict_disk()
+
+    def get(self, key):
+        """Returns the cached audio bytes for `key`, or None on a miss."""
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return audio
+
+            on_disk = key in self._disk
+
+        if on_disk:
+            try:
+                with open(self._path(key), "rb") as f:
+                    audio = f.read()
+                os.utime(self._path(key))
+            except OSError:
+                audio = None
+
+            with self._lock:
+                if audio is not None:
+                    self._disk.move_to_end(key)
+                    self.stats["disk_hits"] += 1
+                    self._store_memory(key, audio)
+                    return audio
+                # File vanished underneath us
+                size = self._disk.pop(key, 0)
+                self._disk_bytes -= size
+
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key, audio):
+        with self._lock:
+            self._store_memory(key, audio)
+            if not self.cache_dir or self.max_disk_bytes <= 0 or key in self._disk:
+                return
+            if len(audio) > self.max_disk_bytes:
+                return
+
+        # Write to a temp file and rename so readers never see a partial clip
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(audio)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"TTS cache: could not write {path}: {e}")
+            return
+
+        with self._lock:
+            if key not in self._disk:
+                self._disk[key] = len(audio)
+                self._disk_bytes += len(audio)
+                self._evict_disk()
+
+    def _store_memory(self, key, audio):
+        if len(audio) > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = audio
+        self._memory_bytes += len(audio)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self.stats["memory_evictions"] += 1
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.max_disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self.stats["disk_evictions"] += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def get_stats(self):
+        with self._lock:
+            return dict(
+                self.stats,
+                memory_entries=len(self._memory),
+                memory_bytes=self._memory_bytes,
+                disk_entries=len(self._disk),
+                disk_bytes=self._disk_bytes
+            )
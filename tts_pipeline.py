@@ -0,0 +1,178 @@
+"""
+Sentence-pipelined TTS.
+
+The chat reply is split into sentences as it decodes (SentenceSplitter)
+and each finished sentence is synthesized in a worker pool while the
+model keeps generating.
+The browser fetches the ordered audio chunks from /api/speech/<id>/<index>,
+so the first sentence can play while the rest is still being written.
+"""
+
+import re
+import time
+import uuid
+import asyncio
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+# Latin terminators need trailing whitespace so "3.5" or a half-decoded "..." don't split;
+# CJK terminators are unambiguous and end a sentence straight away.
+SENTENCE_END = re.compile(r'[.!?…]+["\')\]]*\s+|[。！？]+[」』）]*\s*|\n+')
+EMOTION_TAG = re.compile(r'\[[A-Z]+\]')
+
+
+class SentenceSplitter:
+    def __init__(self, min_chars=2):
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def _speakable(self, text):
+        return len(EMOTION_TAG.sub('', text).strip()) >= self.min_chars
+
+    def feed(self, text):
+        """Adds decoded text and returns the sentences it completed."""
+        self.buffer += text
+        sentences = []
+        search_from = 0
+        while True:
+            match = SENTENCE_END.search(self.buffer, search_from)
+            if not match:
+                break
+            candidate = self.buffer[:match.end()]
+            if self._speakable(candidate):
+                sentences.append(candidate.strip())
+                self.buffer = self.buffer[match.end():]
+                search_from = 0
+            else:
+                # Too short on its own (e.g. a bare emotion tag), keep it for the next sentence
+                search_from = match.end()
+        return sentences
+
+    def flush(self):
+        rest = self.buffer.strip()
+        self.buffer = ""
+        return [rest] if rest and self._speakable(rest) else []
+
+
+class SpeechStream:
+    """Ordered audio chunks for one chat response."""
+
+    def __init__(self, stream_id, executor, synthesize):
+        self.id = stream_id
+        self.created = time.time()
+        self._executor = executor
+        self._synthesize = synthesize
+        self._chunks = []
+        self._closed = False
+        self._cond = threading.Condition()
+        self._async_waiters = []  # Callables waking get_async() callers on their event loops
+
+    def say(self, sentence):
+        """Queues a finished sentence as the next chunk."""
+        with self._cond:
+            if self._closed:
+                return
+            self._chunks.append(self._executor.submit(self._synthesize, sentence))
+            self._notify()
+
+    def end(self):
+        """Marks the reply as complete; the queued sentences are still synthesized."""
+        with self._cond:
+            self._closed = True
+            self._notify()
+
+    def close(self):
+        """
+        Closes a stream that didn't reach end(), e.g. after the client
+        disconnected, and cancels the sentences still waiting for synthesis.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            pending = list(self._chunks)
+            self._notify()
+        for future in pending:
+            future.cancel()
+
+    def _notify(self):
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for wake in waiters:
+            wake()
+
+    def get(self, index, timeout=60):
+        """
+        Blocks until chunk `index` is synthesized and returns its audio.
+        Returns None once the stream is closed and has no such chunk, or
+        the chunk was cancelled by close().
+        """
+        with self._cond:
+            ready = self._cond.wait_for(lambda: index < len(self._chunks) or self._closed, timeout)
+            if not ready:
+                raise TimeoutError("Timed out waiting for sentence")
+            if index >= len(self._chunks):
+                return None
+            future = self._chunks[index]
+        try:
+            return future.result(timeout=timeout)
+        except CancelledError:
+            return None
+
+    async def get_async(self, index, timeout=60):
+        """get() for the ASGI server: waits on the event loop instead of a thread."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            with self._cond:
+                if index < len(self._chunks) or self._closed:
+                    break
+                changed = loop.create_future()
+                self._async_waiters.append(
+                    lambda: loop.call_soon_threadsafe(lambda: changed.done() or changed.set_result(None))
+                )
+            try:
+                await asyncio.wait_for(changed, deadline - loop.time())
+            except asyncio.TimeoutError:
+                raise TimeoutError("Timed out waiting for sentence")
+
+        with self._cond:
+            if index >= len(self._chunks):
+                return None
+            future = self._chunks[index]
+        # asyncio.wait leaves the synthesis running if this request is cancelled or times out
+        chunk = asyncio.wrap_future(future)
+        done, _ = await asyncio.wait({chunk}, timeout=timeout)
+        if not done:
+            raise TimeoutError("Timed out waiting for sentence")
+        return None if chunk.cancelled() else chunk.result()
+
+
+class SpeechPipeline:
+    def __init__(self, synthesize, max_workers=2, max_age=300):
+        self.synthesize = synthesize
+        self.max_age = max_age
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tts")
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def open(self, speaker_id, params=None):
+        stream_id = uuid.uuid4().hex
+        stream = SpeechStream(
+            stream_id,
+            self._executor,
+            lambda sentence: self.synthesize(sentence, speaker_id, params)
+        )
+        with self._lock:
+            self._expire()
+            self._streams[stream_id] = stream
+        return stream
+
+    def get(self, stream_id):
+        with self._lock:
+            return self._streams.get(stream_id)
+
+    def _expire(self):
+        cutoff = time.time() - self.max_age
+        for stream_id in [s.id for s in self._streams.values() if s.created < cutoff]:
+            self._streams.pop(stream_id).close()
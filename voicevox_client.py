@@ -0,0 +1,328 @@
+"""
+Pooled VOICEVOX client.
+
+Keeps HTTP connections to the engine alive, bounds how many requests hit
+it at once (the rest queue), memoizes /audio_query per text and speaker so
+changing speed/pitch/intonation only reruns /synthesis, and records
+per-stage timings.
+
+Every request has a blocking and an async variant (for the ASGI server,
+using httpx); both share the concurrency slots and the query cache.
+"""
+
+import copy
+import time
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:  # Only needed by the *_async methods
+    httpx = None
+
+from metrics import VOICEVOX_STAGE
+
+
+class VoicevoxError(RuntimeError):
+    pass
+
+
+class _Slots:
+    """Concurrency slots shared by threads and coroutines, handed out in arrival order."""
+
+    def __init__(self, count):
+        self._free = count
+        self._waiters = deque()  # Callables that hand a freed slot to one waiter
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free and not self._waiters:
+                self._free -= 1
+                return
+            granted = threading.Event()
+            self._waiters.append(granted.set)
+        granted.wait()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def deliver():
+            if future.cancelled():
+                self.release()  # The waiter gave up after the slot was handed over
+            else:
+                future.set_result(None)
+
+        def grant():
+            loop.call_soon_threadsafe(deliver)
+
+        with self._lock:
+            if self._free and not self._waiters:
+                self._free -= 1
+                return
+            self._waiters.append(grant)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if grant in self._waiters:
+                    self._waiters.remove(grant)
+                    raise
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if not self._waiters:
+                self._free += 1
+                return
+            grant = self._waiters.popleft()
+        grant()
+
+
+class VoicevoxClient:
+    STAGES = ("queue", "audio_query", "synthesis")
+
+    def __init__(self, base_url="http://localhost:50021", max_concurrency=2, pool_size=8,
+                 query_cache_size=256, query_timeout=10, synthesis_timeout=30):
+        self.base_url = base_url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.query_cache_size = query_cache_size
+        self.query_timeout = query_timeout
+        self.synthesis_timeout = synthesis_timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool_size = pool_size
+        self._async_session = None  # httpx.AsyncClient, created on first async request
+
+        self._slots = _Slots(max_concurrency)
+        self._queries = OrderedDict()
+        self._pending_queries = {}
+        self._lock = threading.Lock()
+
+        self.in_flight = 0
+        self.queued = 0
+        self.query_hits = 0
+        self.query_misses = 0
+        self.timings = {stage: {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0} for stage in self.STAGES}
+
+    def _record(self, stage, seconds):
+        VOICEVOX_STAGE.observe(seconds, stage=stage)
+        with self._lock:
+            t = self.timings[stage]
+            t["count"] += 1
+            t["total"] += seconds
+            t["last"] = seconds
+            t["max"] = max(t["max"], seconds)
+
+    def _post(self, stage, path, timeout, **kwargs):
+        """POSTs to the engine once a concurrency slot is free."""
+        with self._lock:
+            self.queued += 1
+        wait_start = time.perf_counter()
+        try:
+            self._slots.acquire()
+        finally:
+            with self._lock:
+                self.queued -= 1
+        self._record("queue", time.perf_counter() - wait_start)
+        with self._lock:
+            self.in_flight += 1
+
+        try:
+            start = time.perf_counter()
+            response = self.session.post(f"{self.base_url}{path}", timeout=timeout, **kwargs)
+            self._record(stage, time.perf_counter() - start)
+            return response
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+    async def _post_async(self, stage, path, timeout, **kwargs):
+        if httpx is None:
+            raise RuntimeError("The async VOICEVOX client needs httpx (pip install httpx)")
+        if self._async_session is None:
+            self._async_session = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            )
+
+        with self._lock:
+            self.queued += 1
+        wait_start = time.perf_counter()
+        try:
+            await self._slots.acquire_async()
+        finally:
+            with self._lock:
+                self.queued -= 1
+        self._record("queue", time.perf_counter() - wait_start)
+        with self._lock:
+            self.in_flight += 1
+
+        try:
+            start = time.perf_counter()
+            try:
+                response = await self._async_session.post(f"{self.base_url}{path}", timeout=timeout, **kwargs)
+            except httpx.ConnectError as e:
+                # Same exception as the blocking client, so callers handle "engine not running" once
+                raise requests.exceptions.ConnectionError(str(e)) from e
+            self._record(stage, time.perf_counter() - start)
+            return response
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+    def _claim_query(self, key):
+        """
+        Returns (query, None) on a cache hit, (None, pending) while another
+        caller fetches the same query, or (None, None) if this caller should.
+        """
+        with self._lock:
+            query = self._queries.get(key)
+            if query is not None:
+                self._queries.move_to_end(key)
+                self.query_hits += 1
+                return copy.deepcopy(query), None
+            pending = self._pending_queries.get(key)
+            if pending is None:
+                self.query_misses += 1
+                self._pending_queries[key] = Future()
+            return None, pending
+
+    def _store_query(self, key, response):
+        if response.status_code != 200:
+            raise VoicevoxError(f"VOICEVOX query failed: {response.text}")
+        query = response.json()
+        with self._lock:
+            self._queries[key] = query
+            while len(self._queries) > self.query_cache_size:
+                self._queries.popitem(last=False)
+        return copy.deepcopy(query)
+
+    def _release_query(self, key):
+        with self._lock:
+            self._pending_queries.pop(key).set_result(None)
+
+    def audio_query(self, text, speaker_id):
+        """
+        Returns the engine's audio query for `text`, memoized per text and
+        speaker. Concurrent misses for the same key share one request.
+        """
+        key = (text, speaker_id)
+        while True:
+            query, pending = self._claim_query(key)
+            if query is not None:
+                return query
+            if pending is None:
+                break
+            # Another caller is already fetching this query; if it fails we fetch it ourselves
+            wait([pending], self.query_timeout)
+
+        try:
+            response = self._post(
+                "audio_query",
+                "/audio_query",
+                self.query_timeout,
+                params={"text": text, "speaker": speaker_id}
+            )
+            return self._store_query(key, response)
+        finally:
+            self._release_query(key)
+
+    async def audio_query_async(self, text, speaker_id):
+        key = (text, speaker_id)
+        while True:
+            query, pending = self._claim_query(key)
+            if query is not None:
+                return query
+            if pending is None:
+                break
+            try:
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(pending)), self.query_timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        try:
+            response = await self._post_async(
+                "audio_query",
+                "/audio_query",
+                self.query_timeout,
+                params={"text": text, "speaker": speaker_id}
+            )
+            return self._store_query(key, response)
+        finally:
+            self._release_query(key)
+
+    def synthesis(self, query, speaker_id):
+        response = self._post(
+            "synthesis",
+            "/synthesis",
+            self.synthesis_timeout,
+            params={"speaker": speaker_id},
+            json=query
+        )
+        return self._synthesis_result(response)
+
+    async def synthesis_async(self, query, speaker_id):
+        response = await self._post_async(
+            "synthesis",
+            "/synthesis",
+            self.synthesis_timeout,
+            params={"speaker": speaker_id},
+            json=query
+        )
+        return self._synthesis_result(response)
+
+    @staticmethod
+    def _synthesis_result(response):
+        if response.status_code != 200:
+            raise VoicevoxError(f"VOICEVOX synthesis failed: {response.text}")
+        return response.content
+
+    def synthesize(self, text, speaker_id, params=None):
+        """
+        Returns WAV bytes for `text`. `params` overrides audio query fields
+        such as speedScale or pitchScale.
+        """
+        query = self.audio_query(text, speaker_id)
+        if params:
+            query.update(params)
+        return self.synthesis(query, speaker_id)
+
+    async def synthesize_async(self, text, speaker_id, params=None):
+        query = await self.audio_query_async(text, speaker_id)
+        if params:
+            query.update(params)
+        return await self.synthesis_async(query, speaker_id)
+
+    async def aclose(self):
+        """Closes the async connection pool; it is recreated on the next async request."""
+        session, self._async_session = self._async_session, None
+        if session is not None:
+            await session.aclose()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "query_cache_hits": self.query_hits,
+                "query_cache_misses": self.query_misses,
+                "query_cache_entries": len(self._queries),
+                "timings": {
+                    stage: dict(t, avg=(t["total"] / t["count"]) if t["count"] else 0.0)
+                    for stage, t in self.timings.items()
+                }
+            }
@@ -0,0 +1,293 @@
+"""
+Load-balanced pool of VOICEVOX engines.
+
+Wraps one VoicevoxClient per engine and sends each request to the engine
+with the fewest outstanding requests, preferring the engine a speaker is
+pinned to (rendezvous hashing) so its voice model and audio-query cache
+stay warm, as long as that engine has a free slot or is no more than
+`affinity_slack` requests behind the least busy one.
+
+A background thread, started by the first request, pings every engine;
+engines that stop answering, or refuse a connection mid-request, are
+taken out of rotation until they answer again, and the request moves on
+to the next engine.
+
+Texts longer than `long_text_chars` are split at sentence boundaries, the
+pieces are synthesized in parallel across the engines and their PCM is
+joined into one WAV without re-encoding.
+
+Exposes the same synthesize/synthesize_async/get_stats interface as
+VoicevoxClient, so it is a drop-in replacement.
+"""
+
+import io
+import wave
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from voicevox_client import VoicevoxClient, VoicevoxError
+from tts_pipeline import SentenceSplitter
+
+
+def split_text(text, min_chars=24):
+    """Splits `text` at sentence boundaries, merging sentences shorter than `min_chars` into the next."""
+    splitter = SentenceSplitter()
+    pieces = []
+    current = ""
+    for sentence in splitter.feed(text) + splitter.flush():
+        current = f"{current} {sentence}".strip()
+        if len(current) >= min_chars:
+            pieces.append(current)
+            current = ""
+    if current:
+        if pieces:
+            pieces[-1] = f"{pieces[-1]} {current}"
+        else:
+            pieces.append(current)
+    return pieces or [text]
+
+
+def join_wavs(clips):
+    """Concatenates the PCM frames of WAV clips that share one format into a single WAV."""
+    params = None
+    frames = []
+    for clip in clips:
+        with wave.open(io.BytesIO(clip), "rb") as w:
+            clip_params = (w.getnchannels(), w.getsampwidth(), w.getframerate())
+            if params is None:
+                params = clip_params
+            elif clip_params != params:
+                raise VoicevoxError(f"Cannot join WAV clips with different formats: {params} and {clip_params}")
+            frames.append(w.readframes(w.getnframes()))
+
+    out = io.BytesIO()
+    with wave.open(out, "wb") as w:
+        w.setnchannels(params[0])
+        w.setsampwidth(params[1])
+        w.setframerate(params[2])
+        w.writeframes(b"".join(frames))
+    return out.getvalue()
+
+
+class _Engine:
+    def __init__(self, client):
+        self.client = client
+        self.url = client.base_url
+        self.healthy = True
+        self.outstanding = 0  # Requests routed here and not finished yet, including queued ones
+        self.requests = 0
+        self.failures = 0
+        self.last_error = None
+
+    def weight(self, speaker_id):
+        digest = hashlib.sha1(f"{speaker_id}\0{self.url}".encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big")
+
+
+class VoicevoxPool:
+    def __init__(self, urls, max_concurrency=2, health_interval=10, health_timeout=2,
+                 long_text_chars=120, affinity_slack=0, **client_options):
+        if isinstance(urls, str):
+            urls = [urls]
+        if not urls:
+            raise ValueError("VoicevoxPool needs at least one engine URL")
+        self.engines = [_Engine(VoicevoxClient(url, max_concurrency=max_concurrency, **client_options))
+                        for url in urls]
+        self.max_concurrency = max_concurrency
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.long_text_chars = long_text_chars
+        # Once its slots are full, how many more outstanding requests a speaker's engine may have than the least busy one
+        self.affinity_slack = affinity_slack
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=len(self.engines) * max_concurrency,
+                                            thread_name_prefix="voicevox-piece")
+        self.stats = {"requests": 0, "failovers": 0, "long_texts": 0, "pieces": 0}
+
+        self._stop = threading.Event()
+        self._health_thread = None  # Started by the first request, so importing app.py alone pings nothing
+
+    # ============================================
+    # Routing
+    # ============================================
+    def _acquire(self, speaker_id, tried):
+        with self._lock:
+            if self.health_interval and self._health_thread is None:
+                self._health_thread = threading.Thread(target=self._health_loop, daemon=True,
+                                                       name="voicevox-health")
+                self._health_thread.start()
+            candidates = [e for e in self.engines if e not in tried]
+            if not candidates:
+                return None
+            # Engines marked down are still tried once the healthy ones are exhausted
+            candidates = [e for e in candidates if e.healthy] or candidates
+            least = min(candidates, key=lambda e: e.outstanding)
+            home = max(candidates, key=lambda e: e.weight(speaker_id))
+            if home.outstanding < self.max_concurrency or home.outstanding <= least.outstanding + self.affinity_slack:
+                engine = home
+            else:
+                engine = least
+            engine.outstanding += 1
+            engine.requests += 1
+            self.stats["requests"] += 1
+            return engine
+
+    def _release(self, engine):
+        with self._lock:
+            engine.outstanding -= 1
+
+    def _set_health(self, engine, healthy, error=None):
+        with self._lock:
+            changed = engine.healthy != healthy
+            engine.healthy = healthy
+            if not healthy:
+                engine.failures += 1
+                engine.last_error = str(error)
+        if changed and healthy:
+            print(f"VOICEVOX engine {engine.url} is back in rotation")
+        elif changed:
+            print(f"VOICEVOX engine {engine.url} is down, taking it out of rotation: {error}")
+
+    def _failed(self, engine, error, tried):
+        """Marks an engine that refused the connection; returns True if another engine should be tried."""
+        self._set_health(engine, False, error)
+        tried.append(engine)
+        if len(tried) == len(self.engines):
+            return False
+        with self._lock:
+            self.stats["failovers"] += 1
+        return True
+
+    def _synthesize_one(self, text, speaker_id, params):
+        tried = []
+        while True:
+            engine = self._acquire(speaker_id, tried)
+            try:
+                audio = engine.client.synthesize(text, speaker_id, params)
+            except requests.exceptions.ConnectionError as e:
+                if self._failed(engine, e, tried):
+                    continue
+                raise
+            finally:
+                self._release(engine)
+            if not engine.healthy:
+                self._set_health(engine, True)
+            return audio
+
+    async def _synthesize_one_async(self, text, speaker_id, params):
+        tried = []
+        while True:
+            engine = self._acquire(speaker_id, tried)
+            try:
+                audio = await engine.client.synthesize_async(text, speaker_id, params)
+            except requests.exceptions.ConnectionError as e:
+                if self._failed(engine, e, tried):
+                    continue
+                raise
+            finally:
+                self._release(engine)
+            if not engine.healthy:
+                self._set_health(engine, True)
+            return audio
+
+    def _pieces(self, text):
+        if len(text) <= self.long_text_chars:
+            return [text]
+        pieces = split_text(text)
+        if len(pieces) > 1:
+            with self._lock:
+                self.stats["long_texts"] += 1
+                self.stats["pieces"] += len(pieces)
+        return pieces
+
+    # ============================================
+    # VoicevoxClient interface
+    # ============================================
+    def synthesize(self, text, speaker_id, params=None):
+        """
+        Returns WAV bytes for `text`. `params` overrides audio query fields
+        such as speedScale or pitchScale.
+        """
+        pieces = self._pieces(text)
+        if len(pieces) == 1:
+            return self._synthesize_one(text, speaker_id, params)
+
+        futures = [self._executor.submit(self._synthesize_one, piece, speaker_id, params) for piece in pieces]
+        try:
+            return join_wavs([future.result() for future in futures])
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    async def synthesize_async(self, text, speaker_id, params=None):
+        pieces = self._pieces(text)
+        if len(pieces) == 1:
+            return await self._synthesize_one_async(text, speaker_id, params)
+
+        tasks = [asyncio.ensure_future(self._synthesize_one_async(piece, speaker_id, params)) for piece in pieces]
+        try:
+            return join_wavs(await asyncio.gather(*tasks))
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    @property
+    def in_flight(self):
+        return sum(e.client.in_flight for e in self.engines)
+
+    @property
+    def queued(self):
+        return sum(e.client.queued for e in self.engines)
+
+    # ============================================
+    # Health checks
+    # ============================================
+    def check_health(self):
+        """Pings every engine once and updates which ones are in rotation."""
+        for engine in self.engines:
+            try:
+                response = engine.client.session.get(f"{engine.url}/version", timeout=self.health_timeout)
+                if response.status_code != 200:
+                    raise VoicevoxError(f"/version returned {response.status_code}")
+            except (requests.exceptions.RequestException, VoicevoxError) as e:
+                self._set_health(engine, False, e)
+            else:
+                self._set_health(engine, True)
+
+    def _health_loop(self):
+        while not self._stop.wait(self.health_interval):
+            self.check_health()
+
+    def close(self):
+        self._stop.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def aclose(self):
+        """Closes the async connection pools; they are recreated on the next async request."""
+        for engine in self.engines:
+            await engine.client.aclose()
+
+    def get_stats(self):
+        with self._lock:
+            engines = [
+                {"url": e.url, "healthy": e.healthy, "outstanding": e.outstanding, "requests": e.requests,
+                 "failures": e.failures, "last_error": e.last_error}
+                for e in self.engines
+            ]
+            stats = dict(self.stats)
+        for entry, engine in zip(engines, self.engines):
+            entry.update(engine.client.get_stats())
+        return dict(
+            stats,
+            engines=engines,
+            healthy_engines=sum(e["healthy"] for e in engines),
+            max_concurrency=self.max_concurrency * len(self.engines),
+            in_flight=sum(e["in_flight"] for e in engines),
+            queued=sum(e["queued"] for e in engines),
+        )
@@ -1,10 +1,15 @@
 import json
 import os
+import asyncio
 import websocket
 import time
+import itertools
+import threading
+from metrics import VTS_REQUEST
 
 class VTSConnector:
-    def __init__(self, host="127.0.0.1", port=8001):
+    def __init__(self, host="127.0.0.1", port=8001, request_timeout=5, token_timeout=30,
+                 min_backoff=0.5, max_backoff=30):
         self.host = host
         self.port = port
         self.token_file = ".vts_token"
@@ -15,6 +20,23 @@ class VTSConnector:
         self.authenticated = False
         self.hotkeys = []
 
+        # Session settings
+        self.request_timeout = request_timeout
+        self.token_timeout = token_timeout  # Token requests wait for the user to click "Allow" in VTS
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        # Session state (shared between callers and the background reader)
+        self._ws = None
+        self._reader = None
+        self._session_lock = threading.RLock()
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._request_ids = itertools.count(1)
+        self._backoff = 0
+        self._next_attempt = 0.0
+
     def _load_token(self):
         if os.path.exists(self.token_file):
             try:
@@ -32,87 +54,284 @@ class VTSConnector:
         except:
             pass
 
-    def _execute(self, request_type, data=None):
+    def _forget_token(self):
+        self.token = None
+        if os.path.exists(self.token_file):
+            try:
+                os.remove(self.token_file)
+            except:
+                pass
+
+    # ============================================
+    # Session management
+    # ============================================
+    def _open_socket(self):
+        url = f"ws://{self.host}:{self.port}"
+        ws = websocket.create_connection(url, timeout=self.request_timeout)
+        # The reader blocks on recv() for the lifetime of the session
+        ws.settimeout(None)
+        self._ws = ws
+        self.connected = True
+        self._reader = threading.Thread(target=self._read_loop, args=(ws,), daemon=True)
+        self._reader.start()
+
+    def _read_loop(self, ws):
         """
-        Executes a request by opening a new connection, authenticating if needed, 
-        sending the request, and closing the connection.
-        This is slow but extremely robust against connection drops.
+        Background reader: routes every incoming message to the caller waiting
+        on the matching requestID, so several requests can be in flight at once.
         """
-        ws = None
-        try:
-            url = f"ws://{self.host}:{self.port}"
-            ws = websocket.create_connection(url, timeout=5)
-            
-            # --- Phase 1: Authentication ---
+        while True:
+            try:
+                raw = ws.recv()
+            except Exception:
+                break
+            if not raw:
+                break
+            try:
+                res = json.loads(raw)
+            except ValueError:
+                continue
+
+            with self._pending_lock:
+                slot = self._pending.pop(res.get("requestID"), None)
+            if slot is not None:
+                slot["response"] = res
+                self._wake(slot)
+
+        self._drop_session(ws)
+
+    def _drop_session(self, ws=None):
+        """Closes the socket and fails every request still waiting on it."""
+        with self._session_lock:
+            if ws is not None and ws is not self._ws:
+                return  # Already replaced by a newer session
+            current = self._ws
+            self._ws = None
+            self.connected = False
+            self.authenticated = False
+
+        if current is not None:
+            try:
+                current.close()
+            except:
+                pass
+
+        with self._pending_lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for slot in pending:
+            self._wake(slot)
+
+    @staticmethod
+    def _wake(slot):
+        slot["event"].set()
+        if slot.get("callback"):
+            slot["callback"]()
+
+    def _schedule_retry(self):
+        self._backoff = min(self.max_backoff, self._backoff * 2) if self._backoff else self.min_backoff
+        self._next_attempt = time.time() + self._backoff
+
+    def _ensure_session(self):
+        """
+        Returns (True, None) once there is an open, authenticated session,
+        connecting and authenticating only when needed.
+        """
+        with self._session_lock:
+            if self._ws is not None and self.authenticated:
+                return True, None
+
+            # Also applies to an open socket whose authentication failed, so a rejected or dismissed
+            # token request isn't repeated (as another pop-up in VTS) on every call
+            wait = self._next_attempt - time.time()
+            if wait > 0:
+                return False, f"VTS Error: retrying in {wait:.1f}s"
+
+            try:
+                if self._ws is None:
+                    self._open_socket()
+                success, msg = self._authenticate_session()
+            except Exception as e:
+                self._drop_session()
+                self._schedule_retry()
+                return False, f"VTS Error: {str(e)}"
+
+            if not success:
+                self._schedule_retry()
+                return False, msg
+
+            self._backoff = 0
+            self._next_attempt = 0.0
+            return True, None
+
+    def _authenticate_session(self):
+        """Authenticates the open socket, requesting a new token only if the stored one is rejected."""
+        for _ in range(2):
             if not self.token:
-                # Request new token
-                token_req = {
-                    "apiName": "VTubeStudioPublicAPI",
-                    "apiVersion": "1.0",
-                    "requestID": "TokenReq",
-                    "messageType": "AuthenticationTokenRequest",
-                    "data": {
-                        "pluginName": self.plugin_name,
-                        "pluginDeveloper": self.developer
-                    }
-                }
-                ws.send(json.dumps(token_req))
-                res = json.loads(ws.recv())
+                res = self._send("AuthenticationTokenRequest", {
+                    "pluginName": self.plugin_name,
+                    "pluginDeveloper": self.developer
+                }, timeout=self.token_timeout)
                 if res.get("messageType") == "AuthenticationTokenResponse":
-                    self.token = res["data"]["authenticationToken"]
-                    self._save_token(self.token)
+                    self._save_token(res["data"]["authenticationToken"])
                 else:
                     return False, f"Token request failed: {res.get('data', {}).get('message', 'Unknown')}"
 
-            # Authenticate with existing/new token
-            auth_req = {
-                "apiName": "VTubeStudioPublicAPI",
-                "apiVersion": "1.0",
-                "requestID": "AuthReq",
-                "messageType": "AuthenticationRequest",
-                "data": {
-                    "pluginName": self.plugin_name,
-                    "pluginDeveloper": self.developer,
-                    "authenticationToken": self.token
-                }
-            }
-            ws.send(json.dumps(auth_req))
-            res = json.loads(ws.recv())
-            
-            if res.get("messageType") == "APIError" and res["data"].get("errorID") == 8:
-                # Invalid token, clear and retry once
-                self.token = None
-                if os.path.exists(self.token_file):
-                    os.remove(self.token_file)
-                ws.close()
-                return self._execute(request_type, data)
-
-            if not (res.get("messageType") == "AuthenticationResponse" and res["data"]["authenticated"]):
-                return False, f"Auth failed: {res.get('data', {}).get('message', 'Not authenticated')}"
-
-            # --- Phase 2: Actual Request ---
-            if request_type == "authenticate_only":
+            res = self._send("AuthenticationRequest", {
+                "pluginName": self.plugin_name,
+                "pluginDeveloper": self.developer,
+                "authenticationToken": self.token
+            })
+
+            if res.get("messageType") == "AuthenticationResponse" and res["data"].get("authenticated"):
+                self.authenticated = True
                 return True, "Authenticated"
 
-            msg = {
-                "apiName": "VTubeStudioPublicAPI",
-                "apiVersion": "1.0",
-                "requestID": f"Req_{int(time.time())}",
-                "messageType": request_type,
-                "data": data if data else {}
-            }
-            ws.send(json.dumps(msg))
-            res = json.loads(ws.recv())
-            return True, res
+            rejected = (
+                (res.get("messageType") == "APIError" and res["data"].get("errorID") == 8)
+                or res.get("messageType") == "AuthenticationResponse"
+            )
+            if not rejected:
+                break
+            # Stored token was rejected, drop it and request a fresh one
+            self._forget_token()
+
+        return False, f"Auth failed: {res.get('data', {}).get('message', 'Not authenticated')}"
+
+    def _post(self, request_type, data, slot):
+        """Registers `slot` for the response and sends the request; returns its requestID."""
+        ws = self._ws
+        if ws is None:
+            raise ConnectionError("Not connected")
 
-        except Exception as e:
-            return False, f"VTS Error: {str(e)}"
+        request_id = f"Req_{next(self._request_ids)}"
+        with self._pending_lock:
+            self._pending[request_id] = slot
+
+        msg = {
+            "apiName": "VTubeStudioPublicAPI",
+            "apiVersion": "1.0",
+            "requestID": request_id,
+            "messageType": request_type,
+            "data": data if data else {}
+        }
+        try:
+            with self._send_lock:
+                ws.send(json.dumps(msg))
+        except Exception:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            self._drop_session(ws)
+            raise
+        return request_id
+
+    def _send(self, request_type, data=None, timeout=None):
+        """
+        Sends one request over the open session and waits for the response
+        with the same requestID. Raises on timeout or if the session drops.
+        """
+        slot = {"event": threading.Event(), "response": None}
+        request_id = self._post(request_type, data, slot)
+
+        if not slot["event"].wait(timeout or self.request_timeout):
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            raise TimeoutError(f"{request_type} timed out")
+        if slot["response"] is None:
+            raise ConnectionError("Connection closed")
+        return slot["response"]
+
+    def _execute(self, request_type, data=None):
+        """
+        Executes a request over the long-lived session, connecting and
+        authenticating first if needed. Safe to call from several threads.
+        """
+        start = time.perf_counter()
+        try:
+            return self._execute_with_retry(request_type, data)
         finally:
-            if ws:
+            VTS_REQUEST.observe(time.perf_counter() - start, request_type=request_type)
+
+    async def _send_async(self, request_type, data=None, timeout=None):
+        """
+        Like _send(), but waits for the response on the event loop instead of
+        blocking a thread; the reader thread resolves the future.
+        """
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def resolve():
+            loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+
+        slot = {"event": threading.Event(), "response": None, "callback": resolve}
+        request_id = self._post(request_type, data, slot)
+        try:
+            await asyncio.wait_for(done, timeout or self.request_timeout)
+        except asyncio.TimeoutError:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            raise TimeoutError(f"{request_type} timed out")
+        if slot["response"] is None:
+            raise ConnectionError("Connection closed")
+        return slot["response"]
+
+    async def _execute_async(self, request_type, data=None):
+        """
+        Async _execute(): requests never block a thread; only (re)connecting
+        and authenticating, which is rare, runs in a worker thread.
+        """
+        start = time.perf_counter()
+        try:
+            for attempt in range(2):
+                if self._ws is None or not self.authenticated:
+                    success, msg = await asyncio.to_thread(self._ensure_session)
+                    if not success:
+                        return False, msg
+
                 try:
-                    ws.close()
-                except:
-                    pass
+                    res = await self._send_async(request_type, data)
+                except TimeoutError as e:
+                    return False, f"VTS Error: {str(e)}"
+                except Exception as e:
+                    if attempt == 0:
+                        continue
+                    return False, f"VTS Error: {str(e)}"
+
+                if res.get("messageType") == "APIError" and res["data"].get("errorID") == 8 and attempt == 0:
+                    self.authenticated = False
+                    continue
+                return True, res
+
+            return False, "VTS Error: request failed"
+        finally:
+            VTS_REQUEST.observe(time.perf_counter() - start, request_type=request_type)
+
+    def _execute_with_retry(self, request_type, data):
+        for attempt in range(2):
+            success, msg = self._ensure_session()
+            if not success:
+                return False, msg
+
+            if request_type == "authenticate_only":
+                return True, "Authenticated"
+
+            try:
+                res = self._send(request_type, data)
+            except TimeoutError as e:
+                return False, f"VTS Error: {str(e)}"
+            except Exception as e:
+                # Socket dropped mid-request, reconnect and retry once
+                if attempt == 0:
+                    continue
+                return False, f"VTS Error: {str(e)}"
+
+            if res.get("messageType") == "APIError" and res["data"].get("errorID") == 8 and attempt == 0:
+                # Session lost its authentication, re-authenticate with the stored token
+                self.authenticated = False
+                continue
+            return True, res
+
+        return False, "VTS Error: request failed"
 
     def authenticate(self):
         success, res = self._execute("authenticate_only")
@@ -121,19 +340,29 @@ class VTSConnector:
             self.authenticated = True
             return True, "Authenticated"
         else:
-            self.connected = False
             self.authenticated = False
             return False, res
 
     def get_hotkeys(self):
-        success, res = self._execute("HotkeysInCurrentModelRequest")
+        return self._hotkeys_result(*self._execute("HotkeysInCurrentModelRequest"))
+
+    async def get_hotkeys_async(self):
+        return self._hotkeys_result(*await self._execute_async("HotkeysInCurrentModelRequest"))
+
+    def _hotkeys_result(self, success, res):
         if success and res.get("messageType") == "HotkeysInCurrentModelResponse":
             self.hotkeys = res["data"]["availableHotkeys"]
             return self.hotkeys
         return []
 
     def trigger_hotkey(self, hotkey_id):
-        success, res = self._execute("HotkeyTriggerRequest", {"hotkeyID": hotkey_id})
+        return self._trigger_result(*self._execute("HotkeyTriggerRequest", {"hotkeyID": hotkey_id}))
+
+    async def trigger_hotkey_async(self, hotkey_id):
+        return self._trigger_result(*await self._execute_async("HotkeyTriggerRequest", {"hotkeyID": hotkey_id}))
+
+    @staticmethod
+    def _trigger_result(success, res):
         if success and res.get("messageType") == "HotkeyTriggerResponse":
             return True, "Hotkey triggered"
         return False, res if not success else "Failed to trigger"
@@ -142,29 +371,46 @@ class VTSConnector:
         """
         Injects a value into a VTS parameter for lip-sync or other controls.
         """
-        data = {
+        return self.inject_parameters({parameter_name: value}, weight)
+
+    def inject_parameters(self, values, weight=1.0):
+        """
+        Injects several parameters in one InjectParameterDataRequest frame.
+        `values` maps parameter names to values.
+        """
+        return self._inject_result(*self._execute("InjectParameterDataRequest", self._inject_data(values, weight)))
+
+    async def inject_parameters_async(self, values, weight=1.0):
+        data = self._inject_data(values, weight)
+        return self._inject_result(*await self._execute_async("InjectParameterDataRequest", data))
+
+    @staticmethod
+    def _inject_data(values, weight):
+        return {
             "faceFound": False,
             "mode": "set",
             "parameterValues": [
                 {
-                    "id": parameter_name,
+                    "id": name,
                     "value": float(value),
                     "weight": float(weight)
                 }
+                for name, value in values.items()
             ]
         }
-        success, res = self._execute("InjectParameterDataRequest", data)
+
+    @staticmethod
+    def _inject_result(success, res):
         if success and res.get("messageType") == "InjectParameterDataResponse":
             return True, "Parameter injected"
         return False, res if not success else "Failed to inject parameter"
 
     def clear_token(self):
-        self.token = None
-        if os.path.exists(self.token_file):
-            try:
-                os.remove(self.token_file)
-            except:
-                pass
-        self.authenticated = False
-        self.connected = False
+        self._forget_token()
+        self._drop_session()
+        self._backoff = 0
+        self._next_attempt = 0.0
         return True, "Token cleared"
+
+    def close(self):
+        self._drop_session()